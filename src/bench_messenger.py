@@ -0,0 +1,163 @@
+"""
+bench_messenger.py
+Load-tests the messaging path: drives simulated DirectMessenger clients against a DSU server
+and reports throughput and latency percentiles, optionally as JSON
+"""
+
+import argparse, json, sys, threading, time
+import ds_messenger
+from ds_messenger import DirectMessenger
+from ds_metrics import percentile
+from ds_server import DsuServer
+
+def summarize(samples, errors=0) -> dict:
+    """
+    Returns the count, error count and latency statistics in milliseconds of a list of samples in seconds.
+    """
+    return {'count': len(samples),
+            'errors': errors,
+            'mean_ms': sum(samples) / len(samples) * 1000 if samples else 0.0,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000
+            }
+
+def compare(results, baseline, threshold, keys=('p50_ms', 'p99_ms')) -> list:
+    """
+    Compares the ops of two result dictionaries and returns a description of each op whose p50 or p99
+    latency, or other statistic in keys, grew by more than threshold, as a fraction of the baseline.
+    """
+    regressions = []
+    for name, stats in results['ops'].items():
+        base = baseline.get('ops', {}).get(name)
+        if base is None:
+            continue
+        for key in keys:
+            if key not in stats or key not in base:
+                continue
+            if base[key] > 0 and stats[key] > base[key] * (1 + threshold):
+                regressions.append(f"{name} {key}: {stats[key]:.3f} vs baseline {base[key]:.3f}")
+    return regressions
+
+def report(results, json_path=None, baseline_path=None, threshold=0.2, keys=('p50_ms', 'p99_ms')) -> int:
+    """
+    Prints the results, writes them to json_path if given, and checks the statistics in keys against
+    the baseline results file if given. Returns the exit status: 1 if any op regressed, otherwise 0.
+    """
+    width = max([16] + [len(name) for name in results['ops']])
+    for name, stats in results['ops'].items():
+        line = (f"{name:>{width}}: {stats['count']:>8} ops {stats['errors']:>6} err  "
+                f"mean {stats['mean_ms']:9.3f} ms  p50 {stats['p50_ms']:9.3f} ms")
+        # Ops with too few samples for a p99 report their slowest sample instead
+        if 'p99_ms' in stats:
+            line += f"  p99 {stats['p99_ms']:9.3f} ms"
+        else:
+            line += f"  max {stats['max_ms']:9.3f} ms"
+        if 'peak_mb' in stats:
+            line += f"  peak {stats['peak_mb']:8.1f} MB"
+        print(line)
+    for key, value in results.items():
+        if key != 'ops':
+            print(f"{key}: {value}")
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), threshold, keys)
+        for line in regressions:
+            print("REGRESSION:", line)
+        return 1 if regressions else 0
+    return 0
+
+def _client(dmr, peer, messages, poll_every, samples, errors, start):
+    """
+    Thread body for one simulated client: sends messages to its peer, retrieving new messages
+    every poll_every sends, and records the latency of each operation.
+    """
+    start.wait()
+    for i in range(messages):
+        t = time.perf_counter()
+        ok = dmr.send(f"message {i} from {dmr.username}", peer)
+        samples['send'].append(time.perf_counter() - t)
+        if not ok:
+            errors['send'] += 1
+        if poll_every and (i + 1) % poll_every == 0:
+            t = time.perf_counter()
+            ok = dmr.retrieve_new() is not None
+            samples['retrieve_new'].append(time.perf_counter() - t)
+            if not ok:
+                errors['retrieve_new'] += 1
+
+def run(host, port, clients=10, messages=100, poll_every=10) -> dict:
+    """
+    Joins clients users to the server at host and port, then has each send messages to the next
+    user while polling for new messages. Returns the results as a dictionary.
+    """
+    ds_messenger.DSU_SERVER_PORT = port
+    ops = ('join', 'send', 'retrieve_new')
+    samples = {name: [] for name in ops}
+    errors = {name: 0 for name in ops}
+    messengers = []
+    for i in range(clients):
+        t = time.perf_counter()
+        dmr = DirectMessenger(host, f"bench{i}", "pwd")
+        samples['join'].append(time.perf_counter() - t)
+        if dmr.token is None:
+            errors['join'] += 1
+        messengers.append(dmr)
+
+    start = threading.Event()
+    threads = []
+    for i, dmr in enumerate(messengers):
+        # Each thread appends to its own lists; they are merged once the run is over
+        own_samples = {name: [] for name in ops}
+        own_errors = {name: 0 for name in ops}
+        peer = f"bench{(i + 1) % clients}"
+        thread = threading.Thread(target=_client, args=(dmr, peer, messages, poll_every, own_samples, own_errors, start))
+        threads.append((thread, own_samples, own_errors))
+        thread.start()
+    t = time.perf_counter()
+    start.set()
+    for thread, own_samples, own_errors in threads:
+        thread.join()
+        for name in ops:
+            samples[name].extend(own_samples[name])
+            errors[name] += own_errors[name]
+    elapsed = time.perf_counter() - t
+    for dmr in messengers:
+        dmr.close()
+
+    total = len(samples['send']) + len(samples['retrieve_new'])
+    return {'ops': {name: summarize(samples[name], errors[name]) for name in ops},
+            'clients': clients,
+            'messages_per_client': messages,
+            'elapsed_s': elapsed,
+            'throughput_ops_s': total / elapsed if elapsed else 0.0
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test DirectMessenger against a DSU server.")
+    parser.add_argument('--server', help="host:port of a running server; a local DsuServer is started if omitted")
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=100, help="messages sent by each client")
+    parser.add_argument('--poll-every', type=int, default=10, help="sends between retrieve_new calls, 0 to never poll")
+    parser.add_argument('--latency', type=float, default=0.0, help="latency injected by the local server, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="error rate injected by the local server")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    server = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        port = int(port)
+    else:
+        server = DsuServer(latency=args.latency, error_rate=args.error_rate, seed=0)
+        host, port = server.host, server.start_in_thread()
+    results = run(host, port, args.clients, args.messages, args.poll_every)
+    if server is not None:
+        results['server_connections'] = server.connections
+        server.stop()
+    sys.exit(report(results, args.json, args.baseline, args.threshold))
@@ -0,0 +1,254 @@
+"""
+bench_profile.py
+Benchmarks the client-side costs that grow with an account: loading, saving and appending to a profile,
+and rendering a conversation, on synthetic DSU files of increasing size. Reports latency percentiles and
+peak memory, optionally as JSON, and checks them against a baseline
+"""
+
+import argparse, gc, json, os, random, shutil, sys, tempfile, time, tracemalloc
+from bench_messenger import summarize, report
+from ds_messenger import DirectMessage
+from message_view import render_lines
+from profile import Profile
+
+# Messages in the synthetic profiles, and contacts they are spread over
+BENCH_SIZES = (1000, 10000, 100000, 1000000)
+BENCH_CONTACTS = (10, 1000)
+
+# Timed runs of each op, messages appended one at a time, and appends between journal saves
+BENCH_REPEAT = 3
+BENCH_APPENDS = 1000
+BENCH_SAVE_EVERY = 100
+
+# Messages of each contact read by a lazy load, as the GUI reads them
+BENCH_RECENT = 200
+
+# Samples an op needs for its p99 to be reported; with fewer, p99 would only be the slowest run, so the
+# slowest run is reported as max instead
+BENCH_P99_SAMPLES = 100
+
+_WORDS = ('hello', 'meeting', 'tomorrow', 'lunch', 'project', 'deadline', 'thanks', 'call', 'later',
+          'weekend', 'ok', 'sure', 'report', 'review', 'coffee', 'done', 'update', 'question', 'yes', 'no')
+
+def generate(path, messages, contacts, seed=0) -> str:
+    """
+    Writes a DSU file holding messages synthetic messages, sent to and received from contacts contacts
+    in random order, in the layout of a file written before journals and sidecar files existed.
+    Returns the name of the contact with the most messages.
+    """
+    rnd = random.Random(seed)
+    names = [f'contact{i}' for i in range(contacts)]
+    counts = [0] * contacts
+    retrieved = []
+    now = time.time() - messages
+    for i in range(messages):
+        c = rnd.randrange(contacts)
+        counts[c] += 1
+        text = ' '.join(rnd.choice(_WORDS) for _ in range(rnd.randint(3, 12)))
+        key = 'recipient' if rnd.random() < 0.5 else 'from'
+        retrieved.append({key: names[c], 'message': f'{text} {i}', 'timestamp': now + i})
+    obj = {'dsuserver': '127.0.0.1', 'username': 'bench', 'password': 'pwd', '_recipients': names,
+           '_sentmsgs': [msg for msg in retrieved if 'recipient' in msg],
+           '_newmsgs': [msg for msg in retrieved if 'from' in msg],
+           '_retrievedmsgs': retrieved}
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+    return names[counts.index(max(counts))]
+
+
+def _remove_sidecars(path) -> None:
+    """
+    Removes every file the client keeps next to a DSU file, so the next load starts from the JSON alone.
+    """
+    for suffix in ('.cache', '.idx', '.search', '.journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    if os.path.isdir(path + '.archive'):
+        shutil.rmtree(path + '.archive')
+
+
+def _measure(func, repeat, setup=None) -> dict:
+    """
+    Runs func repeat times, each after setup if given, and then once more under tracemalloc.
+    Returns the latency statistics of the timed runs and the peak memory of the traced run in MB.
+    """
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        t = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t)
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(_stats(samples), peak_mb=peak / 2 ** 20)
+
+
+def _stats(samples) -> dict:
+    """
+    Returns the latency statistics of samples, with max_ms in place of p99_ms if there are fewer than
+    BENCH_P99_SAMPLES of them.
+    """
+    stats = summarize(samples)
+    if len(samples) < BENCH_P99_SAMPLES:
+        del stats['p99_ms']
+        stats['max_ms'] = max(samples) * 1000 if samples else 0.0
+    return stats
+
+
+def _loaded(path, recent=None) -> Profile:
+    """
+    Returns a profile loaded from path.
+    """
+    profile = Profile()
+    profile.load_profile(path, recent)
+    return profile
+
+
+def _renderer(profile):
+    """
+    Returns a function that renders a contact's whole conversation from an empty cache with
+    MainApp.set_message_box, drawing it in a hidden window if there is a display, a description of
+    what it measures, and the window to destroy afterwards. Without a display, or without tkinter,
+    only the lines are built, with the render_lines that MainApp._render uses.
+    """
+    try:
+        import main
+        root = main.tk.Tk()
+    except ImportError:
+        root = None
+    except main.tk.TclError:
+        root = None
+    if root is None:
+        return lambda contact: render_lines(profile.conversation(contact)), 'lines', None
+    root.withdraw()
+    app = main.MainApp(root)
+    app._current_profile = profile
+
+    def render(contact):
+        app._rendered = {}
+        app._shown_contact = None
+        app.body.recipient = contact
+        app.set_message_box()
+        root.update_idletasks()
+    return render, 'widget', root
+
+
+def run(sizes=BENCH_SIZES, contact_counts=BENCH_CONTACTS, repeat=BENCH_REPEAT, appends=BENCH_APPENDS,
+        directory=None) -> dict:
+    """
+    Generates a DSU file for each combination of sizes and contact_counts and measures, for each:
+    load_cold: load from the JSON alone, writing the snapshot cache
+    save_snapshot: rewrite the whole DSU file with its index, cache and search index
+    load: load through the snapshot cache
+    load_recent: lazy load of the last BENCH_RECENT messages of each contact through the index
+    append: store one received message, as Profile.new_msg does
+    save_append: append the journal records of BENCH_SAVE_EVERY messages
+    render: render the largest conversation
+    Op names are suffixed with /messages x contacts. Returns the results as a dictionary.
+    """
+    own_dir = directory is None
+    directory = directory or tempfile.mkdtemp(prefix='bench_profile')
+    ops = {}
+    render_mode = None
+    try:
+        for size in sizes:
+            for contacts in contact_counts:
+                if contacts > size:
+                    continue
+                label = f'{size}x{contacts}'
+                path = os.path.join(directory, f'bench_{label}.dsu')
+                busiest = generate(path, size, contacts)
+                pristine = path + '.orig'
+                shutil.copyfile(path, pristine)
+
+                def fresh():
+                    _remove_sidecars(path)
+                    shutil.copyfile(pristine, path)
+                ops[f'load_cold/{label}'] = _measure(lambda: _loaded(path), repeat, fresh)
+                profile = _loaded(path)
+                # The search index is built once per profile, on its first search or snapshot; only later snapshots are timed
+                profile.search('hello')
+                ops[f'save_snapshot/{label}'] = _measure(lambda: profile.compact(path), repeat)
+                del profile
+                ops[f'load/{label}'] = _measure(lambda: _loaded(path), repeat)
+                ops[f'load_recent/{label}'] = _measure(lambda: _loaded(path, BENCH_RECENT), repeat)
+
+                profile = _loaded(path)
+                ops[f'append/{label}'], ops[f'save_append/{label}'] = _append(profile, path, busiest, appends)
+                render, render_mode, root = _renderer(profile)
+                ops[f'render/{label}'] = _measure(lambda: render(busiest), repeat)
+                if root is not None:
+                    root.destroy()
+                del profile, render
+                os.remove(pristine)
+                _remove_sidecars(path)
+                os.remove(path)
+    finally:
+        if own_dir:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {'ops': ops,
+            'repeat': repeat,
+            'appends': appends,
+            'render': render_mode,
+            'python': sys.version.split()[0]
+            }
+
+
+def _append(profile, path, contact, appends) -> tuple:
+    """
+    Stores appends received messages from contact one at a time, saving the journal every
+    BENCH_SAVE_EVERY messages. Returns the statistics of the appends and of the saves; the peak
+    memory of both covers the whole run.
+    """
+    append_samples = []
+    save_samples = []
+    tracemalloc.start()
+    try:
+        for i in range(appends):
+            dm = DirectMessage()
+            dm.recipient = contact
+            dm.message = f'appended message {i}'
+            dm.timestamp = time.time()
+            t = time.perf_counter()
+            profile.store_new_msgs([dm])
+            append_samples.append(time.perf_counter() - t)
+            if (i + 1) % BENCH_SAVE_EVERY == 0:
+                t = time.perf_counter()
+                profile.save_profile(path)
+                save_samples.append(time.perf_counter() - t)
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return dict(_stats(append_samples), peak_mb=peak), dict(_stats(save_samples), peak_mb=peak)
+
+
+def _ints(text) -> list:
+    """
+    Parses a comma separated list of integers.
+    """
+    return [int(value) for value in text.split(',') if value]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark profile load, save, append and render on synthetic DSU files.")
+    parser.add_argument('--sizes', type=_ints, default=list(BENCH_SIZES), help="comma separated message counts")
+    parser.add_argument('--contacts', type=_ints, default=list(BENCH_CONTACTS), help="comma separated contact counts")
+    parser.add_argument('--repeat', type=int, default=BENCH_REPEAT, help="timed runs of each op")
+    parser.add_argument('--appends', type=int, default=BENCH_APPENDS, help="messages appended one at a time")
+    parser.add_argument('--dir', help="directory for the generated files; a temporary one is used if omitted")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown or memory growth against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.contacts, args.repeat, args.appends, args.dir)
+    sys.exit(report(results, args.json, args.baseline, args.threshold, ('p50_ms', 'p99_ms', 'max_ms', 'peak_mb')))
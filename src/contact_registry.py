@@ -0,0 +1,95 @@
+"""
+contact_registry.py
+Defines the ContactRegistry class, which holds a profile's contacts with their activity and unread counts
+"""
+
+class ContactRegistry:
+    """
+    The contacts of a profile, each with a stable id given in the order contacts are added.
+    Membership is a dictionary lookup, so adding a contact twice is caught at any size. For each contact
+    the time of its latest message and the number of messages received since it was last read are kept,
+    so the contacts can be ordered by activity without scanning their conversations.
+    """
+    def __init__(self):
+        self._ids = {}      # name -> id
+        self._names = []    # id -> name
+        self._activity = [] # id -> timestamp of the latest message
+        self._unread = []   # id -> messages received since the contact was last read
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def add(self, name) -> bool:
+        '''
+        Adds a contact. Returns false if it was already a contact.
+        '''
+        if name in self._ids:
+            return False
+        self._ids[name] = len(self._names)
+        self._names.append(name)
+        self._activity.append(0.0)
+        self._unread.append(0)
+        return True
+
+    def names(self) -> list:
+        '''
+        Returns the contact names in the order they were added.
+        '''
+        return list(self._names)
+
+    def id_of(self, name) -> int:
+        '''
+        Returns the id of a contact, or None if it is not a contact.
+        '''
+        return self._ids.get(name)
+
+    def name_of(self, id) -> str:
+        '''
+        Returns the name of the contact with an id.
+        '''
+        return self._names[id]
+
+    def touch(self, name, timestamp, unread=False) -> bool:
+        '''
+        Records a message to or from a contact at timestamp, counting it as unread if unread is true.
+        Returns false if name is not a contact.
+        '''
+        id = self._ids.get(name)
+        if id is None:
+            return False
+        if timestamp > self._activity[id]:
+            self._activity[id] = timestamp
+        if unread:
+            self._unread[id] += 1
+        return True
+
+    def unread(self, name) -> int:
+        '''
+        Returns the number of messages received from a contact since it was last read.
+        '''
+        id = self._ids.get(name)
+        return 0 if id is None else self._unread[id]
+
+    def mark_read(self, name) -> bool:
+        '''
+        Clears the unread count of a contact. Returns true if it had unread messages.
+        '''
+        id = self._ids.get(name)
+        if id is None or not self._unread[id]:
+            return False
+        self._unread[id] = 0
+        return True
+
+    def by_activity(self) -> list:
+        '''
+        Returns the contact ids ordered by their latest message, newest first. Contacts without
+        messages follow in the order they were added.
+        '''
+        activity = self._activity
+        return sorted(range(len(self._names)), key=lambda id: -activity[id])
@@ -0,0 +1,177 @@
+"""
+ds_accounts.py
+Defines the AccountManager class, which hosts many DSU profiles in one process, polling and sending
+for all of them from one asyncio event loop
+"""
+
+import argparse, asyncio, json, logging, sys
+from concurrent.futures import ThreadPoolExecutor
+import ds_messenger
+import ds_metrics
+from ds_client import HeadlessClient
+from ds_worker import PollScheduler
+
+log = logging.getLogger(__name__)
+
+# Server commands in flight at once across every account
+ACCOUNT_CONCURRENCY = 32
+
+class Account:
+    """
+    One hosted profile: its HeadlessClient, poll scheduler and outbox. Every command of an account runs
+    under its lock, so its session, token and profile are only ever used by one command at a time.
+    """
+    def __init__(self, client, scheduler):
+        self.client = client
+        self.username = client.profile.username
+        self.scheduler = scheduler
+        self.lock = asyncio.Lock()
+        self.outbox = []    # (message, recipient, future) waiting to be sent
+        self.wakeup = asyncio.Event()
+        self.active = asyncio.Event()   # set by a send, to cut short the poll task's sleep
+
+
+class AccountManager:
+    """
+    Hosts many accounts on one event loop. Each account has a poll task, which sleeps for the delay its
+    PollScheduler chooses, or less once the account sends, and a send task, which sends everything queued for it as one pipelined batch.
+    The blocking server commands run on a pool of concurrency threads, which caps the commands in flight
+    across all accounts. Each account has its own DirectMessenger and Codec, so tokens are never shared.
+    The session of an account whose polls have backed off to max_interval is closed between polls,
+    so mostly idle accounts hold no connection.
+    New messages are put on the incoming queue as (username, DirectMessage) pairs.
+    """
+    def __init__(self, concurrency=ACCOUNT_CONCURRENCY, min_interval=1.0, max_interval=60.0):
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.accounts = {}
+        self.incoming = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ds-account')
+        self._tasks = []
+
+    async def add(self, path, dsuserver=None) -> Account:
+        '''
+        Opens a DSU profile and starts polling and sending for it. Returns its Account.
+        '''
+        client = await self._call(HeadlessClient, path, dsuserver)
+        account = Account(client, PollScheduler(self.min_interval, self.max_interval))
+        self.accounts[account.username] = account
+        self._tasks.append(asyncio.create_task(self._poll_loop(account)))
+        self._tasks.append(asyncio.create_task(self._send_loop(account)))
+        return account
+
+    def send(self, username, message, recipient) -> asyncio.Future:
+        '''
+        Queues a direct message from a hosted account. Returns a future that is set to true once the
+        server accepts the message, or to false if it fails. A message the server did not answer stays
+        in the account's saved outbox and is sent after a later successful poll.
+        '''
+        account = self.accounts[username]
+        future = asyncio.get_running_loop().create_future()
+        account.outbox.append((message, recipient, future))
+        account.scheduler.activity()
+        account.active.set()
+        account.wakeup.set()
+        return future
+
+    async def close(self) -> None:
+        '''
+        Stops every account's tasks, then saves each profile and closes its session.
+        '''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for account in self.accounts.values():
+            async with account.lock:
+                await self._call(account.client.close)
+        self._executor.shutdown()
+
+    async def _call(self, func, *args):
+        """
+        Runs a blocking function on the thread pool.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _poll_loop(self, account):
+        """
+        Task body: polls an account for new messages forever, at the rate its scheduler chooses.
+        A send while the task sleeps starts the delay again at the rate the activity set.
+        """
+        scheduler = account.scheduler
+        while True:
+            delay = scheduler.next_delay()
+            while True:
+                account.active.clear()
+                try:
+                    await asyncio.wait_for(account.active.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+                delay = scheduler.next_delay()
+            async with account.lock:
+                newmsg_list = await self._call(account.client.receive)
+                scheduler.result(newmsg_list is not None, len(newmsg_list or ()))
+                if scheduler.interval >= self.max_interval:
+                    account.client.profile.close()
+            for dm in newmsg_list or ():
+                self.incoming.put_nowait((account.username, dm))
+
+    async def _send_loop(self, account):
+        """
+        Task body: sends the messages queued for an account, a batch at a time, as they are queued.
+        """
+        while True:
+            await account.wakeup.wait()
+            account.wakeup.clear()
+            outbox, account.outbox = account.outbox, []
+            if not outbox:
+                continue
+            pairs = [(message, recipient) for message, recipient, _ in outbox]
+            async with account.lock:
+                try:
+                    report = await self._call(lambda: list(account.client.send_many(pairs, len(pairs))))
+                except Exception as ex:
+                    log.error("Send failed.", extra={'op': 'send', 'account': account.username, 'error': str(ex)})
+                    report = [(message, recipient, False) for message, recipient in pairs]
+            # Messages left in the profile's outbox by an earlier failure are reported first
+            for (_, _, future), (_, _, sent) in zip(outbox, report[len(report) - len(outbox):]):
+                if not future.done():
+                    future.set_result(sent)
+
+
+async def _serve(paths, host, concurrency):
+    """
+    Hosts the profiles at paths and writes their incoming messages to standard output as JSON lines.
+    """
+    manager = AccountManager(concurrency)
+    try:
+        await asyncio.gather(*(manager.add(path, host) for path in paths))
+        log.info("Accounts loaded.", extra={'op': 'serve', 'accounts': len(manager.accounts)})
+        while True:
+            username, dm = await manager.incoming.get()
+            sys.stdout.write(json.dumps({'account': username, 'from': dm.recipient, 'message': dm.message,
+                                         'timestamp': dm.timestamp}) + '\n')
+            if manager.incoming.empty():
+                sys.stdout.flush()
+    finally:
+        await manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host many DSU profiles in one process and stream their incoming messages.")
+    parser.add_argument('profiles', nargs='+', help="paths of the .dsu files")
+    parser.add_argument('--server', help="host:port of the DSU server, overriding each profile's server and DSU_SERVER_PORT")
+    parser.add_argument('--concurrency', type=int, default=ACCOUNT_CONCURRENCY, help="server commands in flight at once")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    ds_metrics.configure_logging(args.log_level.upper())
+    host = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        ds_messenger.DSU_SERVER_PORT = int(port)
+    try:
+        asyncio.run(_serve(args.profiles, host, args.concurrency))
+    except KeyboardInterrupt:
+        pass
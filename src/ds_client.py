@@ -0,0 +1,178 @@
+"""
+ds_client.py
+Defines the HeadlessClient class, which drives a profile without the GUI, and a command line entry
+point for sending messages in bulk and streaming incoming messages as JSON lines.
+Does not import tkinter, so it runs on machines without a display.
+"""
+
+import argparse, json, logging, sys, time
+import ds_messenger
+import ds_metrics
+from ds_worker import PollScheduler
+from profile import Profile
+
+log = logging.getLogger(__name__)
+
+# Messages sent in one pipelined batch, and saved to the DSU file together
+SEND_BATCH_SIZE = 500
+
+class HeadlessClient:
+    """
+    Sends and receives the messages of one DSU profile on the calling thread, keeping the DSU file
+    up to date. Only the header of the profile is read on open; its message history is not needed
+    to send or receive.
+    """
+    def __init__(self, path, dsuserver=None):
+        self.path = path
+        self.profile = Profile()
+        self.profile.load_profile(path, recent=0)
+        if dsuserver is not None:
+            self.profile.dsuserver = dsuserver
+
+    def close(self) -> None:
+        '''
+        Saves the profile and closes its session with the server.
+        '''
+        self.profile.save_profile(self.path)
+        self.profile.close()
+
+    def send_many(self, outbox, batch_size=SEND_BATCH_SIZE):
+        '''
+        Sends every (message, recipient) pair of an iterable, batch_size messages at a time, each batch
+        pipelined over the profile's session and saved to the DSU file once it is answered.
+        Messages left in the profile's outbox by an earlier run are sent first.
+        Yields a (message, recipient, sent) tuple for each message, in order. Once the server stops
+        answering, the remaining messages are only queued in the saved outbox, to be sent by a later
+        send or receive, and are yielded as not sent.
+        '''
+        queued = 0
+        offline = False
+        for message, recipient in outbox:
+            self.profile.queue_msg(message, recipient)
+            if offline:
+                yield message, recipient, False
+                continue
+            queued += 1
+            if queued >= batch_size:
+                yield from self._flush()
+                queued = 0
+                offline = bool(self.profile.pending_outbox())
+        if queued:
+            yield from self._flush()
+        elif offline:
+            self._save()
+
+    def _flush(self) -> list:
+        """
+        Sends the profile's outbox and saves the messages that were accepted.
+        """
+        report = self.profile.flush_outbox()
+        self._save()
+        return report
+
+    def _save(self) -> None:
+        """
+        Saves the profile, then drops the messages the save archived from memory.
+        """
+        self.profile.save_profile(self.path)
+        self.profile.release_archived()
+
+    def receive(self) -> list:
+        '''
+        Retrieves the new messages from the server and stores them in the profile. If the server answers
+        and messages are waiting in the profile's outbox, they are sent too.
+        Returns the list of DirectMessages, or None if the retrieve failed.
+        '''
+        newmsg_list = self.profile.new_msg()
+        if newmsg_list:
+            self._save()
+        if newmsg_list is not None and self.profile.pending_outbox():
+            self._flush()
+        return newmsg_list
+
+    def listen(self, scheduler=None):
+        '''
+        Polls the server for new messages forever, yielding the list of DirectMessages each poll returns,
+        if it returns any. The delay between polls is chosen by scheduler, a PollScheduler by default.
+        '''
+        scheduler = scheduler or PollScheduler()
+        while True:
+            newmsg_list = self.receive()
+            scheduler.result(newmsg_list is not None, len(newmsg_list or ()))
+            if newmsg_list:
+                yield newmsg_list
+            time.sleep(scheduler.next_delay())
+
+
+def read_outbox(lines, recipient=None):
+    """
+    Yields (message, recipient) pairs from lines of text. With a recipient, each line is a message to
+    them; otherwise each line is a JSON object with "recipient" and "message" keys. Blank lines are skipped.
+    """
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        if recipient is not None:
+            yield line, recipient
+        else:
+            obj = json.loads(line)
+            yield obj['message'], obj['recipient']
+
+
+def main(argv=None) -> int:
+    """
+    Runs the command line entry point. Returns the exit status: 1 if any message failed to send.
+    """
+    parser = argparse.ArgumentParser(description="Send and receive the messages of a DSU profile without the GUI.")
+    parser.add_argument('profile', help="path of the .dsu file")
+    parser.add_argument('--server', help="host:port of the DSU server, overriding the profile's server and DSU_SERVER_PORT")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--retain', type=int, help="messages of each contact to keep in the DSU file; older "
+                                                   "ones are moved to its archive")
+    commands = parser.add_subparsers(dest='command', required=True)
+    send = commands.add_parser('send', help="send messages read from a file or standard input")
+    send.add_argument('--to', help="send every line to this recipient; otherwise each line is a JSON object "
+                                   "with recipient and message keys")
+    send.add_argument('--file', help="read messages from this file instead of standard input")
+    send.add_argument('--batch', type=int, default=SEND_BATCH_SIZE, help="messages per pipelined batch")
+    listen = commands.add_parser('listen', help="write incoming messages to standard output as JSON lines")
+    listen.add_argument('--once', action='store_true', help="retrieve new messages once and exit")
+    args = parser.parse_args(argv)
+
+    ds_metrics.configure_logging(args.log_level.upper())
+    host = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        ds_messenger.DSU_SERVER_PORT = int(port)
+    client = HeadlessClient(args.profile, host)
+    if args.retain is not None:
+        client.profile.set_retention(args.retain)
+    failed = 0
+    try:
+        if args.command == 'send':
+            source = open(args.file) if args.file else sys.stdin
+            try:
+                for message, recipient, sent in client.send_many(read_outbox(source, args.to), args.batch):
+                    if not sent:
+                        failed += 1
+                        log.error("Message not sent.", extra={'op': 'send', 'recipient': recipient})
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+        else:
+            polls = [client.receive() or []] if args.once else client.listen()
+            for newmsg_list in polls:
+                for dm in newmsg_list:
+                    sys.stdout.write(json.dumps({'from': dm.recipient, 'message': dm.message,
+                                                 'timestamp': dm.timestamp}) + '\n')
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,107 +3,400 @@ ds_messenger.py
 Defines the DirectMessage and DirectMessenger classes
 """
 
-import socket
+import logging, select, socket, threading, time
 import ds_protocol
+from ds_metrics import metrics
+
+log = logging.getLogger(__name__)
 
 # Replace with valid DSU server port
 DSU_SERVER_PORT = 0
 
+# Characters read at a time, and DirectMessages handed out at a time, when streaming retrieve_all
+STREAM_CHUNK_SIZE = 65536
+STREAM_BATCH_SIZE = 500
+
+# Seconds to wait for the server to accept a connection, and for each read of a reply
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 15.0
+
+# Failures in a row after which the circuit breaker stops connecting, and the backoff it then waits,
+# doubling after each failed trial up to the maximum
+BREAKER_THRESHOLD = 3
+BREAKER_BASE_DELAY = 1.0
+BREAKER_MAX_DELAY = 60.0
+
+
+class ServerUnavailable(ConnectionError):
+    """
+    Raised instead of connecting while the circuit breaker is open.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Counts failed connections and reads in a row. Once threshold failures have happened, the breaker
+    opens and connections are refused for base_delay seconds; the next attempt after that is a trial,
+    which closes the breaker if it succeeds or opens it again for twice as long, up to max_delay.
+    A dead server is then tried a few times a minute instead of on every command, and commands fail
+    at once instead of waiting out the connect timeout. Safe to share between threads.
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD, base_delay=BREAKER_BASE_DELAY, max_delay=BREAKER_MAX_DELAY):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        '''
+        True while connections are refused.
+        '''
+        return self.failures >= self.threshold and time.monotonic() < self._open_until
+
+    def retry_in(self) -> float:
+        '''
+        Returns the seconds until the breaker lets a trial connection through, or 0 if it is closed.
+        '''
+        if self.failures < self.threshold:
+            return 0.0
+        return max(self._open_until - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        '''
+        Returns true if a connection may be attempted.
+        '''
+        return not self.is_open
+
+    def success(self) -> None:
+        '''
+        Records that the server answered, closing the breaker.
+        '''
+        with self._lock:
+            self.failures = 0
+
+    def failure(self) -> None:
+        '''
+        Records a failed connection or read, opening the breaker once threshold failures have happened in a row.
+        '''
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                delay = min(self.base_delay * 2 ** (self.failures - self.threshold), self.max_delay)
+                self._open_until = time.monotonic() + delay
+                metrics.count('net.breaker_open')
+
+
 class DirectMessage:
+    __slots__ = ('recipient', 'message', 'timestamp', 'sent')
+
     def __init__(self):
         """
-        Creates the following data attributes: recipient, message, and timestamp.
+        Creates the following data attributes: recipient, message, timestamp, and sent.
+        For a message the user received, recipient holds the user it came from and sent is false.
         """
         self.recipient = None
         self.message = None
         self.timestamp = None
+        self.sent = False
 
 
 class DirectMessenger:
-    def __init__(self, dsuserver=None, username=None, password=None):
+    def __init__(self, dsuserver=None, username=None, password=None, token=None,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, breaker=None):
         """
-        Creates the following data attributes: token, dsuserver, port, username, password, dm_obj.
-        Populates token attribute to token returned from server upon joining.
+        Creates the following data attributes: token, dsuserver, port, username, password, dm_obj, answered.
+        The session's own Codec encodes commands with its token, so messengers never share state.
+        Given the token of an earlier join, uses it and connects on the first command; otherwise opens
+        a session with the server and populates token attribute to token returned upon joining.
+        The session connection is kept open and reused by every later command. The server is only
+        joined again if it rejects the token.
+        Connecting gives up after connect_timeout seconds and each read after read_timeout seconds.
+        breaker is the CircuitBreaker guarding connections, which may be shared by the sessions of one
+        server; a new one is made if none is given.
         """
         self.token = None
         self.dsuserver = dsuserver
         self.port = DSU_SERVER_PORT
         self.username = username
         self.password = password
-        self.token = self._join_serv()
         self.dm_obj = None
+        self.answered = 0
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._codec = ds_protocol.Codec(token)
+        self._soc = None
+        self._send = None
+        self._recv = None
+        if token is not None:
+            self.token = token
+        else:
+            self.token = self._join_serv()
 
-    def _publish(self, soc, msg_type):
+    def _connect(self):
         """
-        Sends information to the server, and returns the response the server gives.
+        Opens the session connection to the server along with its buffered writer and reader.
+        Raises ServerUnavailable without connecting while the circuit breaker is open.
         """
-        send = soc.makefile('w')
-        recv = soc.makefile('r')
-        send.write(msg_type + '\r\n')
-        send.flush()
-        resp = recv.readline()
+        if not self.breaker.allow():
+            raise ServerUnavailable(f"Server unavailable, retrying in {self.breaker.retry_in():.0f}s.")
+        try:
+            with metrics.timer('net.connect'):
+                soc = socket.create_connection((self.dsuserver, self.port), timeout=self.connect_timeout)
+        except OSError:
+            self.breaker.failure()
+            raise
+        metrics.count('net.connections')
+        soc.settimeout(self.read_timeout)
+        soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._soc = soc
+        self._send = soc.makefile('w')
+        self._recv = soc.makefile('r')
+
+    def close(self):
+        """
+        Closes the session connection. The next command reconnects and re-joins.
+        """
+        for f in (self._send, self._recv, self._soc):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self._soc = None
+        self._send = None
+        self._recv = None
+
+    def _exchange(self, msg_type):
+        """
+        Writes a single command on the session connection and returns the response line.
+        Raises ConnectionError if the server has closed the connection.
+        """
+        self._send.write(msg_type + '\r\n')
+        self._send.flush()
+        resp = self._readline()
+        if not resp:
+            raise ConnectionError("Connection closed by server.")
         return resp
 
+    def _readline(self, size=-1):
+        """
+        Reads a line, or up to size characters of one, from the session connection, recording the
+        outcome with the circuit breaker. Raises TimeoutError if the server does not answer in time.
+        """
+        try:
+            resp = self._recv.readline(size)
+        except TimeoutError:
+            self.breaker.failure()
+            metrics.count('net.timeouts')
+            raise
+        if resp:
+            self.breaker.success()
+        return resp
+
+    def _publish(self, build):
+        """
+        Sends information to the server, and returns the response the server gives, decoded to a DataTuple.
+        build is called to encode the command so it always carries the current token. If the
+        session connection drops before the command is written, reconnects and sends it once more,
+        unless the server timed out or the circuit breaker is open. Once the command is written it is
+        not sent again, as the server may have acted on it; the error is raised instead. If the server
+        rejects the token, re-joins and sends the command once more.
+        """
+        dropped = rejoined = False
+        while True:
+            written = False
+            try:
+                self._ensure_session()
+                cmd = build()
+                written = True
+                with metrics.timer('net.round_trip'):
+                    resp = self._exchange(cmd)
+            except OSError as ex:
+                self.close()
+                metrics.count('net.dropped')
+                if written or dropped or _unreachable(ex):
+                    raise
+                dropped = True
+                continue
+            rt = self._codec.extract_response(resp)
+            if rejoined or not _token_rejected(rt):
+                return rt
+            rejoined = True
+            self._rejoin()
+
+    def _ensure_session(self):
+        """
+        Reconnects if the session connection is closed, or was closed by the server while idle, joining
+        only if there is no token to reuse. Raises ConnectionError if the server cannot be joined.
+        """
+        if self._soc is not None and _closed_by_peer(self._soc):
+            metrics.count('net.dropped')
+            self.close()
+        if self._soc is None:
+            if self.token is not None:
+                self._connect()
+                return
+            self.token = self._join_serv()
+            if self.token is None:
+                raise ConnectionError("Unable to join the server.")
+
+    def _rejoin(self):
+        """
+        Drops the token the server rejected and joins again on a fresh session connection.
+        Raises ConnectionError if the server cannot be joined.
+        """
+        metrics.count('net.token_rejected')
+        self.close()
+        self.token = None
+        self._ensure_session()
+
     def _join_serv(self):
         """
-        Joins the server and returns token generated from response message.
+        Joins the server on a fresh session connection and returns token generated from response message.
         """
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
-                soc.connect((self.dsuserver, self.port))
-                join_msg = ds_protocol.join(self.username, self.password)
-                resp = self._publish(soc, join_msg)
-                rt = ds_protocol.extract_json(resp)
-                if rt[0] == "error":
-                    print(rt[1])
-                else:
-                    return ds_protocol.token
+            self.close()
+            self._connect()
+            self._codec.token = None
+            join_msg = self._codec.join(self.username, self.password)
+            with metrics.timer('net.join'):
+                resp = self._exchange(join_msg)
+            rt = self._codec.extract_json(resp)
+            if rt[0] == "error":
+                log.error(rt[1], extra={'op': 'join'})
+                self.close()
+            else:
+                return self._codec.token
         except OSError:
-            print("ERROR: Host is unreachable. Check WiFi, IP address, and port.")
-        except (ConnectionRefusedError, OverflowError, TimeoutError, socket.gaierror, TypeError):
-            print("ERROR: IP address or port is invalid.")
-        except Exception as r_error:
-            print(rt[1])
-                
-            
+            self.close()
+            log.error("Host is unreachable. Check WiFi, IP address, and port.", extra={'op': 'join', 'host': self.dsuserver, 'port': self.port})
+        except (OverflowError, TypeError):
+            self.close()
+            log.error("IP address or port is invalid.", extra={'op': 'join', 'host': self.dsuserver, 'port': self.port})
+
     def send(self, message:str, recipient:str) -> bool:
         """
         Sends a direct message to another user and populates a DirectMessage object.
         Returns true if message successfully sent, false if send failed.
         """
+        self.dm_obj = None
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
-                soc.connect((self.dsuserver, self.port))
-                dir_msg = ds_protocol.direct_message(message, recipient)
-                resp = self._publish(soc, dir_msg)
-                rt = ds_protocol.extract_json(resp)
-                if rt[0] == "error":
-                    print(rt[1])
-                    raise Exception(r_error)
-                else:
-                    dm = DirectMessage()
-                    dm.recipient = recipient
-                    dm.message = message
-                    dm.timestamp = ds_protocol.timestamp
-                    self.dm_obj = dm
-                    return True
+            timestamp = time.time()
+            rt = self._publish(lambda: self._codec.direct_message(message, recipient, timestamp)[0])
+            if rt.type == "error":
+                log.error(rt[1], extra={'op': 'send'})
+                return False
+            self.dm_obj = self._make_dm(message, recipient, timestamp)
+            return True
         except OSError:
-            print("ERROR: Host is unreachable. Check WiFi, IP address, and port.")
+            log.error("Host is unreachable. Check WiFi, IP address, and port.", extra={'op': 'send', 'host': self.dsuserver, 'port': self.port})
             return False
-        except (ConnectionRefusedError, OverflowError, TimeoutError, socket.gaierror, TypeError):
-            print("ERROR: IP address or port is invalid.")
+        except (OverflowError, TypeError):
+            log.error("IP address or port is invalid.", extra={'op': 'send', 'host': self.dsuserver, 'port': self.port})
             return False
-        except Exception as r_error:
-            print(rt[1])
-            return False
-            
+
+    def send_batch(self, outbox) -> list:
+        """
+        Sends many direct messages at once. outbox is a list of (message, recipient) pairs.
+        Every command is written back-to-back on the session connection before any reply is read,
+        and the replies are matched to the messages in order. If the connection drops once the batch
+        is written, the messages without a reply are not sent again, as the server may have stored
+        them; they are left unanswered for the caller to send again deliberately. If the server rejects
+        the token, the messages without a reply are sent once more after re-joining. A reply that cannot
+        be read closes the session like a dropped connection, leaving it and the rest unanswered.
+        Returns a list holding a DirectMessage for each message the server accepted, or None for each that failed.
+        The answered attribute is set to the number of messages, from the start of outbox, the server
+        replied to; the rest were not delivered and may be sent again.
+        """
+        self.answered = 0
+        results = [None] * len(outbox)
+        # Microsecond steps keep the batch in order and give repeated messages distinct timestamps
+        now = time.time()
+        timestamps = [now + i * 1e-6 for i in range(len(outbox))]
+        done = 0
+        dropped = rejoined = False
+        while True:
+            written = False
+            try:
+                self._ensure_session()
+                t = time.perf_counter()
+                cmds = (self._codec.direct_message(msg, recipient, timestamps[i])[0]
+                        for i, (msg, recipient) in enumerate(outbox[done:], done))
+                written = True
+                self._send.write(ds_protocol.encode_batch(cmds))
+                self._send.flush()
+                while done < len(outbox):
+                    resp = self._readline()
+                    if not resp:
+                        raise ConnectionError("Connection closed by server.")
+                    try:
+                        rt = self._codec.extract_json(resp)
+                    except (KeyError, TypeError, AttributeError) as ex:
+                        raise ValueError(f"Reply has no {ex}.") from ex
+                    if rt is ds_protocol.UNDECODABLE:
+                        raise ValueError(rt[1])
+                    if rt[0] == "error":
+                        if not rejoined and _token_rejected(rt):
+                            # The rest of the batch carried the same token; it is sent again on the new session
+                            rejoined = True
+                            self._rejoin()
+                            break
+                        log.error(rt[1], extra={'op': 'send_batch'})
+                    else:
+                        results[done] = self._make_dm(outbox[done][0], outbox[done][1], timestamps[done])
+                    done += 1
+                    self.answered = done
+                else:
+                    metrics.record('net.batch_round_trip', time.perf_counter() - t)
+                    break
+            except OSError as ex:
+                self.close()
+                metrics.count('net.dropped')
+                if written:
+                    log.error("Connection lost before the server answered.", extra={'op': 'send_batch', 'unanswered': len(outbox) - done})
+                    break
+                if dropped or _unreachable(ex):
+                    log.error("Host is unreachable. Check WiFi, IP address, and port.", extra={'op': 'send_batch', 'host': self.dsuserver, 'port': self.port})
+                    break
+                dropped = True
+            except ValueError as ex:
+                # The replies after one that cannot be read cannot be matched to their messages either
+                self.close()
+                log.error("Unexpected response from server.", extra={'op': 'send_batch', 'error': str(ex), 'unanswered': len(outbox) - done})
+                break
+            except (OverflowError, TypeError):
+                log.error("IP address or port is invalid.", extra={'op': 'send_batch', 'host': self.dsuserver, 'port': self.port})
+                break
+        return results
+
+    def _make_dm(self, message, recipient, timestamp):
+        """
+        Returns a DirectMessage for a message sent to recipient.
+        """
+        dm = DirectMessage()
+        dm.recipient = recipient
+        dm.message = message
+        dm.timestamp = timestamp
+        dm.sent = True
+        return dm
 
     def _populate(self, msg_dict, dm_obj):
         """
         Populates the data attributes of DirectMessage with data from each message dictionary.
+        Message dictionaries without a 'from' key are messages the user sent, as returned by retrieve all.
         Returns the newly populated DirectMessage obj.
         """
-        dm_obj.recipient = msg_dict['from']
+        if 'from' in msg_dict:
+            dm_obj.recipient = msg_dict['from']
+        else:
+            dm_obj.recipient = msg_dict['recipient']
+            dm_obj.sent = True
         dm_obj.message = msg_dict['message']
         dm_obj.timestamp = msg_dict['timestamp']
         return dm_obj
@@ -115,43 +408,122 @@ class DirectMessenger:
         """
         try:
             newmsg_list = []
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
-                soc.connect((self.dsuserver, self.port))
-                new_msg = ds_protocol.new_message()
-                resp = self._publish(soc, new_msg)
-                rt = ds_protocol.extract_messages(resp)
+            rt = self._publish(self._codec.new_message)
+            if rt.type == "error":
+                log.error(rt.message, extra={'op': 'retrieve_new'})
+                return None
             for msg_dict in rt.message:
                 dm = DirectMessage()
                 dm = self._populate(msg_dict, dm)
                 newmsg_list.append(dm)
             return newmsg_list
         except OSError:
-            print("ERROR: Host is unreachable. Check WiFi, IP address, and port.")
-        except (ConnectionRefusedError, OverflowError, TimeoutError, socket.gaierror, TypeError):
-            print("ERROR: IP address or port is invalid.")
-        except Exception as r_error:
-            print(rt[1])
-    
+            log.error("Host is unreachable. Check WiFi, IP address, and port.", extra={'op': 'retrieve_new', 'host': self.dsuserver, 'port': self.port})
+        except (OverflowError, TypeError):
+            log.error("IP address or port is invalid.", extra={'op': 'retrieve_new', 'host': self.dsuserver, 'port': self.port})
+        except KeyError:
+            log.error("Unexpected response from server.", extra={'op': 'retrieve_new'})
+
     def retrieve_all(self) -> list:
         """
         Retrieves all messages from DS server.
         Returns a list of DirectMessage objects containing all messages.
         """
+        self.allmsg_list = []
+        for batch in self.iter_all_batches(STREAM_BATCH_SIZE):
+            if batch is None:
+                return None
+            self.allmsg_list.extend(batch)
+        return self.allmsg_list
+
+    def iter_all(self):
+        """
+        Retrieves all messages from DS server, yielding a DirectMessage for each one as it is decoded.
+        The response is read in STREAM_CHUNK_SIZE pieces, so memory use does not grow with the history.
+        If the retrieve fails, logs the error and yields None as the last item.
+        """
+        finished = False
         try:
-            self.allmsg_list = []
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
-                soc.connect((self.dsuserver, self.port))
-                all_msg = ds_protocol.all_message()
-                resp = self._publish(soc, all_msg)
-                rt = ds_protocol.extract_messages(resp)
-            for msg_dict in rt.message:
-                dm = DirectMessage()
-                dm = self._populate(msg_dict, dm)
-                self.allmsg_list.append(dm)
-            return self.allmsg_list
+            self._ensure_session()
+            t = time.perf_counter()
+            for msg_dict in self._stream_all():
+                yield self._populate(msg_dict, DirectMessage())
+            finished = True
+            metrics.record('net.retrieve_all', time.perf_counter() - t)
         except OSError:
-            print("ERROR: Host is unreachable. Check WiFi, IP address, and port.")
-        except (ConnectionRefusedError, OverflowError, TimeoutError, socket.gaierror, TypeError):
-            print("ERROR: IP address or port is invalid.")
-        except Exception as r_error:
-            print(rt[1])
+            log.error("Host is unreachable. Check WiFi, IP address, and port.", extra={'op': 'retrieve_all', 'host': self.dsuserver, 'port': self.port})
+            yield None
+        except (OverflowError, TypeError):
+            log.error("IP address or port is invalid.", extra={'op': 'retrieve_all', 'host': self.dsuserver, 'port': self.port})
+            yield None
+        except (KeyError, ValueError) as ex:
+            log.error("Unexpected response from server.", extra={'op': 'retrieve_all', 'error': str(ex)})
+            yield None
+        finally:
+            # A response left part-read would be taken as the reply to the next command
+            if not finished:
+                self.close()
+
+    def _stream_all(self):
+        """
+        Sends the retrieve all command and yields each message dictionary of the response as it is decoded.
+        If the server rejects the token, re-joins and sends the command once more.
+        """
+        for rejoined in (False, True):
+            self._send.write(self._codec.all_message() + '\r\n')
+            self._send.flush()
+            try:
+                yield from ds_protocol.iter_messages(lambda: self._readline(STREAM_CHUNK_SIZE))
+                return
+            except ValueError as ex:
+                # An error response is decoded before any message is yielded, so the command can be sent again
+                if rejoined or not _token_rejected(ds_protocol.DataTuple('error', str(ex))):
+                    raise
+            self._rejoin()
+
+    def iter_all_batches(self, batch_size=None):
+        """
+        Retrieves all messages from DS server, yielding them as lists of at most batch_size DirectMessages.
+        If the retrieve fails, yields None as the last item.
+        """
+        batch_size = batch_size or STREAM_BATCH_SIZE
+        batch = []
+        for dm in self.iter_all():
+            if dm is None:
+                if batch:
+                    yield batch
+                yield None
+                return
+            batch.append(dm)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def _token_rejected(rt) -> bool:
+    """
+    Returns true if a decoded response is the server rejecting the session's token.
+    """
+    return rt.type == 'error' and 'token' in str(rt.message).lower()
+
+
+def _closed_by_peer(soc) -> bool:
+    """
+    Returns true if an idle session connection can no longer be used. Every reply has been read while
+    it is idle, so if the socket is readable the server has closed it, or sent something unasked.
+    """
+    try:
+        readable, _, _ = select.select([soc], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def _unreachable(ex) -> bool:
+    """
+    Returns true if a connection error means the server is not answering, so a command should not be
+    sent again at once: it timed out, or the circuit breaker is open.
+    """
+    return isinstance(ex, (TimeoutError, ServerUnavailable))
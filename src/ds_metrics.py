@@ -0,0 +1,189 @@
+"""
+ds_metrics.py
+Defines the Histogram and Metrics classes, which keep rolling latency histograms and counters for the
+hot paths of the client, and the JsonFormatter class used for structured logging
+"""
+
+import json, logging, threading, time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds in milliseconds of the histogram buckets; the last bucket holds anything slower
+BUCKET_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Most recent samples of each stage kept for percentiles
+HISTOGRAM_WINDOW = 1024
+
+def percentile(samples, pct) -> float:
+    """
+    Returns the pct percentile of a list of samples, using the nearest-rank method.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Histogram:
+    """
+    Latency histogram of one stage. Bucket counts, the total and the maximum cover every sample since
+    the histogram was created; percentiles cover the last HISTOGRAM_WINDOW samples, so they follow
+    changes in latency instead of being dominated by old samples.
+    """
+    def __init__(self, window=HISTOGRAM_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.recent = deque(maxlen=window)
+
+    def record(self, seconds) -> None:
+        '''
+        Adds a sample, in seconds.
+        '''
+        ms = seconds * 1000
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.recent.append(ms)
+
+    def snapshot(self) -> dict:
+        '''
+        Returns the count and the latency statistics in milliseconds, with the count of each bucket
+        keyed by its upper bound.
+        '''
+        recent = list(self.recent)
+        bounds = [str(bound) for bound in BUCKET_BOUNDS_MS] + ['inf']
+        return {'count': self.count,
+                'mean_ms': self.total / self.count if self.count else 0.0,
+                'p50_ms': percentile(recent, 50),
+                'p90_ms': percentile(recent, 90),
+                'p99_ms': percentile(recent, 99),
+                'max_ms': self.max,
+                'buckets': {bound: n for bound, n in zip(bounds, self.buckets) if n}
+                }
+
+
+class Metrics:
+    """
+    Named latency histograms and counters, safe to record from any thread.
+    Stage names are dotted by layer, e.g. 'net.connect', 'net.round_trip', 'profile.save' or 'ui.render',
+    so that time spent waiting on the server can be told apart from time spent in the client.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._started = time.time()
+
+    def record(self, name, seconds) -> None:
+        '''
+        Adds a latency sample, in seconds, to the histogram of a stage.
+        '''
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(seconds)
+
+    def count(self, name, n=1) -> None:
+        '''
+        Adds n to a counter.
+        '''
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, name):
+        '''
+        Times the body of a with statement as a sample of a stage. If the body raises, the sample is
+        still recorded and the stage's error counter is incremented.
+        '''
+        t = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.count(name + '.errors')
+            raise
+        finally:
+            self.record(name, time.perf_counter() - t)
+
+    def timed(self, name):
+        '''
+        Decorator that times every call of a function as a sample of a stage.
+        '''
+        def decorate(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def snapshot(self) -> dict:
+        '''
+        Returns the statistics of every stage and the value of every counter.
+        '''
+        with self._lock:
+            return {'uptime_s': time.time() - self._started,
+                    'stages': {name: h.snapshot() for name, h in sorted(self._histograms.items())},
+                    'counters': dict(sorted(self._counters.items()))
+                    }
+
+    def export_json(self, path) -> None:
+        '''
+        Writes a snapshot to a JSON file.
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def reset(self) -> None:
+        '''
+        Discards every sample and counter.
+        '''
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+            self._started = time.time()
+
+
+# The metrics every module of the client records to
+metrics = Metrics()
+
+
+# Attributes every LogRecord has; any others were passed through extra and are logged as fields
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each log record as one JSON object per line, with the fields passed through extra,
+    e.g. log.error("Join failed.", extra={'op': 'join', 'reason': reason}).
+    """
+    def format(self, record) -> str:
+        entry = {'time': round(record.created, 3),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'msg': record.getMessage()
+                 }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=logging.INFO, stream=None) -> None:
+    """
+    Sends the client's log records to stream, standard error by default, as JSON lines.
+    """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
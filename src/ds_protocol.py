@@ -3,44 +3,98 @@ ds_protocol.py
 Handles encoding and decoding of JSON messages for the distributed social messenger
 """
 
-import json, time
+import json, logging, time
 from collections import namedtuple
 
+log = logging.getLogger(__name__)
+
 # Namedtuple to hold the values retrieved from json messages
-DataTuple = namedtuple('DataTuple', ['type','message'])
+DataTuple = namedtuple('DataTuple', ['type','message','token'], defaults=[None])
 '''
-DataTuple: {string, string}
+DataTuple: {string, string, string}
+token is only set on responses that carry one, such as the response to a join command
 '''
 
+# The DataTuple returned for a response that is not JSON
+UNDECODABLE = DataTuple('error', "JSON cannot be decoded.")
+
 def extract_json(json_msg:str) -> DataTuple:
   '''
   Calls the json.loads function on a json string (join command) and converts it to a DataTuple object
   '''
   try:
-    json_obj = json.loads(json_msg)
-    type = json_obj['response']['type']
-    message = json_obj['response']['message']
-    if 'token' in str(json_obj):
-      # Globally set token to use for other commands
-      global token
-      token = json_obj['response']['token'] 
+    response = json.loads(json_msg)['response']
+    return DataTuple(response['type'], response['message'], response.get('token'))
   except json.JSONDecodeError:
-    print("JSON cannot be decoded.")
-  return DataTuple(type, message)
+    log.error("JSON cannot be decoded.", extra={'op': 'decode'})
+    return UNDECODABLE
 
 def extract_messages(json_msg:str) -> DataTuple:
   '''
   Calls the json.loads function on a json string (direct message command) and converts it to a DataTuple object
   '''
   try:
-    json_obj = json.loads(json_msg)
-    type = json_obj['response']['type']
-    message = json_obj['response']['messages']
+    response = json.loads(json_msg)['response']
+    return DataTuple(response['type'], response['messages'])
+  except json.JSONDecodeError:
+    log.error("JSON cannot be decoded.", extra={'op': 'decode'})
+    return UNDECODABLE
+
+def extract_response(json_msg:str) -> DataTuple:
+  '''
+  Calls the json.loads function on a json string (response to any command) and converts it to a DataTuple object
+  message holds the messages list of a retrieve response, and the server's message otherwise
+  '''
+  try:
+    response = json.loads(json_msg)['response']
+    message = response['messages'] if 'messages' in response else response.get('message')
+    return DataTuple(response['type'], message, response.get('token'))
   except json.JSONDecodeError:
-    print("JSON cannot be decoded.")
-  return DataTuple(type, message)
+    log.error("JSON cannot be decoded.", extra={'op': 'decode'})
+    return UNDECODABLE
+
+
+def iter_messages(read_chunk):
+  '''
+  Decodes the messages array of a direct message retrieve response one message at a time, yielding
+  each message dictionary. read_chunk is called with no arguments for the next piece of the response
+  line, so only one piece and one message are held in memory at once. Stops at the end of the line.
+  Raises ValueError with the server's message if the response is an error, or if it cannot be decoded.
+  '''
+  decoder = json.JSONDecoder()
+  buf = ''
+  while True:
+    chunk = read_chunk()
+    buf += chunk
+    key = buf.find('"messages"')
+    start = buf.find('[', key) if key >= 0 else -1
+    if start >= 0:
+      buf = buf[start + 1:]
+      break
+    if not chunk or buf.endswith('\n'):
+      # The whole line arrived without a messages array, so it is an error response
+      raise ValueError(extract_json(buf).message)
+  while True:
+    buf = buf.lstrip(' \t\r\n,')
+    if buf.startswith(']'):
+      # Read the rest of the response line so the connection is ready for the next command
+      while not buf.endswith('\n'):
+        buf = read_chunk()
+        if not buf:
+          return
+      return
+    try:
+      msg, end = decoder.raw_decode(buf)
+    except json.JSONDecodeError:
+      chunk = '' if '\n' in buf else read_chunk()
+      if not chunk:
+        raise ValueError("JSON cannot be decoded.")
+      buf += chunk
+      continue
+    yield msg
+    buf = buf[end:]
+
 
-  
 def join(username, password):
   '''
   Wraps join command in JSON format
@@ -51,22 +105,22 @@ def join(username, password):
                        }}
   return json.dumps(join_msg)
 
-def direct_message(msg, o_user):
+def direct_message(msg, o_user, token, timestamp=None):
   '''
   Wraps direct message send command in JSON format
+  Returns the JSON string and the timestamp it carries
   '''
+  if timestamp is None:
+    timestamp = time.time()
   dir_msg = {"token": token,
              "directmessage": {"entry": msg,
                                "recipient": o_user,
-                               "timestamp": time.time()
+                               "timestamp": timestamp
                                }}
-  # Globally sets the timestamp to store for data in Direct Message class
-  global timestamp
-  timestamp = dir_msg['directmessage']['timestamp'] 
-  return json.dumps(dir_msg)
+  return json.dumps(dir_msg), timestamp
+
 
- 
-def new_message():
+def new_message(token):
   '''
   Wraps direct message retrieve new command in JSON format
   '''
@@ -75,7 +129,7 @@ def new_message():
              }
   return json.dumps(new_msg)
 
-def all_message():
+def all_message(token):
   '''
   Wraps direct message retrieve all command in JSON format
   '''
@@ -83,3 +137,67 @@ def all_message():
              "directmessage": "all"
              }
   return json.dumps(all_msg)
+
+def encode_batch(commands) -> str:
+  '''
+  Joins several JSON commands into one buffer, each terminated as the server expects
+  '''
+  return ''.join(cmd + '\r\n' for cmd in commands)
+
+
+class Codec:
+  '''
+  Encodes and decodes commands for one session with the server. Each Codec carries its own token,
+  so several sessions can run in one process, or on several threads, without sharing state.
+  '''
+  def __init__(self, token=None):
+    self.token = token
+
+  def extract_json(self, json_msg:str) -> DataTuple:
+    '''
+    Decodes a response, keeping the token if the response carries one
+    '''
+    rt = extract_json(json_msg)
+    if rt.token is not None:
+      self.token = rt.token
+    return rt
+
+  def extract_messages(self, json_msg:str) -> DataTuple:
+    '''
+    Decodes a response to a retrieve command
+    '''
+    return extract_messages(json_msg)
+
+  def extract_response(self, json_msg:str) -> DataTuple:
+    '''
+    Decodes the response to any command, keeping the token if the response carries one
+    '''
+    rt = extract_response(json_msg)
+    if rt.token is not None:
+      self.token = rt.token
+    return rt
+
+  def join(self, username, password):
+    '''
+    Wraps join command in JSON format
+    '''
+    return join(username, password)
+
+  def direct_message(self, msg, o_user, timestamp=None):
+    '''
+    Wraps direct message send command in JSON format
+    Returns the JSON string and the timestamp it carries
+    '''
+    return direct_message(msg, o_user, self.token, timestamp)
+
+  def new_message(self):
+    '''
+    Wraps direct message retrieve new command in JSON format
+    '''
+    return new_message(self.token)
+
+  def all_message(self):
+    '''
+    Wraps direct message retrieve all command in JSON format
+    '''
+    return all_message(self.token)
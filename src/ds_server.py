@@ -0,0 +1,186 @@
+"""
+ds_server.py
+Defines the DsuServer class, a local stand-in for the DSU server used for testing and benchmarks
+"""
+
+import argparse, asyncio, json, random, threading, uuid
+
+class DsuServer:
+    """
+    Speaks the DSU server's line-delimited JSON protocol: join, and directmessage send, new and all.
+    Users are created on their first join. Every command can be delayed by latency seconds, answered
+    with an error response with probability error_rate, or have its connection dropped with
+    probability drop_rate.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, drop_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.connections = 0
+        self.commands = 0
+        self._random = random.Random(seed)
+        self._users = {}    # username -> password
+        self._tokens = {}   # token -> username
+        self._inbox = {}    # username -> messages received, as response dictionaries
+        self._unread = {}   # username -> index of the first unread message in the inbox
+        self._sent = {}     # username -> messages sent, as response dictionaries
+        self._server = None
+        self._handlers = set()  # tasks answering open connections
+        self._loop = None
+        self._thread = None
+
+    async def start(self) -> int:
+        """
+        Starts listening on the current event loop and returns the port.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self) -> None:
+        """
+        Stops listening, ends every open connection and waits for the server to close.
+        """
+        self._server.close()
+        for task in list(self._handlers):
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start_in_thread(self) -> int:
+        """
+        Runs the server on its own event loop in a daemon thread and returns the port.
+        """
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='ds-server', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.port
+
+    def stop(self) -> None:
+        """
+        Stops a server started with start_in_thread. Stopping it again does nothing.
+        """
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._thread = None
+
+    async def _handle(self, reader, writer):
+        """
+        Answers commands on one connection, one response line per command line.
+        """
+        self.connections += 1
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.commands += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if self.drop_rate and self._random.random() < self.drop_rate:
+                    break
+                if self.error_rate and self._random.random() < self.error_rate:
+                    resp = _error("Injected error.")
+                else:
+                    resp = self._respond(line)
+                writer.write(json.dumps(resp).encode() + b'\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    def _respond(self, line) -> dict:
+        """
+        Returns the response dictionary for one command line.
+        """
+        try:
+            cmd = json.loads(line)
+        except ValueError:
+            return _error("Invalid JSON.")
+        if 'join' in cmd:
+            return self._join(cmd['join'])
+        username = self._tokens.get(cmd.get('token'))
+        if username is None:
+            return _error("Invalid token.")
+        dm = cmd.get('directmessage')
+        if dm == 'new':
+            inbox = self._inbox[username]
+            start = self._unread[username]
+            self._unread[username] = len(inbox)
+            return {"response": {"type": "ok", "messages": inbox[start:]}}
+        if dm == 'all':
+            return {"response": {"type": "ok", "messages": self._inbox[username] + self._sent[username]}}
+        if isinstance(dm, dict):
+            recipient = dm.get('recipient')
+            if recipient not in self._users:
+                return _error("Recipient does not exist.")
+            self._inbox[recipient].append({"message": dm.get('entry'), "from": username, "timestamp": str(dm.get('timestamp'))})
+            self._sent[username].append({"message": dm.get('entry'), "recipient": recipient, "timestamp": str(dm.get('timestamp'))})
+            return {"response": {"type": "ok", "message": "Direct message sent"}}
+        return _error("Unknown command.")
+
+    def _join(self, join) -> dict:
+        """
+        Joins a user, creating the account on its first join.
+        """
+        username = join.get('username')
+        password = join.get('password')
+        if not username or not password:
+            return _error("Username and password are required.")
+        if username not in self._users:
+            self._users[username] = password
+            self._inbox[username] = []
+            self._unread[username] = 0
+            self._sent[username] = []
+        elif self._users[username] != password:
+            return _error("Invalid password.")
+        token = str(uuid.uuid5(uuid.NAMESPACE_OID, username))
+        self._tokens[token] = username
+        return {"response": {"type": "ok", "message": f"Welcome back, {username}", "token": token}}
+
+
+def _error(message) -> dict:
+    """
+    Returns an error response dictionary.
+    """
+    return {"response": {"type": "error", "message": message}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the DSU server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3021)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added before each response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of commands answered with an error")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="fraction of commands that drop the connection")
+    args = parser.parse_args()
+    server = DsuServer(args.host, args.port, args.latency, args.error_rate, args.drop_rate)
+
+    async def serve():
+        port = await server.start()
+        print(f"DSU server stand-in listening on {args.host}:{port}")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
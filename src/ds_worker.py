@@ -0,0 +1,167 @@
+"""
+ds_worker.py
+Defines the NetWorker class, which runs DirectMessenger traffic off the GUI thread,
+and the PollScheduler class, which decides how often it polls for new messages
+"""
+
+import queue, random, threading, time
+from ds_messenger import DirectMessenger, CircuitBreaker
+
+class NetWorker:
+    """
+    Runs server traffic for one user on background threads. Sends and polls each have their own
+    thread and their own DirectMessenger session, so a send can finish while a poll is in flight.
+    The two sessions share one CircuitBreaker, so while the server is down neither waits on it.
+    Results are placed on the results queue as tuples for the GUI thread to drain:
+    ('flush', list of (message, recipient), list of DirectMessage or None, number of messages answered)
+    ('poll', list of DirectMessage or None)
+    ('sync', list of DirectMessage) for each batch of the server's history, as it arrives
+    ('synced', bool) once the history has been retrieved, false if the retrieve failed part way
+    ('token', str) when the server gave a new token, to be stored with the profile
+    ('error', str)
+    Both sessions start from token, the token of an earlier join, if given.
+    """
+    def __init__(self, dsuserver=None, username=None, password=None, token=None):
+        self.dsuserver = dsuserver
+        self.username = username
+        self.password = password
+        self.token = token
+        self.results = queue.Queue()
+        self.breaker = CircuitBreaker()
+        self._poll_pending = threading.Event()
+        self._jobs = {}
+        self._threads = []
+        for lane in ('send', 'poll'):
+            jobs = queue.Queue()
+            thread = threading.Thread(target=self._run, args=(jobs,), name=f'ds-{lane}', daemon=True)
+            self._jobs[lane] = jobs
+            self._threads.append(thread)
+            thread.start()
+
+    def flush(self, outbox) -> None:
+        '''
+        Queues the sending of a list of (message, recipient) pairs, taken from a profile's outbox, as one
+        pipelined batch. The outcome is reported on the results queue, to be applied with Profile.outbox_sent.
+        '''
+        self._jobs['send'].put(('flush', outbox))
+
+    def poll(self) -> bool:
+        '''
+        Queues a retrieve of new messages, unless one is already in flight.
+        Returns true if a poll was queued.
+        '''
+        if self._poll_pending.is_set():
+            return False
+        self._poll_pending.set()
+        self._jobs['poll'].put(('poll',))
+        return True
+
+    def sync(self) -> None:
+        '''
+        Queues a retrieve of every message the server holds for the user, on the poll thread.
+        '''
+        self._jobs['poll'].put(('sync',))
+
+    def get_results(self) -> list:
+        '''
+        Returns every result that is ready without blocking.
+        '''
+        ready = []
+        while True:
+            try:
+                ready.append(self.results.get_nowait())
+            except queue.Empty:
+                return ready
+
+    def stop(self, timeout=None) -> list:
+        '''
+        Asks the worker threads to close their sessions and exit. If timeout is given, waits up to timeout
+        seconds for the send thread to finish the batch it is sending, so that its outcome can still be
+        applied; the poll thread is not waited for. Returns every result that is ready by then.
+        '''
+        for jobs in self._jobs.values():
+            jobs.put(None)
+        if timeout is not None:
+            self._threads[0].join(timeout)
+        return self.get_results()
+
+    def _run(self, jobs):
+        """
+        Thread body: handles jobs from one queue with its own DirectMessenger until stopped.
+        """
+        dmr = None
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            try:
+                if dmr is None:
+                    dmr = DirectMessenger(self.dsuserver, self.username, self.password, self.token,
+                                          breaker=self.breaker)
+                if job[0] == 'flush':
+                    results = dmr.send_batch(job[1])
+                    self.results.put(('flush', job[1], results, dmr.answered))
+                elif job[0] == 'sync':
+                    ok = True
+                    for batch in dmr.iter_all_batches():
+                        if batch is None:
+                            ok = False
+                            break
+                        self.results.put(('sync', batch))
+                    self.results.put(('synced', ok))
+                else:
+                    newmsg_list = dmr.retrieve_new()
+                    self._poll_pending.clear()
+                    self.results.put(('poll', newmsg_list))
+            except Exception as ex:
+                if job[0] == 'poll':
+                    self._poll_pending.clear()
+                if job[0] == 'flush':
+                    self.results.put(('flush', job[1], [None] * len(job[1]), 0))
+                if job[0] == 'sync':
+                    self.results.put(('synced', False))
+                self.results.put(('error', str(ex)))
+            if dmr is not None and dmr.token is not None and dmr.token != self.token:
+                self.token = dmr.token
+                self.results.put(('token', dmr.token))
+        if dmr is not None:
+            dmr.close()
+
+
+class PollScheduler:
+    """
+    Chooses the delay before the next poll for new messages. Polls every min_interval seconds while a
+    conversation is active, i.e. within active_window seconds of the last message sent or received.
+    Otherwise, and after every failed poll, the interval grows by factor up to max_interval.
+    Each delay is spread by +/- jitter, as a fraction, so that many clients do not poll in step.
+    """
+    def __init__(self, min_interval=1.0, max_interval=60.0, factor=2.0, jitter=0.2, active_window=30.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.active_window = active_window
+        self.interval = min_interval
+        self._active_until = 0.0
+
+    def activity(self) -> None:
+        '''
+        Records that a message was sent or received, returning to the fastest poll rate.
+        '''
+        self.interval = self.min_interval
+        self._active_until = time.monotonic() + self.active_window
+
+    def result(self, ok, count=0) -> None:
+        '''
+        Records the outcome of a poll: whether it succeeded and how many new messages it returned.
+        '''
+        if ok and count:
+            self.activity()
+        elif not ok or time.monotonic() >= self._active_until:
+            self.interval = min(self.interval * self.factor, self.max_interval)
+
+    def next_delay(self) -> float:
+        '''
+        Returns the delay in seconds before the next poll, with jitter applied.
+        '''
+        return self.interval * (1 + self.jitter * (2 * random.random() - 1))
@@ -0,0 +1,125 @@
+"""
+history_archive.py
+Defines the SegmentCache class and the functions that read and write the compressed archive segments
+holding the older messages of a profile's contacts
+"""
+
+import hashlib, json, os, threading, uuid, zlib
+from collections import OrderedDict
+from pathlib import Path
+
+# Messages of one contact held by each archive segment
+ARCHIVE_SEGMENT_SIZE = 1000
+
+# Decoded segments kept in memory by a SegmentCache
+ARCHIVE_CACHE_SEGMENTS = 16
+
+# zlib level segments are compressed with
+ARCHIVE_COMPRESSION = 6
+
+def archive_dir(p) -> Path:
+    """
+    Returns the directory holding the archive segments of the DSU file at p.
+    """
+    p = Path(p)
+    return p.with_name(p.name + '.archive')
+
+
+def segment_name(contact) -> str:
+    """
+    Returns a new, unique file name for an archive segment of a contact. Names are never reused, so a
+    segment is only ever replaced by writing a new one, and a DSU snapshot never refers to a segment
+    whose content changed after the snapshot was written.
+    """
+    key = hashlib.sha1(contact.encode('utf-8')).hexdigest()[:16]
+    return f'{key}-{uuid.uuid4().hex[:12]}.seg'
+
+
+def write_segment(path, msgs, fsync=True) -> None:
+    """
+    Writes a list of message dictionaries to an archive segment: JSON compressed with zlib. The segment is
+    written to a temporary file and renamed into place.
+    """
+    p = Path(path)
+    tmp = p.with_name(p.name + '.tmp')
+    data = zlib.compress(json.dumps(msgs).encode('utf-8'), ARCHIVE_COMPRESSION)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, p)
+
+
+def read_segment(path) -> list:
+    """
+    Returns the list of message dictionaries held by an archive segment.
+    """
+    with open(path, 'rb') as f:
+        return json.loads(zlib.decompress(f.read()).decode('utf-8'))
+
+
+def remove_unreferenced(directory, names) -> int:
+    """
+    Removes the segment files, and temporary files left by an interrupted write, of an archive directory
+    that are not in names. Returns the number of files removed.
+    """
+    removed = 0
+    if not os.path.isdir(directory):
+        return removed
+    for entry in os.scandir(directory):
+        if entry.name.endswith(('.seg', '.tmp')) and entry.name not in names:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+
+class SegmentCache:
+    """
+    Keeps the most recently read archive segments decoded in memory, up to capacity segments,
+    so paging back and forth through archived history does not decompress the same segment again.
+    Safe to use from any thread.
+    """
+    def __init__(self, capacity=ARCHIVE_CACHE_SEGMENTS):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._segments = OrderedDict()  # path -> list of message dictionaries, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._segments)
+
+    def get(self, path) -> list:
+        '''
+        Returns the message dictionaries of the segment at path, reading it if it is not cached.
+        '''
+        key = str(path)
+        with self._lock:
+            msgs = self._segments.get(key)
+            if msgs is not None:
+                self._segments.move_to_end(key)
+                self.hits += 1
+                return msgs
+            self.misses += 1
+        msgs = read_segment(path)
+        self.put(key, msgs)
+        return msgs
+
+    def put(self, path, msgs) -> None:
+        '''
+        Caches the message dictionaries of the segment at path, evicting the least recently used segment
+        if the cache is full.
+        '''
+        with self._lock:
+            self._segments[str(path)] = msgs
+            self._segments.move_to_end(str(path))
+            while len(self._segments) > self.capacity:
+                self._segments.popitem(last=False)
+
+    def clear(self) -> None:
+        '''
+        Discards every cached segment.
+        '''
+        with self._lock:
+            self._segments.clear()
@@ -3,25 +3,66 @@ main.py
 Provides the GUI for the distributed social messenger and runs the client when executed
 """
 
+import logging, time
 import tkinter as tk
 from tkinter import ttk, filedialog
-from profile import Profile
+import ds_metrics
+from ds_metrics import metrics
+from profile import Profile, ProfileWriter, DsuFileError, DsuProfileError, FSYNC_ALWAYS
+from ds_worker import NetWorker, PollScheduler
+from message_view import render_lines
+
+log = logging.getLogger(__name__)
 
 # Replace with valid DSU server address
 DSU_SERVER_ADD = "YOUR SERVER ADDRESS HERE"
 
+# Seconds between polls for new messages during a conversation, and the longest wait when idle
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 60.0
+
+# Messages of each contact read when a DSU file is opened; older ones are read when scrolling up
+LOAD_RECENT_MSGS = 200
+
+# Messages kept in the message_box widget at once, and messages added at a time while scrolling past its ends
+MESSAGE_WINDOW = 400
+MESSAGE_PAGE = 100
+
+# Most search hits kept for one query
+SEARCH_LIMIT = 1000
+
+# Seconds changes to the profile wait to be saved together, and when saves are synced to disk, see profile.FSYNC_ALWAYS
+SAVE_DELAY = 0.5
+SAVE_FSYNC = FSYNC_ALWAYS
+
+# Milliseconds between checks for results from the network worker, and between refreshes of the diagnostics window
+RESULTS_INTERVAL = 50
+DIAGNOSTICS_INTERVAL = 1000
+
+# Seconds a closing profile waits for the network worker to finish sending a batch
+WORKER_STOP_TIMEOUT = 5.0
+
 class Body(tk.Frame):
     """
     A subclass of tk.Frame that is responsible for drawing all of the widgets
     in the body portion of the root frame.
     """
-    def __init__(self, root, select_callback=None):
+    def __init__(self, root, select_callback=None, top_callback=None, search_callback=None):
         tk.Frame.__init__(self, root)
         self.root = root
         self._select_callback = select_callback
-
-        # List of all recipients available in the active DSU file
-        self._recipients = []
+        self._top_callback = top_callback
+        self._search_callback = search_callback
+
+        # Recipients available in the active DSU file, by the contact id used as their contact_tree item id
+        self._names = {}
+        self._ids = {}
+
+        # Rendered msgs of the shown conversation, and the slice of them inserted in the message_box widget
+        self._lines = []
+        self._start = 0
+        self._end = 0
+        self._total_drawn = 0
         
         # After all initialization is complete, call _draw to pack the widgets into the Body instance 
         self._draw()
@@ -33,9 +74,29 @@ class Body(tk.Frame):
         selection = self.contact_tree.selection()
         if not selection:
            return
-        index = int(selection[0])
-        self.recipient = self._recipients[index]
+        self.recipient = self._names[int(selection[0])]
+        if self._select_callback is not None:
+            self._select_callback()
     
+    def search_submit(self, event):
+        """
+        Calls the callback function specified in the search_callback class attribute, if available,
+        with the text of the search_entry widget.
+        """
+        if self._search_callback is not None:
+            self._search_callback(self.search_entry.get().strip())
+
+    def show_contact(self, recipient):
+        """
+        Binds the current recipient to a contact and moves the focus of the contact_tree widget to it,
+        without selecting it.
+        """
+        self.recipient = recipient
+        id = self._ids.get(recipient)
+        if id is not None:
+            self.contact_tree.focus(id)
+            self.contact_tree.see(id)
+
     def get_text_entry(self) -> str:
         """
         Returns the text that is currently displayed in the entry_editor widget.
@@ -57,22 +118,186 @@ class Body(tk.Frame):
 	    self.message_box.delete(0.0, 'end')      # delete between two indices, 0-based
 	    self.message_box.insert(0.0, text)       # insert new text at a given index
 	    self.message_box.configure(state=tk.DISABLED)
-    
-    def set_contacts(self, contact:list):
+
+    def set_message_lines(self, lines: list, top=None):
+        """
+        Shows a conversation, given as one rendered string per msg, in the message_box widget.
+        Only a window of MESSAGE_WINDOW msgs is inserted: the last ones, or those around index top when
+        given, with msg top at the top of the view. The list is kept so that more of it can be inserted
+        as the widget is scrolled, and so that msgs appended to it can be shown by show_new_message_lines.
+        """
+        self._lines = lines
+        total = len(lines)
+        if top is None:
+            self._start = max(total - MESSAGE_WINDOW, 0)
+        else:
+            self._start = max(min(top, total - MESSAGE_WINDOW), 0)
+        self._end = min(self._start + MESSAGE_WINDOW, total)
+        self._total_drawn = total
+        self.set_message_text(''.join(lines[self._start:self._end]))
+        if top is None:
+            self.message_box.yview('end')
+        else:
+            above = ''.join(lines[self._start:top]).count('\n')
+            self.message_box.yview(f'{above + 1}.0')
+
+    def show_new_message_lines(self):
+        """
+        Inserts msgs appended to the shown conversation since it was last drawn, if the window of
+        the message_box widget reaches the end of the conversation, and follows them if the view was
+        at the bottom. Otherwise only the scrollbar changes.
+        """
+        total = len(self._lines)
+        drawn, self._total_drawn = self._total_drawn, total
+        if self._end < drawn:
+            self._update_scrollbar(*self.message_box.yview())
+            return
+        if self._end >= total:
+            return
+        at_bottom = self.message_box.yview()[1] >= 1.0
+        self.message_box.configure(state=tk.NORMAL)
+        self.message_box.insert('end', ''.join(self._lines[self._end:total]))
+        self.message_box.configure(state=tk.DISABLED)
+        self._end = total
+        self._trim_top()
+        if at_bottom:
+            self.message_box.yview('end')
+
+    def message_scrolled(self, first, last):
+        """
+        Keeps the window of msgs in the message_box widget around the view: when the view reaches either
+        end of the window, MESSAGE_PAGE more msgs are inserted there and the msgs furthest away are removed.
+        Calls the callback function specified in the top_callback class attribute, if available, when
+        the top of the conversation is reached. Updates the scrollbar to match the whole conversation.
+        """
+        first, last = float(first), float(last)
+        if first <= 0.0 and self._start > 0:
+            self._extend_up()
+        elif last >= 1.0 and self._end < len(self._lines):
+            self._extend_down()
+        elif first <= 0.0 and self._top_callback is not None:
+            self._top_callback()
+        self._update_scrollbar(*self.message_box.yview())
+
+    def scrollbar_moved(self, *args):
+        """
+        Handles the scrollbar, whose position covers the whole conversation. Dragging it to a part of the
+        conversation outside the window of the message_box widget redraws the window around that part.
+        """
+        total = len(self._lines)
+        shown = self._end - self._start
+        if args[0] != 'moveto' or not shown:
+            self.message_box.yview(*args)
+            return
+        target = float(args[1]) * total
+        if self._start <= target <= self._end:
+            self.message_box.yview('moveto', (target - self._start) / shown)
+        else:
+            self.set_message_lines(self._lines, top=max(min(int(target), total - 1), 0))
+
+    def _update_scrollbar(self, first, last):
+        """
+        Sets the scrollbar from the view of the message_box widget, as fractions of the whole conversation.
+        """
+        total = len(self._lines)
+        shown = self._end - self._start
+        if not total:
+            self.msg_box_scrollbar.set(0.0, 1.0)
+            return
+        self.msg_box_scrollbar.set((self._start + first * shown) / total, (self._start + last * shown) / total)
+
+    def _extend_up(self):
+        """
+        Inserts the MESSAGE_PAGE msgs before the window at the top of the message_box widget, keeping the view in place.
+        """
+        top = self._top_line()
+        start = max(self._start - MESSAGE_PAGE, 0)
+        text = ''.join(self._lines[start:self._start])
+        self.message_box.configure(state=tk.NORMAL)
+        self.message_box.insert('1.0', text)
+        self.message_box.configure(state=tk.DISABLED)
+        self._start = start
+        added = text.count('\n')
+        self.message_box.yview(f'{top + added}.0')
+        self._trim_bottom()
+
+    def _extend_down(self):
+        """
+        Inserts the MESSAGE_PAGE msgs after the window at the bottom of the message_box widget.
+        """
+        end = min(self._end + MESSAGE_PAGE, len(self._lines))
+        self.message_box.configure(state=tk.NORMAL)
+        self.message_box.insert('end', ''.join(self._lines[self._end:end]))
+        self.message_box.configure(state=tk.DISABLED)
+        self._end = end
+        self._trim_top()
+
+    def _trim_top(self):
+        """
+        Removes msgs from the top of the message_box widget while it holds more than MESSAGE_WINDOW + MESSAGE_PAGE.
+        """
+        if self._end - self._start <= MESSAGE_WINDOW + MESSAGE_PAGE:
+            return
+        start = self._end - MESSAGE_WINDOW
+        count = ''.join(self._lines[self._start:start]).count('\n')
+        top = self._top_line()
+        self.message_box.configure(state=tk.NORMAL)
+        self.message_box.delete('1.0', f'{count + 1}.0')
+        self.message_box.configure(state=tk.DISABLED)
+        self._start = start
+        self.message_box.yview(f'{max(top - count, 1)}.0')
+
+    def _trim_bottom(self):
+        """
+        Removes msgs from the bottom of the message_box widget while it holds more than MESSAGE_WINDOW + MESSAGE_PAGE.
+        """
+        if self._end - self._start <= MESSAGE_WINDOW + MESSAGE_PAGE:
+            return
+        end = self._start + MESSAGE_WINDOW
+        count = ''.join(self._lines[end:self._end]).count('\n')
+        last = int(self.message_box.index('end-1c').split('.')[0])
+        self.message_box.configure(state=tk.NORMAL)
+        self.message_box.delete(f'{last - count}.0', 'end-1c')
+        self.message_box.configure(state=tk.DISABLED)
+        self._end = end
+
+    def _top_line(self) -> int:
+        """
+        Returns the number of the line at the top of the view of the message_box widget, counting from 1.
+        """
+        return int(self.message_box.index('@0,0').split('.')[0])
+
+    def set_contacts(self, contacts:list):
         """
-        Populates the self._recipients attribute with recipients from the active DSU file.
+        Replaces the contacts of the contact_tree widget with (id, recipient, text) rows from the active
+        DSU file, in the order given. The old rows are removed in one call.
         """
-        self._recipients = contact
-        for id in range(0, len(self._recipients)):
-            self._insert_contact_tree(id, self._recipients[id])
+        self.contact_tree.delete(*self.contact_tree.get_children())
+        self._names = {}
+        self._ids = {}
+        for id, recipient, text in contacts:
+            self.insert_contact(id, recipient, text)
 
-    def insert_contact(self, recipient):
+    def insert_contact(self, id, recipient, text=None):
         """
-        Inserts a single contact to the contact_tree widget.
+        Inserts a single contact at the end of the contact_tree widget, showing text, or the recipient
+        if no text is given.
         """
-        self._recipients.append(recipient)
-        id = len(self._recipients) - 1 #adjust id for 0-base of treeview widget
-        self._insert_contact_tree(id, recipient)
+        self._names[id] = recipient
+        self._ids[recipient] = id
+        self.contact_tree.insert('', 'end', id, text=text or recipient)
+
+    def update_contact(self, id, text):
+        """
+        Changes the text shown for a contact in the contact_tree widget.
+        """
+        self.contact_tree.item(id, text=text)
+
+    def order_contacts(self, ids):
+        """
+        Moves the contacts of the contact_tree widget into the order of ids, in one call.
+        """
+        self.contact_tree.set_children('', *ids)
 
     def reset_ui(self):
         """
@@ -81,17 +306,7 @@ class Body(tk.Frame):
         """
         self.set_text_entry("")
         self._posts = []
-        for item in self.contact_tree.get_children():
-            self.contact_tree.delete(item)
-
-    def _insert_contact_tree(self, id, recipient):
-        """
-        Inserts a contact into the contact_tree widget.
-        """
-        # Use the first 24 characters of a post entry as the identifier in the post_tree widget
-        if len(recipient) > 25:
-            recipient = recipient[:24] + "..."
-        self.contact_tree.insert('', id, id, text=recipient)
+        self.set_contacts([])
     
     def _draw(self):
         """
@@ -99,6 +314,9 @@ class Body(tk.Frame):
         """
         contacts_frame = tk.Frame(master=self, width=150)
         contacts_frame.pack(fill=tk.BOTH, side=tk.LEFT)
+        self.search_entry = tk.Entry(contacts_frame)
+        self.search_entry.bind("<Return>", self.search_submit)
+        self.search_entry.pack(fill=tk.X, side=tk.TOP, padx=5, pady=(5,0))
         self.contact_tree = ttk.Treeview(contacts_frame)
         self.contact_tree.bind("<<TreeviewSelect>>", self.node_select)
         self.contact_tree.pack(fill=tk.BOTH, side=tk.TOP, expand=True, padx=5, pady=5)
@@ -121,9 +339,9 @@ class Body(tk.Frame):
         self.entry_editor = tk.Text(editor_frame, width=0, height=5)
         self.entry_editor.pack(fill=tk.X, expand=True, padx=0, pady=0)
 
-        msg_box_scrollbar = tk.Scrollbar(master=scroll_frame, command=self.message_box.yview)
-        self.message_box['yscrollcommand'] = msg_box_scrollbar.set
-        msg_box_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
+        self.msg_box_scrollbar = tk.Scrollbar(master=scroll_frame, command=self.scrollbar_moved)
+        self.message_box['yscrollcommand'] = self.message_scrolled
+        self.msg_box_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
 
 
 class Footer(tk.Frame):
@@ -151,7 +369,13 @@ class Footer(tk.Frame):
         Updates the text that is displayed in the footer_label widget
         """
         self.footer_label.configure(text=message)
-    
+
+    def set_poll_status(self, message):
+        """
+        Updates the text that is displayed in the poll_label widget
+        """
+        self.poll_label.configure(text=message)
+
     def _draw(self):
         """
         Call only once upon initialization to add widgets to the frame
@@ -160,6 +384,9 @@ class Footer(tk.Frame):
         save_button.configure(command=self.save_click)
         save_button.pack(fill=tk.BOTH, side=tk.RIGHT, padx=(5,20), pady=5)
 
+        self.poll_label = tk.Label(master=self, text="")
+        self.poll_label.pack(fill=tk.BOTH, side=tk.RIGHT, padx=5)
+
         self.footer_label = tk.Label(master=self, text="No file loaded. Open or create a file to continue.")
         self.footer_label.pack(fill=tk.BOTH, side=tk.LEFT, padx=5)
 
@@ -175,6 +402,26 @@ class MainApp(tk.Frame):
         # Initialize a new Profile and assign it to a class attribute
         self._current_profile = Profile()
         self._profile_filename = None
+        # Background worker that owns all traffic with the DS server for the current profile
+        self._worker = None
+        # Background writer that saves the current profile to its DSU file
+        self._writer = None
+        # Set while the worker is sending the outbox of the current profile
+        self._flushing = False
+        # HistoryMerge of the server's history into the current profile, while a sync runs
+        self._merge = None
+        # Decides when the worker next polls for new messages, and the pending after() event that will do it
+        self._poller = PollScheduler(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL)
+        self._poll_job = None
+        # Rendered conversation lines per contact
+        self._rendered = {}
+        self._shown_contact = None
+        # When process_results last ran, to measure how late the GUI thread runs its timer events
+        self._last_tick = None
+        # Hits of the last search, and the position of the hit shown
+        self._search_query = None
+        self._search_hits = []
+        self._search_pos = 0
         # After all initialization is complete, call _draw to pack the widgets into the root frame
         self._draw()
 
@@ -193,17 +440,22 @@ class MainApp(tk.Frame):
             if not filename:
               return
             self._profile_filename = filename.name
+            self._close_profile()
             self._current_profile = Profile()
             self._current_profile.dsuserver = DSU_SERVER_ADD
             self._current_profile.username = username
             self._current_profile.password = pwd
             self._current_profile.save_profile(self._profile_filename)
+            self._start_worker()
             self.footer.set_status(f"{self._current_profile.username} - Ready")
             self.body.reset_ui()
+            self._reset_message_box()
         except AttributeError:
             error = "ERROR: No file loaded. Open or create a file to continue."
-            print(error)
+            log.error(error)
             self.footer.set_status(error)
+        except (DsuFileError, DsuProfileError) as ex:
+            self._profile_failed(ex)
     
     def open_profile(self):
         """
@@ -213,61 +465,247 @@ class MainApp(tk.Frame):
         try:
             filename = tk.filedialog.askopenfile(filetypes=[('Distributed Social Profile', '*.dsu')])
             self._profile_filename = filename.name
+            self._close_profile()
             self._current_profile = Profile()
-            self._current_profile.load_profile(self._profile_filename)
+            self._current_profile.load_profile(self._profile_filename, recent=LOAD_RECENT_MSGS)
+            self._start_worker()
 
             self.footer.set_status(f"{self._current_profile.username} - Ready")
             self.body.reset_ui()
-            self.body.set_contacts(self._current_profile._recipients)
+            self._reset_message_box()
+            self._show_contacts()
         except AttributeError:
             error = "ERROR: No file loaded. Open or create a file to continue."
-            print(error)
+            log.error(error)
             self.footer.set_status(error)
+        except (DsuFileError, DsuProfileError) as ex:
+            self._profile_failed(ex)
+
+    def _profile_failed(self, ex):
+        """
+        Reports a DSU file that could not be opened or created, leaving no profile loaded.
+        """
+        log.error("Profile could not be loaded.", extra={'op': 'open', 'path': self._profile_filename, 'error': str(ex)})
+        self.footer.set_status(f"ERROR: Could not open {self._profile_filename}: {ex}")
+        self._close_profile()
+        self._current_profile = Profile()
+        self._profile_filename = None
+        self.body.reset_ui()
+        self._reset_message_box()
     
     def close(self):
         """
         Closes the program when the 'Close' menu item is clicked.
         """
+        self._close_profile()
         self.root.destroy()
 
+    def _close_profile(self):
+        """
+        Stops the network worker, applying the outcome of a batch it was sending, writes the unsaved changes
+        of the current profile and closes its session with the server. A running history sync is stopped,
+        keeping the messages merged so far.
+        """
+        if self._worker is not None:
+            # A batch the server already answered is removed from the outbox, so it is not sent again
+            for result in self._worker.stop(WORKER_STOP_TIMEOUT):
+                if result[0] == 'flush':
+                    self._current_profile.outbox_sent(*result[1:])
+                elif result[0] == 'token':
+                    self._current_profile.set_token(result[1])
+            self._worker = None
+        if self._merge is not None:
+            self._merge.finish(False)
+            self._merge.wait()
+            self._current_profile.apply_merge(self._merge)
+            self._merge = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._current_profile.close()
+
+    def _start_worker(self):
+        """
+        Replaces the network worker and the profile writer with ones for the current profile.
+        """
+        if self._worker is not None:
+            self._worker.stop()
+        profile = self._current_profile
+        self._worker = NetWorker(profile.dsuserver, profile.username, profile.password, profile._token)
+        self._writer = ProfileWriter(profile, self._profile_filename, SAVE_DELAY, SAVE_FSYNC)
+        self._poller = PollScheduler(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL)
+        self._flushing = False
+        self._flush_outbox()
+        self.schedule_poll()
+
+    def _flush_outbox(self):
+        """
+        Queues the messages waiting in the outbox of the current profile to be sent by the network worker,
+        unless it is already sending them. process_results applies the outcome.
+        """
+        outbox = self._current_profile.pending_outbox()
+        if self._worker is not None and outbox and not self._flushing:
+            self._flushing = True
+            self._worker.flush(outbox)
+
+    @metrics.timed('ui.render')
     def set_message_box(self):
         """
-        Creates a text string populated with the retrieved msgs to the server.
-        Calls the set_message_text method to make it appear in the text editor.
-        """
-        text = ""
-        for msg in self._current_profile._retrievedmsgs:
-            if 'recipient' in msg.keys():
-                if msg['recipient'] == self.body.recipient:
-                    entry = msg['message']
-                    text += f'YOU: {entry}\n'   #'YOU' indicates who is sending the msg
-            if 'from' in msg.keys():
-                if msg['from'] == self.body.recipient:
-                    entry = msg['message']
-                    who = msg['from'].upper()
-                    text += f'{who}: {entry}\n'
-        self.body.set_message_text(text)
-        
+        Renders the selected contact's msgs that arrived since the last call into that contact's cached
+        lines, then shows the conversation in the message_box widget. Only new lines are added to the
+        widget; it is redrawn from the cached lines only when a different contact is selected.
+        """
+        recipient = self.body.recipient
+        if self._current_profile.mark_read(recipient):
+            self._update_contact(recipient)
+        if recipient != self._shown_contact and self._shown_contact is not None:
+            # Archived msgs read while the last contact was shown are dropped, and read again on demand
+            if self._current_profile.release_archived(self._shown_contact):
+                self._rendered.pop(self._shown_contact, None)
+        lines = self._render(recipient)
+        if recipient != self._shown_contact:
+            self._shown_contact = recipient
+            self.body.set_message_lines(lines)
+        else:
+            self.body.show_new_message_lines()
+
+    def _show_contacts(self):
+        """
+        Fills the contact_tree widget with the contacts of the current profile, most recently active first.
+        """
+        contacts = self._current_profile.contacts
+        rows = []
+        for id in contacts.by_activity():
+            recipient = contacts.name_of(id)
+            rows.append((id, recipient, self._contact_text(recipient)))
+        self.body.set_contacts(rows)
+
+    def _contact_text(self, recipient) -> str:
+        """
+        Returns the text shown for a contact in the contact_tree widget: its name, and its unread count if any.
+        """
+        unread = self._current_profile.contacts.unread(recipient)
+        return f"{recipient} ({unread})" if unread else recipient
+
+    def _update_contact(self, recipient):
+        """
+        Redraws the text of a contact in the contact_tree widget, if it is a contact.
+        """
+        id = self._current_profile.contacts.id_of(recipient)
+        if id is not None:
+            self.body.update_contact(id, self._contact_text(recipient))
+
+    def _render(self, recipient) -> list:
+        """
+        Renders the msgs of a contact that are not in its cached lines yet, and returns the cached lines.
+        """
+        lines = self._rendered.setdefault(recipient, [])
+        lines.extend(render_lines(self._current_profile.conversation(recipient, start=len(lines))))
+        return lines
+
+    def load_older_msgs(self):
+        """
+        Reads a page of older msgs of the selected contact from the DSU file when the message_box
+        widget is scrolled to the top, and redraws the conversation keeping the same msgs in view.
+        """
+        recipient = getattr(self.body, 'recipient', None)
+        if recipient is None or not self._current_profile.has_older(recipient):
+            return
+        added = self._current_profile.load_older(recipient)
+        self._rendered.pop(recipient, None)
+        self._shown_contact = recipient
+        self.body.set_message_lines(self._render(recipient), top=added)
+
+    def search_msgs(self, query):
+        """
+        Searches the msgs of the active DSU file for every word of the query when Enter is pressed in the
+        search box, and shows the newest hit in its conversation. Pressing Enter again on the same query
+        shows the next hit.
+        """
+        if not query:
+            return
+        if query != self._search_query:
+            self._search_query = query
+            self._search_hits = self._current_profile.search(query, limit=SEARCH_LIMIT)
+            self._search_pos = 0
+        elif self._search_hits:
+            self._search_pos = (self._search_pos + 1) % len(self._search_hits)
+        if not self._search_hits:
+            self.footer.set_status(f"No messages match '{query}'")
+            return
+        contact, timestamp = self._search_hits[self._search_pos]
+        self.body.show_contact(contact)
+        self._show_msg(contact, timestamp)
+        self.footer.set_status(f"Match {self._search_pos + 1} of {len(self._search_hits)}")
+
+    def _show_msg(self, recipient, timestamp):
+        """
+        Shows a contact's conversation with the msg sent at timestamp at the top of the message_box widget,
+        reading older msgs from the DSU file until it is found.
+        """
+        older = self._current_profile.has_older(recipient)
+        index = self._current_profile.find_msg(recipient, timestamp)
+        if older:
+            self._rendered.pop(recipient, None)
+        self._shown_contact = recipient
+        self.body.set_message_lines(self._render(recipient), top=index)
+
+    def _reset_message_box(self):
+        """
+        Clears the rendered conversations and the message_box widget, e.g. when a new DSU file is loaded.
+        """
+        self._rendered = {}
+        self._shown_contact = None
+        self._search_query = None
+        self.body.set_message_lines([])
 
     def send_msg(self):
         """
-        Sends the message to the user, adds it to the active DSU file,
-        calls set_message_box for the text to appear in the message_box widget.
+        Adds the message to the outbox of the active DSU file and queues the outbox to be sent by the
+        network worker. process_results stores it as sent once the server accepts it; until then it is
+        kept in the outbox, which is saved with the profile, and sent again once the server answers.
         """
-        try:
-            msg = self.body.get_text_entry()
-            self._current_profile.send_msg(msg, self.body.recipient)
-            self._current_profile.save_profile(self._profile_filename)
-            self.body.set_text_entry("")
-            self.set_message_box()
-        except AttributeError:
+        recipient = getattr(self.body, 'recipient', None)
+        if self._worker is None or recipient is None:
             error = "ERROR: Please create/open a file and click on a contact."
-            print(error)
-            self.footer.set_status(error)
-        except TypeError:
-            error = "ERROR: Please connect to WiFi, and check IP address and port."
+            log.error(error)
             self.footer.set_status(error)
+            return
+        self._current_profile.queue_msg(self.body.get_text_entry(), recipient)
+        self._writer.mark_dirty()
+        self.body.set_text_entry("")
+        self._flush_outbox()
+        self._poller.activity()
+        self.schedule_poll()
             
+    def _show_refused(self, refused):
+        """
+        Reports the msgs the server answered but refused, as (message, recipient) pairs, in the footer. They
+        are no longer in the outbox, so the last one is put back in the entry_editor widget if it is empty.
+        """
+        message, recipient = refused[-1]
+        if not self.body.get_text_entry():
+            self.body.set_text_entry(message)
+        recipients = ', '.join(sorted({recipient for _, recipient in refused}))
+        self.footer.set_status(f"ERROR: Server refused {len(refused)} message(s) to {recipients}.")
+
+    def sync_history(self):
+        """
+        Queues a retrieve of the server's full message history on the network worker, when the 'Sync History'
+        menu item is clicked. process_results hands each batch to a HistoryMerge, which merges them into
+        the active DSU file off the GUI thread, and applies the merge once it is done.
+        """
+        if self._worker is None:
+            error = "ERROR: No file loaded. Open or create a file to continue."
+            self.footer.set_status(error)
+            return
+        if self._merge is not None:
+            self.footer.set_status("History sync already running.")
+            return
+        self.footer.set_status("Syncing history...")
+        self._merge = self._current_profile.start_merge()
+        self._worker.sync()
+
     def add_contact(self):
         """
         Creates the add_contact window under Settings, allows user to enter in a new contact, and saves recipient to file
@@ -281,13 +719,60 @@ class MainApp(tk.Frame):
 
         def get_input():
             self.contact = text_wid.get('1.0', 'end').rstrip()
-            self._current_profile._recipients.append(self.contact)
-            self.body.insert_contact(self.contact)
-            self._current_profile.save_profile(self._profile_filename)
+            if not self._current_profile.add_contact(self.contact):
+                self.footer.set_status(f"{self.contact} is already a contact.")
+                return
+            contacts = self._current_profile.contacts
+            self.body.insert_contact(contacts.id_of(self.contact), self.contact)
+            self.body.order_contacts(contacts.by_activity())
+            if self._writer is not None:
+                self._writer.mark_dirty()
 
         Ok_btn = tk.Button(root_2, height=1, width=10, text="OK", command=lambda: [get_input(), root_2.destroy()])
         Ok_btn.pack()
 
+    def show_diagnostics(self):
+        """
+        Creates the diagnostics window under Settings, which shows the latency of each instrumented stage
+        and the counters, refreshed every DIAGNOSTICS_INTERVAL ms, and can export them as JSON.
+        Stages named net.* wait on the server; the others are time spent in the client.
+        """
+        window = tk.Toplevel(self.root)
+        window.title("Diagnostics")
+        window.geometry('640x360')
+        text_wid = tk.Text(window, width=0, height=0, wrap=tk.NONE, state=tk.DISABLED)
+
+        def export():
+            path = tk.filedialog.asksaveasfilename(parent=window, defaultextension='.json',
+                                                   filetypes=[('JSON', '*.json')])
+            if path:
+                metrics.export_json(path)
+
+        def refresh():
+            if not text_wid.winfo_exists():
+                return
+            snapshot = metrics.snapshot()
+            lines = [f"{'stage':<24}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}\n"]
+            for name, stats in snapshot['stages'].items():
+                errors = snapshot['counters'].get(name + '.errors', 0)
+                lines.append(f"{name:<24}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}"
+                             f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}{errors:>8}\n")
+            lines.append("\n")
+            for name, value in snapshot['counters'].items():
+                lines.append(f"{name:<24}{value:>8}\n")
+            text_wid.configure(state=tk.NORMAL)
+            text_wid.delete(0.0, 'end')
+            text_wid.insert(0.0, ''.join(lines))
+            text_wid.configure(state=tk.DISABLED)
+            window.after(DIAGNOSTICS_INTERVAL, refresh)
+
+        button_frame = tk.Frame(master=window)
+        button_frame.pack(fill=tk.X, side=tk.BOTTOM)
+        tk.Button(button_frame, text="Export JSON...", command=export).pack(side=tk.RIGHT, padx=5, pady=5)
+        tk.Button(button_frame, text="Reset", command=metrics.reset).pack(side=tk.RIGHT, padx=5, pady=5)
+        text_wid.pack(fill=tk.BOTH, side=tk.TOP, expand=True, padx=5, pady=5)
+        refresh()
+
     def _draw(self):
         """
         Call only once, upon initialization to add widgets to root frame
@@ -299,6 +784,8 @@ class MainApp(tk.Frame):
         settings_file = tk.Menu(menu_bar)
         menu_bar.add_cascade(menu=menu_file, label='File')
         settings_file.add_command(label = 'Add Contact', command = self.add_contact)
+        settings_file.add_command(label = 'Sync History', command = self.sync_history)
+        settings_file.add_command(label = 'Diagnostics', command = self.show_diagnostics)
         
         menu_file.add_command(label='New', command=self.new_profile)
         menu_file.add_command(label='Open...', command=self.open_profile)
@@ -306,7 +793,8 @@ class MainApp(tk.Frame):
         menu_bar.add_cascade(menu = settings_file, label = 'Settings')
 
         # The Body and Footer classes must be initialized and packed into the root window.
-        self.body = Body(self.root, self._current_profile)
+        self.body = Body(self.root, select_callback=self.set_message_box, top_callback=self.load_older_msgs,
+                         search_callback=self.search_msgs)
         self.body.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
         
         self.footer = Footer(self.root, save_callback=self.send_msg)
@@ -314,20 +802,102 @@ class MainApp(tk.Frame):
 
     def check_task(self):
         """
-        Retrieves the new messages form the DS server
-        Places new timer event on the event queue by calling after (recursion)
+        Queues a retrieve of the new messages from the DS server on the network worker
+        Places new timer event on the event queue by calling schedule_poll (recursion)
         """
-        try:
-            if self._profile_filename is not None:
-                self._current_profile.new_msg()
-                self._current_profile.save_profile(self._profile_filename)
-                self.set_message_box()
-            self.root.after(5000, self.check_task)
-        except TypeError:
-            error = "ERROR: Please connect to WiFi, and check IP address and port."
-            self.footer.set_status(error)
+        self._poll_job = None
+        if self._worker is not None:
+            self._worker.poll()
+        self.schedule_poll()
+
+    def schedule_poll(self):
+        """
+        Replaces the pending check_task timer event with one after the delay chosen by the poll
+        scheduler, and shows the current poll rate in the footer.
+        """
+        if self._poll_job is not None:
+            self.root.after_cancel(self._poll_job)
+        self._poll_job = self.root.after(int(self._poller.next_delay() * 1000), self.check_task)
+        self.footer.set_poll_status(f"Checking every {self._poller.interval:g}s")
+
+    def process_results(self):
+        """
+        Applies the results handed back by the network worker, saving the DSU file and
+        refreshing the message_box widget only when something arrived.
+        Places new timer event on the event queue by calling after (recursion)
+        Records how late this timer event ran, which shows stalls of the GUI thread.
+        """
+        now = time.perf_counter()
+        if self._last_tick is not None:
+            metrics.record('ui.timer_lag', max(now - self._last_tick - RESULTS_INTERVAL / 1000, 0.0))
+        # The worker and the writer are started and stopped together, see _start_worker and _close_profile
+        if self._worker is not None and self._writer is not None:
+            changed = False
+            results = self._worker.get_results()
+            for result in results:
+                if result[0] == 'flush':
+                    _, outbox, sent, answered = result
+                    report = self._current_profile.outbox_sent(outbox, sent, answered)
+                    self._flushing = False
+                    changed = changed or answered > 0
+                    waiting = len(self._current_profile.pending_outbox())
+                    if answered == len(outbox):
+                        # Messages queued while this batch was in flight are sent now
+                        self._flush_outbox()
+                    elif waiting:
+                        self.footer.set_status(f"Server unreachable: {waiting} messages waiting to send.")
+                    refused = [(message, recipient) for message, recipient, ok in report[:answered] if not ok]
+                    if refused:
+                        self._show_refused(refused)
+                elif result[0] == 'sync':
+                    if self._merge is not None:
+                        self._merge.add(result[1])
+                elif result[0] == 'synced':
+                    if self._merge is not None:
+                        self._merge.finish(result[1])
+                elif result[0] == 'token':
+                    self._current_profile.set_token(result[1])
+                    changed = True
+                elif result[0] == 'poll' and result[1] is not None:
+                    self._current_profile.store_new_msgs(result[1])
+                    for recipient in {dm.recipient for dm in result[1]}:
+                        self._update_contact(recipient)
+                    self._poller.result(True, len(result[1]))
+                    changed = changed or len(result[1]) > 0
+                    # The server answered again, so messages kept while it was unreachable are sent
+                    self._flush_outbox()
+                else:
+                    self._poller.result(False)
+                    log.warning("Network worker request failed.", extra={'op': result[0], 'result': result[1:]})
+                    error = "ERROR: Please connect to WiFi, and check IP address and port."
+                    self.footer.set_status(error)
+            if self._merge is not None and self._merge.done:
+                stats = self._current_profile.apply_merge(self._merge)
+                self._merge = None
+                if stats['ok']:
+                    self.footer.set_status(f"Synced history: {stats['added']} new of {stats['received']} messages")
+                else:
+                    self.footer.set_status(f"ERROR: History sync stopped early, {stats['added']} new messages kept.")
+                # A merge rebuilds the conversations, with any archived msgs read back in
+                self._rendered = {}
+                self._shown_contact = None
+                if stats['added']:
+                    changed = True
+            if changed:
+                self._writer.mark_dirty()
+                self.body.order_contacts(self._current_profile.contacts.by_activity())
+                if getattr(self.body, 'recipient', None) is not None:
+                    self.set_message_box()
+            self._writer.tick()
+            if results:
+                metrics.record('ui.process_results', time.perf_counter() - now)
+        self._last_tick = time.perf_counter()
+        self.root.after(RESULTS_INTERVAL, self.process_results)
 
 if __name__ == "__main__":
+    # Log records are written to standard error as JSON lines
+    ds_metrics.configure_logging()
+
     # All Tkinter programs start with a root window
     main = tk.Tk()
 
@@ -348,8 +918,10 @@ if __name__ == "__main__":
     main.update()
     # minsize prevents the root window from resizing too small
     main.minsize(main.winfo_width(), main.winfo_height())
-	#accepts delay time, and check_task function so new messages can pop up
-    main.after(5000, main_instance.check_task)
+	#schedules check_task so new messages can pop up, at a rate that adapts to activity
+    main_instance.schedule_poll()
+    #drains results from the network worker so the event loop never waits on the server
+    main.after(RESULTS_INTERVAL, main_instance.process_results)
     
     # Start up the event loop for the program
     main.mainloop()
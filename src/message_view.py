@@ -0,0 +1,17 @@
+"""
+message_view.py
+Formats stored messages as the lines the message box shows for a conversation.
+Does not import tkinter, so the lines can be built and benchmarked without a display.
+"""
+
+def render_lines(msgs) -> list:
+    """
+    Returns the line shown for each Message of msgs, in order.
+    """
+    lines = []
+    for msg in msgs:
+        if msg.sent:
+            lines.append(f'YOU: {msg.message}\n')   #'YOU' indicates who is sending the msg
+        else:
+            lines.append(f'{msg.contact.upper()}: {msg.message}\n')
+    return lines
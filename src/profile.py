@@ -3,9 +3,48 @@ profile.py
 Defines the Profile class
 """
 
-import json, time, os
+import gc, hashlib, heapq, itertools, json, logging, queue, re, shutil, threading, time, os, struct, sys
+from array import array
+from contextlib import contextmanager
 from pathlib import Path
-from ds_messenger import DirectMessenger, DirectMessage
+from ds_messenger import DirectMessenger, DirectMessage, CircuitBreaker
+from ds_metrics import metrics
+from search_index import SearchIndex
+from contact_registry import ContactRegistry
+from history_archive import (ARCHIVE_SEGMENT_SIZE, SegmentCache, archive_dir, segment_name, read_segment,
+                             write_segment, remove_unreferenced)
+
+log = logging.getLogger(__name__)
+
+# Number of journal records saved before the journal is folded into the DSU snapshot
+JOURNAL_COMPACT_RECORDS = 1000
+
+# Messages read at a time when older history of a lazily loaded profile is fetched
+HISTORY_PAGE_SIZE = 200
+
+# When a save fsyncs: every write, only snapshots and not journal appends, or never
+FSYNC_ALWAYS = 'always'
+FSYNC_SNAPSHOT = 'snapshot'
+FSYNC_NEVER = 'never'
+
+# Seconds a ProfileWriter waits after the first change of a burst before saving, and before retrying a failed write
+SAVE_DELAY = 0.5
+SAVE_RETRY_INTERVAL = 5.0
+
+# Version of the snapshot cache file format; caches of other versions are ignored
+SNAPSHOT_CACHE_VERSION = 2
+
+# Messages whose text is encoded at a time in a snapshot cache, so that a cache written on a background
+# thread never holds the interpreter lock for long
+_CACHE_CHUNK = 10000
+
+# Entry in a DSU index file: byte offset and length of one message in the DSU file
+_INDEX_ENTRY = struct.Struct('<QI')
+
+# Start of the _retrievedmsgs list in a DSU file, and the separators between its messages; a key inside
+# a message's text has its quotes escaped, so only the list itself matches
+_RETRIEVED_KEY = re.compile(r'"_retrievedmsgs"\s*:\s*\[')
+_SEPARATOR = re.compile(r'[\s,]*')
 
 class DsuFileError(Exception):
     """
@@ -19,6 +58,38 @@ class DsuProfileError(Exception):
     """
     pass
 
+class Message:
+    """
+    A direct message stored in a Profile. contact is the user the message was sent to,
+    or the user it was received from when sent is false.
+    """
+    __slots__ = ('contact', 'message', 'timestamp', 'sent')
+
+    def __init__(self, contact, message, timestamp, sent):
+        self.contact = sys.intern(contact)
+        self.message = message
+        self.timestamp = timestamp
+        self.sent = sent
+
+    @classmethod
+    def from_dict(cls, msg):
+        """
+        Creates a Message from a message dictionary as stored in a DSU file.
+        """
+        if 'recipient' in msg:
+            return cls(msg['recipient'], msg['message'], msg['timestamp'], True)
+        return cls(msg['from'], msg['message'], msg['timestamp'], False)
+
+    def to_dict(self) -> dict:
+        """
+        Returns the message dictionary stored in a DSU file for this Message.
+        """
+        return {'recipient' if self.sent else 'from': self.contact,
+                'message': self.message,
+                'timestamp': self.timestamp
+                }
+
+
 class Profile:
     def __init__(self, dsuserver=None, username=None, password=None):
         '''
@@ -26,51 +97,461 @@ class Profile:
         dsuserver:str: the server to connect to
         username:str: user's username
         password:str: user's password
-        recipients:list: the contacts the user adds
-        sent_msgs:list: the direct messages the user has sent
-        new_msgs:list: the unread direct messages the user has received
-        retrievedmsgs:list: a collection of both sent and received messages, in order of time sent
+        contacts:ContactRegistry: the contacts the user adds, with their activity and unread counts
+        retrievedmsgs:list: the Messages both sent and received, in order of time sent
+        conversations:dict: the retrievedmsgs of each contact, keyed by contact name
+        token:str: the token the server gave on the last join, reused until the server rejects it
+        outbox:list: the messages queued to be sent that the server has not answered yet
+        retention:int: the messages of each contact kept in the DSU file, or None to keep every message;
+        older messages are moved to compressed archive segments next to it, see _take_archive
+        The sent and received messages are views of retrievedmsgs, see _sentmsgs and _newmsgs.
         '''
         self.dsuserver = dsuserver # REQUIRED
         self.username = username # REQUIRED
         self.password = password # REQUIRED
-        self._recipients = []   #OPTIONAL
-        self._sentmsgs = []     #OPTIONAL
-        self._newmsgs = []      #OPTIONAL
+        self.contacts = ContactRegistry()   #OPTIONAL
         self._retrievedmsgs = []    #OPTIONAL
+        self._token = None      #OPTIONAL
+        self._conversations = {}    # index of _retrievedmsgs, not saved to file
+        self._messenger = None  # session with the server, not saved to file
+        self._outbox = []       # (message, recipient) pairs queued to be sent, in order  #OPTIONAL
+        self._breaker = CircuitBreaker()    # guards the profile's sessions with the server, not saved to file
+        self.retention = None   #OPTIONAL
+        self._archive = {}      # contact -> [segment name, message count] of its archive segments, oldest first
+        self._archived = {}     # contact -> number of archived messages not yet read into its conversation
+        self._archive_cache = SegmentCache()    # recently read archive segments, not saved to file
+        self._unwritten = {}    # archive segments of a snapshot that failed to be written, by name
+        self._journalseq = 0    # sequence number of the last journal record
+        self._snapshotseq = 0   # sequence number of the last record folded into the DSU file
+        self._pending = []      # journal records not yet saved to file
+        self._saved_path = None # DSU file whose snapshot and journal match this profile
+        self._older = {}        # contact -> number of older messages not yet read from a lazily loaded DSU file
+        self._index = None      # contacts section of the DSU index file the older messages are read through
+        self._in_file = None    # messages at the start of _retrievedmsgs that are in a lazily loaded DSU file
+        self._in_snapshot = 0   # messages at the start of _retrievedmsgs that are in the DSU snapshot otherwise
+        self._msg_keys = None   # keys of every stored message, kept once sync_history has run
+        self._needs_compact = False # set when stored messages were reordered, so the journal cannot be used
+        self._merging = None    # Messages stored while a HistoryMerge runs, during which saves only append to the journal
+        self._search = None     # SearchIndex of every message, read or built on first use
+        self._write_barrier = None  # set by a ProfileWriter, waits for its writes before the journal is read
+
+    @property
+    def _recipients(self) -> list:
+        '''
+        The names of the contacts the user has added, in the order they were added
+        '''
+        return self.contacts.names()
+
+    @property
+    def _sentmsgs(self) -> list:
+        '''
+        The Messages the user has sent, in order of time sent
+        '''
+        return [msg for msg in self._retrievedmsgs if msg.sent]
+
+    @property
+    def _newmsgs(self) -> list:
+        '''
+        The Messages the user has received, in order of time received
+        '''
+        return [msg for msg in self._retrievedmsgs if not msg.sent]
+
+    def _to_dict(self) -> dict:
+        '''
+        Returns the data attributes that are saved to the DSU file, other than the messages, which are
+        written after them by _write_save
+        '''
+        return {'dsuserver': self.dsuserver,
+                'username': self.username,
+                'password': self.password,
+                '_recipients': list(self._recipients),
+                '_token': self._token,
+                '_outbox': _outbox_dicts(self._outbox),
+                '_retention': self.retention,
+                '_archive': {contact: list(manifest) for contact, manifest in self._archive.items()},
+                '_journalseq': self._journalseq
+                }
+
+    def _apply(self, record) -> None:
+        '''
+        Applies a single journal record to the data attributes
+        '''
+        if 'sent' in record or 'new' in record:
+            msg = Message.from_dict(record.get('sent') or record['new'])
+            self._retrievedmsgs.append(msg)
+            self._index_msg(msg)
+        elif 'contact' in record:
+            self.contacts.add(record['contact'])
+        elif 'token' in record:
+            self._token = record['token']
+        elif 'queue' in record:
+            self._outbox.append((record['queue']['message'], record['queue']['recipient']))
+        elif 'dequeue' in record:
+            del self._outbox[:record['dequeue']]
+
+    def _index_msg(self, msg) -> None:
+        '''
+        Adds a Message to the conversation of the contact it was sent to or received from
+        '''
+        conversation = self._conversations.get(msg.contact)
+        if conversation is None:
+            conversation = self._conversations[msg.contact] = []
+        conversation.append(msg)
+        if self._msg_keys is not None:
+            self._msg_keys.add(_msg_key(msg.contact, msg.timestamp, msg.message))
+
+    def conversation(self, contact, since=None, limit=None, start=None, stop=None) -> list:
+        '''
+        Returns the Messages sent to or received from a contact, in the order they were stored.
+        since: only messages with a later timestamp are returned
+        limit: only the last limit messages are returned
+        start, stop: only the messages at these positions of the conversation are returned, as by a slice
+        Costs time proportional to the messages returned, not to the whole profile.
+        '''
+        msgs = self._conversations.get(contact, [])
+        first, last, _ = slice(start, stop).indices(len(msgs))
+        if limit is not None:
+            first = max(first, last - limit)
+        if since is not None:
+            since = _timestamp_key(since)
+            begin = last
+            while begin > first and _timestamp_key(msgs[begin - 1].timestamp) > since:
+                begin -= 1
+            first = begin
+        return msgs[first:last]
+
+    def _record(self, kind, value) -> None:
+        '''
+        Applies a change to the data attributes and queues it to be appended to the journal on the next save
+        '''
+        self._journalseq += 1
+        record = {'n': self._journalseq, kind: value}
+        self._apply(record)
+        self._pending.append(record)
+        if kind in ('sent', 'new'):
+            if self._merging is not None:
+                self._merging.append(self._retrievedmsgs[-1])
+            contact = value.get('recipient') or value.get('from')
+            self.contacts.touch(contact, _timestamp_key(value['timestamp']), unread=kind == 'new')
+            if self._search is not None:
+                self._search_add(value, self._search)
+
+    def _refresh_activity(self) -> None:
+        '''
+        Records the latest loaded message of each conversation as the activity of its contact
+        '''
+        for contact, conversation in self._conversations.items():
+            if conversation:
+                self.contacts.touch(contact, _timestamp_key(conversation[-1].timestamp))
+
+    @metrics.timed('profile.search')
+    def search(self, query, contact=None, since=None, until=None, limit=None) -> list:
+        '''
+        Returns the (contact, timestamp) of each message containing every word of the query, most recently
+        stored first.
+        contact: only messages sent to or received from this contact
+        since, until: only messages with a timestamp in this range
+        limit: at most this many hits
+        The search index is kept next to the DSU file and read, or built, on the first search.
+        '''
+        return self._get_search().search(query, contact, since, until, limit)
+
+    def find_msg(self, contact, timestamp):
+        '''
+        Returns the index in the contact's conversation of the message with the given timestamp, as returned
+        by search, reading older messages with load_older until it is found. Returns None if there is none.
+        '''
+        # Only the messages read by each load_older are searched, as they are put before the others
+        unseen = None
+        while True:
+            conversation = self.conversation(contact, stop=unseen)
+            for i in range(len(conversation) - 1, -1, -1):
+                if _timestamp_key(conversation[i].timestamp) == timestamp:
+                    return i
+            if not self.has_older(contact):
+                return None
+            unseen = self.load_older(contact)
+
+    def _get_search(self) -> SearchIndex:
+        '''
+        Returns the search index, reading it from the DSU file's search index file on first use.
+        The file matches the DSU snapshot; messages saved to the journal since, or not saved yet, are
+        added from the journal and the pending records. Without a matching file, the index is built from
+        the messages in memory, or from the DSU file if it was loaded lazily, after the archived messages.
+        '''
+        if self._search is not None:
+            return self._search
+        if self._write_barrier is not None:
+            self._write_barrier()
+        p = self._saved_path
+        index = None
+        # Once messages were reordered the journal no longer brings the file up to date
+        if p is not None and not self._needs_compact:
+            index = SearchIndex.load(_search_path(p), self._snapshotseq)
+        if index is None and self._in_file is None:
+            index = self._search = SearchIndex()
+            for msg in self._archived_dicts():
+                self._search_add(msg, index)
+            for msg in self._retrievedmsgs:
+                index.add(msg.contact, _timestamp_key(msg.timestamp), msg.message)
+            return index
+        if index is None:
+            index = SearchIndex()
+            for msg in self._archived_dicts():
+                self._search_add(msg, index)
+            with open(p, 'r') as f:
+                for msg in json.load(f)['_retrievedmsgs']:
+                    self._search_add(msg, index)
+        last = self._snapshotseq
+        if p is not None and os.path.exists(_journal_path(p)):
+            with open(_journal_path(p), 'rb') as f:
+                for line in f:
+                    # A record being appended by the ProfileWriter is also one of the pending records
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if last < record['n'] <= self._journalseq:
+                        last = record['n']
+                        if 'sent' in record or 'new' in record:
+                            self._search_add(record.get('sent') or record['new'], index)
+        # Pending records already appended to the journal are skipped
+        for record in self._pending:
+            if record['n'] > last and ('sent' in record or 'new' in record):
+                self._search_add(record.get('sent') or record['new'], index)
+        self._search = index
+        return index
+
+    def _search_add(self, msg, index) -> None:
+        '''
+        Adds a message dictionary to a search index
+        '''
+        msg = Message.from_dict(msg)
+        index.add(msg.contact, _timestamp_key(msg.timestamp), msg.message)
 
-    def send_msg(self, message, recipient) -> None:
+    def _get_messenger(self) -> DirectMessenger:
         '''
-        Sends a direct message to a user, and stores this message in a dictionary, appending to the _sentmsgs lists
+        Returns the profile's long-lived DirectMessenger, joining the server on first use
         '''
-        dmr = DirectMessenger(self.dsuserver, self.username, self.password)
-        dmr.send(message, recipient)
-        dm_dict = {'recipient': dmr.dm_obj.recipient,
-                   'message': dmr.dm_obj.message,
-                   'timestamp': dmr.dm_obj.timestamp
+        if self._messenger is None:
+            self._messenger = DirectMessenger(self.dsuserver, self.username, self.password, self._token,
+                                              breaker=self._breaker)
+        return self._messenger
+
+    def set_token(self, token) -> None:
+        '''
+        Stores the token the server gave on a join, to be saved with the profile and reused by later sessions
+        '''
+        if token is not None and token != self._token:
+            self._record('token', token)
+
+    def close(self) -> None:
+        '''
+        Closes the profile's session with the server, if one is open
+        '''
+        if self._messenger is not None:
+            self.set_token(self._messenger.token)
+            self._messenger.close()
+            self._messenger = None
+
+    def send_msg(self, message, recipient) -> bool:
+        '''
+        Sends a direct message to a user, and stores this message, appending to the _retrievedmsgs list.
+        The message is queued first, after any messages still waiting in the outbox, and stays queued if
+        the server cannot be reached. Returns true if it was sent.
+        '''
+        self.queue_msg(message, recipient)
+        report = self.flush_outbox()
+        return bool(report) and report[-1][2]
+
+    def queue_msg(self, message, recipient) -> None:
+        '''
+        Adds a direct message to the outbox, to be sent by the next flush_outbox.
+        The outbox is saved with the profile, so queued messages survive a restart.
+        '''
+        self._record('queue', {'recipient': recipient, 'message': message})
+
+    def pending_outbox(self) -> list:
+        '''
+        Returns the (message, recipient) pairs waiting in the outbox, in the order they were queued.
+        '''
+        return list(self._outbox)
+
+    def flush_outbox(self) -> list:
+        '''
+        Sends every message in the outbox over one connection without waiting for each reply, and
+        stores the messages the server accepted. Returns a list of (message, recipient, sent) tuples,
+        in the order the messages were queued, where sent is false for each message that failed.
+        Messages the server refused are dropped from the outbox; messages it never answered, because
+        it could not be reached, stay in the outbox in order, to be sent by the next flush.
+        '''
+        outbox = self.pending_outbox()
+        if not outbox:
+            return []
+        dmr = self._get_messenger()
+        results = dmr.send_batch(outbox)
+        return self.outbox_sent(outbox, results, dmr.answered)
+
+    def outbox_sent(self, outbox, results, answered) -> list:
+        '''
+        Applies the outcome of sending outbox, the messages at the start of the outbox, as returned by
+        DirectMessenger.send_batch and its answered count: stores the messages the server accepted and
+        removes the answered messages from the outbox. Returns the report described in flush_outbox.
+        Lets the outbox be sent on another thread; nothing may be removed from the outbox meanwhile.
+        '''
+        report = []
+        for (message, recipient), dm_obj in zip(outbox, results):
+            if dm_obj is not None:
+                self.store_sent_msg(dm_obj)
+            report.append((message, recipient, dm_obj is not None))
+        if answered:
+            self._record('dequeue', answered)
+        if answered < len(outbox):
+            log.warning("Messages kept in outbox.", extra={'op': 'flush_outbox', 'queued': len(self._outbox)})
+        return report
+
+    def store_sent_msg(self, dm_obj) -> None:
+        '''
+        Stores a DirectMessage the user has sent, appending to the _retrievedmsgs list
+        '''
+        dm_dict = {'recipient': dm_obj.recipient,
+                   'message': dm_obj.message,
+                   'timestamp': dm_obj.timestamp
                    }
-        self._sentmsgs.append(dm_dict)
-        print(dm_dict)
-        self._retrievedmsgs.append(dm_dict)
-        
-    def new_msg(self) -> None:
+        log.debug("Message sent.", extra={'op': 'store_sent', 'dm': dm_dict})
+        self._record('sent', dm_dict)
+
+    def add_contact(self, recipient) -> bool:
+        '''
+        Adds a contact to the contacts registry. Returns false, recording nothing, if it is already a contact.
+        '''
+        if recipient in self.contacts:
+            return False
+        self._record('contact', recipient)
+        conversation = self.conversation(recipient, limit=1)
+        if conversation:
+            self.contacts.touch(recipient, _timestamp_key(conversation[-1].timestamp))
+        return True
+
+    def mark_read(self, recipient) -> bool:
+        '''
+        Clears the unread count of a contact. Returns true if it had unread messages.
+        Unread counts are kept while the profile is open and are not saved to the DSU file.
         '''
-        Retrieves an unread message from another user, and stores this message in a dictionary, appending to the _newmsgs lists
+        return self.contacts.mark_read(recipient)
+
+    def new_msg(self) -> list:
+        '''
+        Retrieves the unread messages from other users over the profile's session, and stores them, appending
+        to the _retrievedmsgs list. Returns the list of DirectMessages, or None if the retrieve failed.
         '''
-        dmr = DirectMessenger(self.dsuserver, self.username, self.password)
+        dmr = self._get_messenger()
         newmsg_list = dmr.retrieve_new()
+        if newmsg_list is not None:
+            self.store_new_msgs(newmsg_list)
+        return newmsg_list
+
+    def store_new_msgs(self, newmsg_list) -> None:
+        '''
+        Stores DirectMessages received from other users, appending to the _retrievedmsgs list
+        '''
         for i in range(0, len(newmsg_list)):
+            # After a sync, messages already merged from the server's history must not be stored twice
+            if self._msg_keys is not None and _msg_key(newmsg_list[i].recipient, newmsg_list[i].timestamp,
+                                                       newmsg_list[i].message) in self._msg_keys:
+                continue
             dm_dict = {'from': newmsg_list[i].recipient,
                        'message': newmsg_list[i].message,
                        'timestamp': newmsg_list[i].timestamp
                        }
-            self._newmsgs.append(dm_dict)
-            print(dm_dict)
-            self._retrievedmsgs.append(dm_dict)
+            log.debug("Message received.", extra={'op': 'store_new', 'dm': dm_dict})
+            self._record('new', dm_dict)
 
+    def sync_history(self, batch_size=None) -> dict:
+        '''
+        Retrieves every message the server holds for the user and merges it into the profile, see merge_history
+        '''
+        return self.merge_history(self._get_messenger().iter_all_batches(batch_size))
+
+    def merge_history(self, batches) -> dict:
+        '''
+        Merges messages retrieved from the server's history into the profile. batches yields lists of
+        DirectMessages, with None as the last item if the retrieve failed part way. Messages are matched
+        by (contact, timestamp, message) through a hash index of the stored messages, so merging is
+        linear and repeating it adds nothing. Merged messages are put in order of time sent, and the
+        next save_profile writes a full snapshot.
+        Returns the number of messages received and added, whether the retrieve completed, and the
+        seconds spent on each phase: index, fetch, merge and sort.
+        The merge runs on a HistoryMerge; see start_merge to merge without waiting for it.
+        '''
+        merge = self.start_merge()
+        ok = True
+        for batch in batches:
+            if batch is None:
+                ok = False
+                break
+            merge.add(batch)
+        merge.finish(ok)
+        merge.wait()
+        return self.apply_merge(merge)
+
+    def start_merge(self) -> 'HistoryMerge':
+        '''
+        Starts merging messages from the server's history into the profile on a background thread, as
+        merge_history does. The caller hands each batch to the returned HistoryMerge as it arrives, and
+        calls apply_merge once the merge is done. Until then the profile can keep changing, but saves
+        only append to the journal.
+        '''
+        if self._write_barrier is not None:
+            self._write_barrier()
+        if self._in_file is not None and self._file_index() is None:
+            self._load_all()
+        merge = HistoryMerge(self)
+        self._merging = []
+        return merge
+
+    def apply_merge(self, merge) -> dict:
+        '''
+        Puts the outcome of a finished HistoryMerge in place: the merged messages, in order of time sent,
+        followed by the messages stored since the merge started that were not merged from the server.
+        Costs time proportional to the messages stored since and to the contacts, not to the history.
+        Returns the statistics described in merge_history.
+        '''
+        since, self._merging = self._merging or [], None
+        stats = merge.stats
+        if merge.keys is None:
+            return stats
+        keys = merge.keys
+        kept = [msg for msg in since if _msg_key(msg.contact, msg.timestamp, msg.message) not in keys]
+        # A message stored since the merge started and merged from the server as well is only kept once
+        stats['added'] -= len(since) - len(kept)
+        for msg in kept:
+            merge.search.add(msg.contact, _timestamp_key(msg.timestamp), msg.message)
+        self._search = merge.search
+        if merge.msgs is not None:
+            self._retrievedmsgs = merge.msgs
+            self._conversations = merge.conversations
+            self._msg_keys = None
+            for msg in kept:
+                self._retrievedmsgs.append(msg)
+                self._index_msg(msg)
+            self._set_archive({})
+            self._older = {}
+            self._index = None
+            self._in_file = None
+            self._needs_compact = True
+            self._refresh_activity()
+        keys.update(_msg_key(msg.contact, msg.timestamp, msg.message) for msg in kept)
+        self._msg_keys = keys
+        return stats
+
+    @metrics.timed('profile.save')
     def save_profile(self, path: str) -> None:
         """
         save_profile accepts an existing dsu file to save the current instance of Profile to the file system.
+        Changes since the last save are appended to a journal file next to the DSU file; the journal is
+        folded into the DSU file once it holds JOURNAL_COMPACT_RECORDS records, or when saving to a new file.
+        Nothing is written if nothing changed. See ProfileWriter to save in the background instead.
         Example usage:
         profile = Profile()
         profile.save_profile('/path/to/file.dsu')
@@ -78,18 +559,110 @@ class Profile:
         """
         p = Path(path)
         if os.path.exists(p) and p.suffix == '.dsu':
+            job = self._take_save(p)
+            if job is None:
+                return
             try:
-                f = open(p, 'w')
-                json.dump(self.__dict__, f)
-                f.close()
+                _write_save(job, FSYNC_ALWAYS)
             except Exception as ex:
+                self._untake_save(job)
                 raise DsuFileError("An error occurred while attempting to process the DSU file.", ex)
         else:
             raise DsuFileError("Invalid DSU file path or type")
 
-    def load_profile(self, path: str) -> None:
+    @metrics.timed('profile.compact')
+    def compact(self, path: str) -> None:
+        """
+        Writes the whole profile to the DSU file and removes its journal.
+        The snapshot is written to a temporary file and renamed over the DSU file, so a crash
+        leaves either the old snapshot and journal or the new snapshot in place.
+        An index of where each contact's messages sit in the snapshot is written next to it.
+        """
+        job = self._take_snapshot(Path(path))
+        try:
+            _write_save(job, FSYNC_ALWAYS)
+        except Exception:
+            self._untake_save(job)
+            raise
+
+    def _take_save(self, p):
+        """
+        Takes the changes to be saved to the DSU file at p, as a job for _write_save: a snapshot of the
+        whole profile, or the journal records added since the last save. Returns None if nothing changed.
+        The profile counts the changes as saved from here on; only references are copied, so the job can
+        be written on another thread while the profile keeps changing.
+        """
+        if self._messenger is not None:
+            self.set_token(self._messenger.token)
+        # A HistoryMerge reads the snapshot and the journal, so the snapshot waits until it is applied
+        if self._saved_path != p or (self._merging is None and (self._needs_compact or
+                                     self._journalseq - self._snapshotseq >= JOURNAL_COMPACT_RECORDS)):
+            return self._take_snapshot(p)
+        if not self._pending:
+            return None
+        records, self._pending = self._pending, []
+        return {'kind': 'append', 'path': p, 'records': records}
+
+    def _take_snapshot(self, p) -> dict:
+        """
+        Takes the whole profile as a snapshot job for _write_save.
+        The messages of a lazily loaded profile that are in its DSU file are not read: the job copies them
+        from the file through its index, and takes only the messages added since from memory. Unless the
+        search index is in memory, the writer reads the search index file of the last snapshot and adds the
+        messages stored since, or builds the index if there is no such file.
+        """
+        if self._in_file is not None and self._file_index() is None:
+            # The files on disk are not those the profile was loaded from, as when a snapshot failed to be written
+            self._load_all()
+        copy = None
+        if self._in_file is not None:
+            copy = {'path': self._saved_path, 'offset': self._index[1], 'seq': self._snapshotseq,
+                    'ranges': {contact: list(entries) for contact, entries in self._index[0].items()}}
+        search = self._search
+        added = self._retrievedmsgs[self._in_file or self._in_snapshot:] if search is None else []
+        search_from = None
+        # Once messages were reordered the messages added since the snapshot are not the last ones
+        if search is None and self._saved_path is not None and not self._needs_compact:
+            search_from = (self._saved_path, self._snapshotseq)
+        segments = self._take_archive(copy and copy['ranges']) if self.retention is not None else {}
+        segments, self._unwritten = dict(self._unwritten, **segments), {}
+        job = {'kind': 'snapshot', 'path': p, 'header': self._to_dict(),
+               'msgs': self._retrievedmsgs[self._in_file or 0:], 'copy': copy,
+               'search': search, 'search_count': len(search) if search is not None else 0, 'added': added,
+               'search_from': search_from, 'records': self._pending, 'segments': segments,
+               'archive_from': archive_dir(self._saved_path) if self._saved_path is not None else None}
+        if self._in_file is not None:
+            # The index is read again once the writer has written it
+            self._in_file = len(self._retrievedmsgs)
+            self._index = None
+        self._in_snapshot = len(self._retrievedmsgs)
+        self._pending = []
+        self._saved_path = p
+        self._snapshotseq = self._journalseq
+        self._needs_compact = False
+        return job
+
+    def _untake_save(self, job) -> None:
+        """
+        Puts the changes of a job that failed to be written back, so the next save writes them.
+        """
+        if job['kind'] == 'snapshot':
+            self._needs_compact = True
+            self._unwritten.update({name: [msg if isinstance(msg, dict) else msg.to_dict() for msg in msgs]
+                                    for name, msgs in job['segments'].items()})
+        self._pending = job['records'] + self._pending
+
+    @metrics.timed('profile.load')
+    def load_profile(self, path: str, recent=None) -> None:
         """
-        load_profile will populate the current instance of Profile with data stored in a DSU file.
+        load_profile will populate the current instance of Profile with data stored in a DSU file,
+        followed by any changes saved to its journal since.
+        If recent is given, only the last recent messages of each contact are read, through the index
+        file kept next to the DSU file, and older messages are read on demand by load_older. Without a
+        valid index the whole file is read once and the index is written.
+        A whole file is read from its snapshot cache if the cache matches it. A lazy load has no use for
+        the cache, and a snapshot taken of a lazily loaded profile is written without one, since its
+        messages are not in memory; the next whole read of the file writes the cache again.
         Example usage: 
         profile = Profile()
         profile.load_profile('/path/to/file.dsu')
@@ -99,46 +672,1048 @@ class Profile:
 
         if os.path.exists(p) and p.suffix == '.dsu':
             try:
-                f = open(p, 'r')
-                obj = json.load(f)
-                self.username = obj['username']
-                self.password = obj['password']
-                self.dsuserver = obj['dsuserver']
-                    
-                for recipient in obj['_recipients']:
-                    self._recipients.append(recipient)
-
-                for msg in obj['_sentmsgs']:
-                    dm_dict = {'recipient': msg['recipient'],
-                               'message': msg['message'],
-                               'timestamp': msg['timestamp']
-                               }
-                    self._sentmsgs.append(dm_dict)
-        
-                for msg in obj['_newmsgs']:
-                    dm_dict = {'from': msg['from'],
-                               'message': msg['message'],
-                               'timestamp': msg['timestamp']
-                               }
-                    self._newmsgs.append(dm_dict)
-
-                for msg in obj['_retrievedmsgs']:
-                    if 'recipient' in msg.keys():
-                        dm_dict = {'recipient': msg['recipient'],
-                                   'message': msg['message'],
-                                   'timestamp': msg['timestamp']
-                                   }
-                        self._retrievedmsgs.append(dm_dict)
-
-                    if 'from' in msg.keys():
-                        dm_dict = {'from': msg['from'],
-                                   'message': msg['message'],
-                                   'timestamp': msg['timestamp']
-                                   }
-                        self._retrievedmsgs.append(dm_dict)
-                        
-                f.close()
+                lazy = recent is not None and self._load_recent(p, recent)
+                if not lazy:
+                    self._load_snapshot(p)
+                    if recent is not None:
+                        self._index_snapshot(p)
+                self._replay_journal(p)
+                self._refresh_activity()
+                self._saved_path = p
             except Exception as ex:
                 raise DsuProfileError(ex)
         else:
             raise DsuFileError()
+
+    def _load_snapshot(self, p) -> None:
+        """
+        Reads every field of a DSU snapshot, from its snapshot cache if the cache matches it.
+        Otherwise the JSON is parsed and the cache is written for the next time.
+        """
+        if self._load_cache(p):
+            self._in_snapshot = len(self._retrievedmsgs)
+            return
+        f = open(p, 'r')
+        obj = json.load(f)
+        self.username = obj['username']
+        self.password = obj['password']
+        self.dsuserver = obj['dsuserver']
+        self._token = obj.get('_token')
+        self._outbox = _outbox_pairs(obj.get('_outbox', []))
+        self.retention = obj.get('_retention')
+        self._set_archive(obj.get('_archive', {}))
+
+        for recipient in obj['_recipients']:
+            self.contacts.add(recipient)
+
+        # _retrievedmsgs holds every message; _sentmsgs and _newmsgs are only written for older readers
+        with _gc_paused():
+            for msg in obj['_retrievedmsgs']:
+                self._retrievedmsgs.append(Message.from_dict(msg))
+
+        f.close()
+        for msg in self._retrievedmsgs:
+            self._index_msg(msg)
+        self._in_snapshot = len(self._retrievedmsgs)
+        self._journalseq = obj.get('_journalseq', 0)
+        self._snapshotseq = self._journalseq
+        _try_write_cache(p, self._to_dict(), self._retrievedmsgs, 'load')
+
+    def _index_snapshot(self, p) -> None:
+        """
+        Writes the index file of the DSU snapshot just read, finding where each message sits by scanning
+        the file, so the next load can read only the recent messages. The snapshot itself is not rewritten.
+        """
+        try:
+            found = _scan_entries(p)
+            if len(found) != len(self._retrievedmsgs):
+                raise ValueError("Messages in the file do not match the messages read.")
+            entries = {}
+            for msg, (offset, length) in zip(self._retrievedmsgs, found):
+                entries.setdefault(msg.contact, bytearray()).extend(_INDEX_ENTRY.pack(offset, length))
+            _write_index(p, self._to_dict(), entries)
+        except (OSError, ValueError) as ex:
+            log.warning("Index not written.", extra={'op': 'load', 'path': str(p), 'error': str(ex)})
+
+    def _load_cache(self, p) -> bool:
+        """
+        Reads a DSU snapshot from its snapshot cache: the parsed fields, the messages in columns and the
+        position of each contact's messages. Returns false, having read nothing, if there is no cache, if
+        it is damaged, or if the DSU file's size, mtime or content hash differ from those the cache was
+        written for. The key is checked before anything else in the cache is read.
+        """
+        cp = _cache_path(p)
+        if not os.path.exists(cp):
+            return False
+        st = os.stat(p)
+        try:
+            with open(cp, 'rb') as f:
+                state = json.loads(f.readline())
+                if (state.get('version') != SNAPSHOT_CACHE_VERSION or state['byteorder'] != sys.byteorder
+                        or state['size'] != st.st_size or state['mtime_ns'] != st.st_mtime_ns
+                        or state['sha1'] != _file_hash(p)):
+                    return False
+                count = state['count']
+                state['contact_ids'] = _read_array(f, 'I', count)
+                state['sent'] = f.read(count)
+                positions = _read_array(f, 'I', count)
+                lengths = _read_array(f, 'I', count)
+                if state['timestamps'] == 'd':
+                    state['timestamps'] = _read_array(f, 'd', count).tolist()
+                else:
+                    state['timestamps'] = json.loads(f.read(state['timestamps']))
+                text = f.read().decode('utf-8', 'surrogatepass')
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+        offsets = list(itertools.accumulate(lengths, initial=0))
+        if len(state['sent']) != count or len(state['timestamps']) != count or offsets[-1] != len(text):
+            return False
+        contacts = state['contacts']
+        with _gc_paused():
+            try:
+                msgs = list(map(Message, [contacts[i] for i in state['contact_ids']],
+                                [text[start:stop] for start, stop in zip(offsets, offsets[1:])],
+                                state['timestamps'], map(bool, state['sent'])))
+                conversations = {}
+                start = 0
+                for contact, size in zip(contacts, state['sizes']):
+                    conversations[contact] = [msgs[i] for i in positions[start:start + size]]
+                    start += size
+            except IndexError:
+                return False
+        header = state['header']
+        self.username = header['username']
+        self.password = header['password']
+        self.dsuserver = header['dsuserver']
+        self._token = header['_token']
+        self._outbox = _outbox_pairs(header.get('_outbox', []))
+        self.retention = header.get('_retention')
+        self._set_archive(header.get('_archive', {}))
+        for recipient in header['_recipients']:
+            self.contacts.add(recipient)
+        self._retrievedmsgs.extend(msgs)
+        self._conversations.update(conversations)
+        self._journalseq = header['_journalseq']
+        self._snapshotseq = self._journalseq
+        return True
+
+    def _load_recent(self, p, recent) -> bool:
+        """
+        Reads the header fields of a DSU snapshot and the last recent messages of each contact through
+        its index file. Returns false, having read nothing, if there is no index that matches the snapshot.
+        """
+        ip = _index_path(p)
+        if not os.path.exists(ip):
+            return False
+        entries = []
+        with open(ip, 'rb') as f:
+            header = json.loads(f.readline())
+            st = os.stat(p)
+            if header['size'] != st.st_size or header['mtime_ns'] != st.st_mtime_ns:
+                return False
+            self._index = (header['contacts'], f.tell())
+            for contact, (first, count) in header['contacts'].items():
+                older = max(count - recent, 0)
+                self._older[contact] = older
+                entries.extend(self._read_index(f, first + older, count - older))
+        self.username = header['username']
+        self.password = header['password']
+        self.dsuserver = header['dsuserver']
+        self._token = header.get('_token')
+        self._outbox = _outbox_pairs(header.get('_outbox', []))
+        self.retention = header.get('_retention')
+        self._set_archive(header.get('_archive', {}))
+        for recipient in header['_recipients']:
+            self.contacts.add(recipient)
+        self._journalseq = header['_journalseq']
+        self._snapshotseq = self._journalseq
+
+        # Offsets follow the order of _retrievedmsgs, so sorting restores the order of time sent
+        entries.sort()
+        for msg in self._read_msgs(p, entries):
+            self._retrievedmsgs.append(msg)
+            self._index_msg(msg)
+        self._older = {contact: older for contact, older in self._older.items() if older}
+        self._in_file = len(self._retrievedmsgs)
+        return True
+
+    def _file_index(self) -> dict:
+        """
+        Returns the contacts section of the index file of a lazily loaded DSU file, reading it again if a
+        snapshot was taken since, once the ProfileWriter has written it. Returns None if the files on disk
+        do not match the profile, as when a snapshot failed to be written.
+        """
+        if self._index is None:
+            if self._write_barrier is not None:
+                self._write_barrier()
+            try:
+                with open(_index_path(self._saved_path), 'rb') as f:
+                    header = json.loads(f.readline())
+                    offset = f.tell()
+                st = os.stat(self._saved_path)
+            except (OSError, ValueError):
+                return None
+            if (header['size'] != st.st_size or header['mtime_ns'] != st.st_mtime_ns
+                    or header['_journalseq'] != self._snapshotseq):
+                return None
+            self._index = (header['contacts'], offset)
+        return self._index[0]
+
+    def _read_index(self, f, start, count) -> list:
+        """
+        Returns count (offset, length) entries of the open DSU index file f, starting at entry start.
+        """
+        f.seek(self._index[1] + start * _INDEX_ENTRY.size)
+        return list(_INDEX_ENTRY.iter_unpack(f.read(count * _INDEX_ENTRY.size)))
+
+    @metrics.timed('profile.load_older')
+    def load_older(self, contact, count=HISTORY_PAGE_SIZE) -> int:
+        """
+        Reads up to count older messages of a contact from a lazily loaded DSU file, adding them to
+        the start of the contact's conversation. Once every message of the contact in the DSU file has
+        been read, reads from its archive segments instead. Returns the number of messages added.
+        """
+        older = self._older.get(contact, 0)
+        if not older:
+            return self._load_archived(contact, count)
+        index = self._file_index()
+        if index is None:
+            raise DsuFileError("The DSU index file does not match the profile.")
+        first = index[contact][0]
+        start = max(older - count, 0)
+        with open(_index_path(self._saved_path), 'rb') as f:
+            entries = self._read_index(f, first + start, older - start)
+        msgs = self._read_msgs(self._saved_path, entries)
+        self._conversations[contact] = msgs + self._conversations.get(contact, [])
+        if start:
+            self._older[contact] = start
+        else:
+            del self._older[contact]
+        return len(msgs)
+
+    def has_older(self, contact) -> bool:
+        """
+        Returns true if the contact has older messages that load_older can read.
+        """
+        return contact in self._older or contact in self._archived
+
+    def set_retention(self, retention) -> None:
+        """
+        Sets the number of messages of each contact kept in the DSU file, or None to keep every message.
+        The next save writes a snapshot, moving older messages to the archive.
+        """
+        self.retention = retention
+        self._needs_compact = True
+
+    def release_archived(self, contact=None) -> int:
+        """
+        Drops the archived messages read into a contact's conversation, or into every conversation if
+        contact is None, so that only the messages kept in the DSU file stay in memory. load_older reads
+        them again on demand. Returns the number of messages dropped.
+        """
+        released = 0
+        for contact in [contact] if contact is not None else list(self._archive):
+            total = sum(count for _, count in self._archive.get(contact, []))
+            loaded = total - self._archived.get(contact, 0)
+            if loaded:
+                del self._conversations[contact][:loaded]
+                self._archived[contact] = total
+                released += loaded
+        return released
+
+    def _set_archive(self, archive) -> None:
+        """
+        Replaces the archive segments of the profile, with none of their messages read into conversations.
+        """
+        self._archive = archive
+        self._archived = {contact: sum(count for _, count in manifest)
+                          for contact, manifest in archive.items() if manifest}
+
+    def _load_archived(self, contact, count) -> int:
+        """
+        Reads up to count of the newest archived messages of a contact not read yet, adding them to the
+        start of the contact's conversation. Returns the number of messages added.
+        """
+        archived = self._archived.get(contact, 0)
+        if not archived:
+            return 0
+        start = max(archived - count, 0)
+        msgs = [Message.from_dict(msg) for msg in self._read_archive(contact, start, archived)]
+        self._conversations[contact] = msgs + self._conversations.get(contact, [])
+        if start:
+            self._archived[contact] = start
+        else:
+            del self._archived[contact]
+        return len(msgs)
+
+    def _read_archive(self, contact, start, stop) -> list:
+        """
+        Returns the message dictionaries of a contact's archive from position start up to stop, counting
+        from its oldest archived message, reading only the segments that hold them.
+        """
+        msgs = []
+        first = 0
+        for name, count in self._archive.get(contact, []):
+            if first >= stop:
+                break
+            if first + count > start:
+                msgs.extend(self._segment(name)[max(start - first, 0):stop - first])
+            first += count
+        return msgs
+
+    def _segment(self, name) -> list:
+        """
+        Returns the message dictionaries of an archive segment of the DSU file, through the segment cache.
+        A segment taken by a snapshot that the ProfileWriter has not written yet is waited for.
+        """
+        if name in self._unwritten:
+            return self._unwritten[name]
+        path = archive_dir(self._saved_path) / name
+        try:
+            return self._archive_cache.get(path)
+        except FileNotFoundError:
+            if self._write_barrier is None:
+                raise
+            self._write_barrier()
+            return self._archive_cache.get(path)
+
+    def _archived_dicts(self):
+        """
+        Yields the message dictionaries of every archive segment, each contact's oldest first.
+        """
+        for manifest in self._archive.values():
+            for name, _ in manifest:
+                yield from self._segment(name)
+
+    def _take_archive(self, ranges=None) -> dict:
+        """
+        Moves the messages of each contact older than its newest retention messages out of _retrievedmsgs,
+        into new archive segments of up to ARCHIVE_SEGMENT_SIZE messages. A contact's last segment is
+        merged with them if it is not full, and replaced. The moved messages stay in their conversations
+        until release_archived. Returns the new segments, as lists of messages by name, which the writer
+        turns into message dictionaries.
+        For a lazily loaded profile, ranges holds the [first, count] index entries of each contact's
+        messages in the DSU file. The oldest are read from the file, moved and dropped from ranges; those
+        not read into the conversation yet are left to be read from the archive by load_older.
+        """
+        ranges = ranges or {}
+        start = self._in_file or 0
+        counts = {contact: count for contact, (_, count) in ranges.items()}
+        in_memory = {}
+        if self._in_file is None:
+            # Each conversation holds the contact's messages in _retrievedmsgs after those read from the archive
+            for contact, conversation in self._conversations.items():
+                loaded = sum(count for _, count in self._archive.get(contact, [])) - self._archived.get(contact, 0)
+                counts[contact] = len(conversation) - loaded
+        else:
+            for i, msg in enumerate(self._retrievedmsgs):
+                if i >= start:
+                    counts[msg.contact] = counts.get(msg.contact, 0) + 1
+                else:
+                    in_memory[msg.contact] = in_memory.get(msg.contact, 0) + 1
+        excess = {contact: n - self.retention for contact, n in counts.items() if n > self.retention}
+        if not excess:
+            return {}
+        moved = {}
+        from_head = {}  # contact -> messages to move from the part of _retrievedmsgs in the DSU file
+        from_rest = {}  # contact -> messages to move from the messages added since
+        for contact, n in excess.items():
+            first, count = ranges.get(contact, (0, 0))
+            from_file = min(n, count)
+            moved[contact] = []
+            if from_file:
+                with open(_index_path(self._saved_path), 'rb') as f:
+                    entries = self._read_index(f, first, from_file)
+                moved[contact] = self._read_msgs(self._saved_path, entries)
+                ranges[contact] = [first + from_file, count - from_file]
+                older = self._older.get(contact, 0)
+                unread = min(from_file, older)
+                if unread:
+                    # Nothing is read from the archive before the older messages in the file, so these stay in order
+                    self._archived[contact] = self._archived.get(contact, 0) + unread
+                    if older > unread:
+                        self._older[contact] = older - unread
+                    else:
+                        del self._older[contact]
+            from_head[contact] = max(from_file - (count - in_memory.get(contact, 0)), 0)
+            from_rest[contact] = n - from_file
+        head_moved = sum(from_head.values())
+        kept = []
+        for i, msg in enumerate(self._retrievedmsgs):
+            moving = from_head if i < start else from_rest
+            left = moving.get(msg.contact)
+            if not left:
+                kept.append(msg)
+                continue
+            moving[msg.contact] = left - 1
+            # Messages moved from the part in the DSU file were read from the file above
+            if moving is from_rest:
+                moved[msg.contact].append(msg)
+        self._retrievedmsgs = kept
+        if self._in_file is not None:
+            self._in_file = start - head_moved
+        segments = {}
+        for contact, msgs in moved.items():
+            manifest = self._archive.setdefault(contact, [])
+            if manifest and manifest[-1][1] < ARCHIVE_SEGMENT_SIZE:
+                msgs = [Message.from_dict(msg) for msg in self._segment(manifest.pop()[0])] + msgs
+            for i in range(0, len(msgs), ARCHIVE_SEGMENT_SIZE):
+                chunk = msgs[i:i + ARCHIVE_SEGMENT_SIZE]
+                name = segment_name(contact)
+                manifest.append([name, len(chunk)])
+                segments[name] = chunk
+        metrics.count('profile.archived', sum(excess.values()))
+        return segments
+
+    def _read_msgs(self, p, entries) -> list:
+        """
+        Reads the Messages at the given (offset, length) entries of a DSU snapshot.
+        """
+        msgs = []
+        with open(p, 'rb') as f:
+            for offset, length in entries:
+                f.seek(offset)
+                msgs.append(Message.from_dict(json.loads(f.read(length))))
+        return msgs
+
+    def _load_all(self) -> None:
+        """
+        Reads the whole history of a lazily loaded profile, keeping changes not yet saved.
+        """
+        if self._write_barrier is not None:
+            self._write_barrier()
+        pending = self._pending
+        self._outbox = []
+        self._retrievedmsgs = []
+        self._conversations = {}
+        self._older = {}
+        self._index = None
+        self._in_file = None
+        self._load_snapshot(self._saved_path)
+        self._replay_journal(self._saved_path)
+        for record in pending:
+            self._apply(record)
+            self._journalseq = record['n']
+        self._pending = pending
+
+    def _replay_journal(self, p, until=None) -> None:
+        """
+        Applies the journal records saved after the DSU snapshot. A record left half-written by a
+        crash ends the journal and is cut off so that later appends start on a clean line.
+        If until is given, only records up to that sequence number are applied and nothing is cut off,
+        as another thread may be appending to the journal.
+        """
+        jp = _journal_path(p)
+        if not os.path.exists(jp):
+            return
+        good = 0
+        with open(jp, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good += len(line)
+                if until is not None and record['n'] > until:
+                    return
+                if record['n'] > self._journalseq:
+                    self._apply(record)
+                    self._journalseq = record['n']
+        if until is None and good < os.path.getsize(jp):
+            os.truncate(jp, good)
+
+
+class ProfileWriter:
+    """
+    Saves a profile to a DSU file on a background thread. The thread that owns the profile calls
+    mark_dirty after each change and tick regularly; once delay seconds have passed since the first
+    change of a burst, tick takes the changes from the profile, copying only references, and hands
+    them to the writer thread, so a burst of changes is written once and the owner never waits on
+    the disk. The files are written as save_profile writes them, with the fsync policy given.
+    A failed write is logged and retried every SAVE_RETRY_INTERVAL seconds.
+    Raises DsuFileError if path is not an existing DSU file.
+    """
+    def __init__(self, profile, path, delay=SAVE_DELAY, fsync=FSYNC_ALWAYS):
+        p = Path(path)
+        if not os.path.exists(p) or p.suffix != '.dsu':
+            raise DsuFileError("Invalid DSU file path or type")
+        self.profile = profile
+        self.path = p
+        self.delay = delay
+        self.fsync = fsync
+        self._dirty_since = None
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='ds-writer', daemon=True)
+        self._thread.start()
+        profile._write_barrier = self.wait
+
+    def mark_dirty(self) -> None:
+        '''
+        Records that the profile changed, starting the delay if it is not running.
+        '''
+        if self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+
+    def tick(self) -> bool:
+        '''
+        Hands the changes to the writer thread if the delay has passed. Returns true if a write was queued.
+        '''
+        if self._dirty_since is None or time.monotonic() - self._dirty_since < self.delay:
+            return False
+        return self.flush(wait=False)
+
+    def flush(self, wait=True) -> bool:
+        '''
+        Hands the changes to the writer thread now, and waits until they are written if wait is true.
+        Returns true if there was anything to write.
+        '''
+        self._dirty_since = None
+        job = self.profile._take_save(self.path)
+        if job is not None:
+            self._jobs.put(job)
+        if wait:
+            self.wait()
+        return job is not None
+
+    def wait(self) -> None:
+        '''
+        Blocks until every change handed to the writer thread has been written, or has failed.
+        '''
+        self._jobs.join()
+
+    def close(self) -> None:
+        '''
+        Writes the remaining changes and stops the writer thread.
+        '''
+        self.flush()
+        self._jobs.put(None)
+        self._thread.join()
+        self.profile._write_barrier = None
+
+    def _run(self):
+        """
+        Thread body: writes jobs in the order they were taken. Jobs waiting together are coalesced:
+        journal records are appended in one write, and a snapshot replaces everything before it.
+        """
+        backlog = []
+        stop = False
+        while not stop:
+            try:
+                jobs = [self._jobs.get(timeout=SAVE_RETRY_INTERVAL if backlog else None)]
+            except queue.Empty:
+                jobs = []
+            while True:
+                try:
+                    jobs.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            for job in jobs:
+                if job is None:
+                    stop = True
+                elif job['kind'] == 'snapshot':
+                    # Archive segments of a snapshot it replaces may be referenced by this one
+                    segments = {}
+                    for older in backlog:
+                        segments.update(older.get('segments', {}))
+                    backlog = [dict(job, segments=dict(segments, **job['segments']))]
+                elif backlog and backlog[-1]['kind'] == 'append':
+                    backlog[-1] = dict(backlog[-1], records=backlog[-1]['records'] + job['records'])
+                else:
+                    backlog.append(job)
+            while backlog:
+                try:
+                    _write_save(backlog[0], self.fsync)
+                except Exception as ex:
+                    log.error("Profile write failed.", extra={'op': 'write', 'path': str(self.path), 'error': str(ex)})
+                    break
+                backlog.pop(0)
+            for _ in jobs:
+                self._jobs.task_done()
+
+
+class HistoryMerge:
+    """
+    Merges messages retrieved from the server's history into a profile on a background thread, as
+    Profile.merge_history does, so that neither the merge nor the final sort holds up the thread that
+    owns the profile. Created by Profile.start_merge, which takes the stored messages as they are then;
+    the messages of a lazily loaded profile, and archived messages, are read by the merge thread.
+    The owner hands over each batch with add and the outcome of the retrieve with finish, and once
+    done is true, puts the result in place with Profile.apply_merge.
+    """
+    def __init__(self, profile):
+        self.stats = {'received': 0, 'added': 0, 'ok': True}
+        self.keys = None            # keys of every merged message, set once the merge succeeded
+        self.msgs = None            # every merged Message in order of time sent, if any was added
+        self.conversations = None   # msgs of each contact, keyed by contact name
+        self.search = None          # SearchIndex of every merged message
+        self._batches = queue.Queue()
+        self._finished = False      # set once the outcome of the retrieve was taken from _batches
+        # The base profile holds what the profile holds now, without sharing any list with it
+        base = Profile()
+        base._saved_path = profile._saved_path
+        base._archive = {contact: list(manifest) for contact, manifest in profile._archive.items()}
+        base._archive_cache = profile._archive_cache
+        base._unwritten = dict(profile._unwritten)
+        base._snapshotseq = profile._snapshotseq
+        base._journalseq = profile._journalseq
+        base._pending = list(profile._pending)
+        base._needs_compact = profile._needs_compact
+        if profile._in_file is None:
+            base._retrievedmsgs = list(profile._retrievedmsgs)
+            base._in_snapshot = profile._in_snapshot
+        else:
+            base._in_file = 0
+        self._base = base
+        self._thread = threading.Thread(target=self._run, name='ds-merge', daemon=True)
+        self._thread.start()
+
+    def add(self, batch) -> None:
+        '''
+        Hands a list of DirectMessages retrieved from the server to the merge.
+        '''
+        self._batches.put(batch)
+
+    def finish(self, ok=True) -> None:
+        '''
+        Tells the merge that every batch has been added, and whether the retrieve completed.
+        '''
+        self._batches.put(bool(ok))
+
+    @property
+    def done(self) -> bool:
+        '''
+        True once the merge has finished, or failed.
+        '''
+        return not self._thread.is_alive()
+
+    def wait(self) -> None:
+        '''
+        Blocks until the merge has finished, or failed.
+        '''
+        self._thread.join()
+
+    def _run(self):
+        """
+        Thread body: reads the stored messages, merges batches as they arrive, then sorts the result.
+        A failure is logged and leaves the profile as it was.
+        """
+        try:
+            self._merge()
+        except Exception as ex:
+            log.error("History merge failed.", extra={'op': 'merge', 'error': str(ex)})
+            self.stats.update(ok=False, added=0)
+            self.keys = None
+            # The owner may still be adding batches
+            while not self._finished:
+                self._finished = isinstance(self._batches.get(), bool)
+
+    def _merge(self):
+        """
+        Merges every batch into the messages of the base profile, see Profile.merge_history.
+        """
+        stats = self.stats
+        base = self._base
+        t = time.perf_counter()
+        if base._in_file is not None:
+            seq = base._journalseq
+            base._load_snapshot(base._saved_path)
+            base._replay_journal(base._saved_path, until=seq)
+            for record in base._pending:
+                if record['n'] > base._journalseq:
+                    base._apply(record)
+                    base._journalseq = record['n']
+            base._in_file = None
+        # The profile's own search index may be added to meanwhile, so the merge builds its own
+        search = base._get_search()
+        msgs = [Message.from_dict(msg) for msg in base._archived_dicts()] + base._retrievedmsgs
+        keys = {_msg_key(msg.contact, msg.timestamp, msg.message) for msg in msgs}
+        stats['index_s'] = time.perf_counter() - t
+
+        fetch = merge = 0.0
+        while True:
+            t = time.perf_counter()
+            batch = self._batches.get()
+            fetch += time.perf_counter() - t
+            if isinstance(batch, bool):
+                self._finished = True
+                stats['ok'] = batch
+                break
+            t = time.perf_counter()
+            stats['received'] += len(batch)
+            for dm in batch:
+                key = _msg_key(dm.recipient, dm.timestamp, dm.message)
+                if key not in keys:
+                    keys.add(key)
+                    msgs.append(Message(dm.recipient, dm.message, dm.timestamp, dm.sent))
+                    search.add(dm.recipient, key[1], dm.message)
+                    stats['added'] += 1
+            merge += time.perf_counter() - t
+        stats['fetch_s'] = fetch
+        stats['merge_s'] = merge
+
+        t = time.perf_counter()
+        if stats['added']:
+            msgs.sort(key=lambda msg: _timestamp_key(msg.timestamp))
+            conversations = {}
+            for msg in msgs:
+                conversation = conversations.get(msg.contact)
+                if conversation is None:
+                    conversation = conversations[msg.contact] = []
+                conversation.append(msg)
+            self.msgs = msgs
+            self.conversations = conversations
+        stats['sort_s'] = time.perf_counter() - t
+        self.search = search
+        self.keys = keys
+
+
+@metrics.timed('profile.write')
+def _write_save(job, fsync) -> None:
+    """
+    Writes a job taken by Profile._take_save. fsync is FSYNC_ALWAYS, FSYNC_SNAPSHOT or FSYNC_NEVER.
+    """
+    p = job['path']
+    if job['kind'] == 'append':
+        lines = ''.join(json.dumps(record) + '\n' for record in job['records'])
+        with open(_journal_path(p), 'a') as f:
+            f.write(lines)
+            if fsync == FSYNC_ALWAYS:
+                f.flush()
+                os.fsync(f.fileno())
+        return
+    header = job['header']
+    copy = job['copy']
+    referenced = _write_archive(job, fsync)
+    search = job['search']
+    added = job['added']
+    if search is None and job['search_from'] is not None:
+        # Read before the snapshot it matches is replaced; the messages added since are indexed after
+        search = SearchIndex.load(_search_path(job['search_from'][0]), job['search_from'][1])
+    if search is None:
+        search = _build_search(job)
+        added = []
+    # The header is Profile._to_dict; the messages are written by hand so the position of each message is known
+    entries = {}
+    sent = bytearray()
+    tmp = p.with_name(p.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        text = (json.dumps(header)[:-1] + ', "_retrievedmsgs": [').encode()
+        f.write(text)
+        offset = len(text)
+        sep = b''
+        msgs = ((msg.contact, json.dumps(msg.to_dict()).encode(), msg.sent) for msg in job['msgs'])
+        for contact, text, is_sent in itertools.chain(_copied_msgs(copy), msgs):
+            f.write(sep + text)
+            offset += len(sep)
+            entries.setdefault(contact, bytearray()).extend(_INDEX_ENTRY.pack(offset, len(text)))
+            offset += len(text)
+            sent.append(is_sent)
+            sep = b', '
+        for key, wanted in (b'_sentmsgs', True), (b'_newmsgs', False):
+            f.write(b'], "' + key + b'": [')
+            sep = b''
+            for _, text, is_sent in _copied_msgs(copy, sent):
+                if is_sent == wanted:
+                    f.write(sep + text)
+                    sep = b', '
+            text = json.dumps([msg.to_dict() for msg in job['msgs'] if msg.sent == wanted])[1:-1].encode()
+            if text:
+                f.write(sep + text)
+        f.write(b']}')
+        if fsync != FSYNC_NEVER:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, p)
+    # Records up to _journalseq are now in the snapshot and are skipped if the journal survives a crash here
+    if os.path.exists(_journal_path(p)):
+        os.remove(_journal_path(p))
+    remove_unreferenced(archive_dir(p), referenced)
+    _write_index(p, header, entries)
+    if copy is None:
+        _try_write_cache(p, header, job['msgs'], 'write')
+    elif os.path.exists(_cache_path(p)):
+        # The messages are not in memory, so the stale cache is dropped rather than rebuilt from the file
+        os.remove(_cache_path(p))
+    for msg in added:
+        search.add(msg.contact, _timestamp_key(msg.timestamp), msg.message)
+    search.save(_search_path(p), header['_journalseq'], job['search_count'] if job['search'] is not None else None)
+
+
+def _build_search(job) -> SearchIndex:
+    """
+    Builds the search index of a snapshot job from its archive segments, which are written by then, and
+    its messages, before the DSU file it copies messages from is replaced.
+    """
+    index = SearchIndex()
+    directory = archive_dir(job['path'])
+    for manifest in job['header']['_archive'].values():
+        for name, _ in manifest:
+            msgs = job['segments'].get(name)
+            for msg in msgs if msgs is not None else read_segment(directory / name):
+                msg = Message.from_dict(msg) if isinstance(msg, dict) else msg
+                index.add(msg.contact, _timestamp_key(msg.timestamp), msg.message)
+    for _, text, _ in _copied_msgs(job['copy']):
+        msg = Message.from_dict(json.loads(text))
+        index.add(msg.contact, _timestamp_key(msg.timestamp), msg.message)
+    for msg in job['msgs']:
+        index.add(msg.contact, _timestamp_key(msg.timestamp), msg.message)
+    return index
+
+
+def _copied_msgs(copy, sent=None):
+    """
+    Yields the (contact, JSON text, sent) of each message a snapshot job copies from the DSU file the
+    profile was lazily loaded from, in the order they are in it. copy is the job's copy field, or None.
+    sent holds the flags yielded by an earlier pass, so the messages are not decoded again.
+    """
+    if copy is None:
+        return
+    with open(_index_path(copy['path']), 'rb') as f:
+        f.seek(copy['offset'])
+        packed = memoryview(f.read())
+    # Each contact's entries are in the order of the file, so merging them by offset restores it
+    size = _INDEX_ENTRY.size
+    contacts = [zip(_INDEX_ENTRY.iter_unpack(packed[first * size:(first + count) * size]), itertools.repeat(contact))
+                for contact, (first, count) in copy['ranges'].items() if count]
+    with open(copy['path'], 'rb') as f:
+        for i, ((offset, length), contact) in enumerate(heapq.merge(*contacts)):
+            f.seek(offset)
+            text = f.read(length)
+            yield contact, text, sent[i] if sent is not None else 'recipient' in json.loads(text)
+
+
+def _write_archive(job, fsync) -> set:
+    """
+    Writes the archive segments of a snapshot job that its header refers to, before the snapshot itself,
+    copying those kept from the archive of the DSU file the profile was saved to before, if it is another.
+    Returns the names of every segment the snapshot refers to.
+    """
+    referenced = {name for manifest in job['header']['_archive'].values() for name, _ in manifest}
+    if not referenced:
+        return referenced
+    directory = archive_dir(job['path'])
+    os.makedirs(directory, exist_ok=True)
+    for name, msgs in job['segments'].items():
+        if name in referenced:
+            write_segment(directory / name, [msg if isinstance(msg, dict) else msg.to_dict() for msg in msgs],
+                          fsync != FSYNC_NEVER)
+    source = job['archive_from']
+    if source is not None and source != directory:
+        for name in referenced - set(job['segments']):
+            if not os.path.exists(directory / name):
+                shutil.copyfile(source / name, directory / name)
+    return referenced
+
+
+def _write_index(p, header, entries) -> None:
+    """
+    Writes the index file of a DSU snapshot: one JSON line holding the snapshot's header fields,
+    its size and mtime, and where each contact's entries start, followed by the entries. entries holds
+    the packed _INDEX_ENTRY entries of each contact.
+    """
+    st = os.stat(p)
+    contacts = {}
+    first = 0
+    for contact, packed in entries.items():
+        contacts[contact] = [first, len(packed) // _INDEX_ENTRY.size]
+        first += contacts[contact][1]
+    idx_header = dict(header, size=st.st_size, mtime_ns=st.st_mtime_ns, contacts=contacts)
+    ip = _index_path(p)
+    tmp = ip.with_name(ip.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(idx_header).encode() + b'\n')
+        for packed in entries.values():
+            f.write(packed)
+    os.replace(tmp, ip)
+
+
+def _scan_entries(p) -> list:
+    """
+    Returns the (offset, length) of each message in the _retrievedmsgs of a DSU snapshot, in order,
+    decoding only enough JSON to find where each message ends.
+    Raises ValueError if the snapshot has no _retrievedmsgs list.
+    """
+    # Decoded as latin-1, each byte is one character, so positions in the text are byte offsets
+    with open(p, 'rb') as f:
+        text = f.read().decode('latin-1')
+    found = _RETRIEVED_KEY.search(text)
+    if found is None:
+        raise ValueError("No _retrievedmsgs list in the DSU file.")
+    decoder = json.JSONDecoder()
+    entries = []
+    pos = found.end()
+    while True:
+        pos = _SEPARATOR.match(text, pos).end()
+        if text.startswith(']', pos):
+            return entries
+        end = decoder.raw_decode(text, pos)[1]
+        entries.append((pos, end - pos))
+        pos = end
+
+
+def _try_write_cache(p, header, msgs, op) -> None:
+    """
+    Writes the snapshot cache of a DSU snapshot with _write_cache. The cache only speeds up loading, so if
+    it cannot be written, for any reason, the failure is logged and the snapshot is left without one.
+    """
+    try:
+        _write_cache(p, header, msgs)
+    except Exception as ex:
+        log.warning("Snapshot cache not written.", extra={'op': op, 'path': str(p), 'error': repr(ex)})
+        cp = _cache_path(p)
+        for path in (cp, cp.with_name(cp.name + '.tmp')):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _write_cache(p, header, msgs) -> None:
+    """
+    Writes the snapshot cache of a DSU snapshot holding msgs, so it is read without parsing JSON or
+    building a dictionary per message. The first line is a JSON key of the snapshot's size, mtime and
+    content hash, with the parsed header fields and the contacts; the messages follow in columns of raw
+    array bytes: contact ids, sent flags, the positions of each contact's messages, the length of each
+    text and the timestamps, then the text of every message as one UTF-8 string.
+    """
+    st = os.stat(p)
+    contact_ids = {}
+    ids = array('I')
+    conversations = {}
+    for i, msg in enumerate(msgs):
+        cid = contact_ids.get(msg.contact)
+        if cid is None:
+            cid = contact_ids[msg.contact] = len(contact_ids)
+            conversations[msg.contact] = array('I')
+        ids.append(cid)
+        conversations[msg.contact].append(i)
+    # Timestamps read from older files may be strings or integers, which are kept as JSON
+    if all(type(msg.timestamp) is float for msg in msgs):
+        timestamps = array('d', [msg.timestamp for msg in msgs]).tobytes()
+        kind = 'd'
+    else:
+        timestamps = json.dumps([msg.timestamp for msg in msgs]).encode('utf-8')
+        kind = len(timestamps)
+    key = {'version': SNAPSHOT_CACHE_VERSION,
+           'byteorder': sys.byteorder,
+           'size': st.st_size,
+           'mtime_ns': st.st_mtime_ns,
+           'sha1': _file_hash(p),
+           'header': header,
+           'count': len(msgs),
+           'contacts': list(contact_ids),
+           'sizes': [len(positions) for positions in conversations.values()],
+           'timestamps': kind
+           }
+    cp = _cache_path(p)
+    tmp = cp.with_name(cp.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(key).encode('utf-8') + b'\n')
+        f.write(ids.tobytes())
+        f.write(bytes(msg.sent for msg in msgs))
+        for positions in conversations.values():
+            f.write(positions.tobytes())
+        f.write(array('I', [len(msg.message) for msg in msgs]).tobytes())
+        f.write(timestamps)
+        # The text is encoded in chunks of _CACHE_CHUNK messages
+        for i in range(0, len(msgs), _CACHE_CHUNK):
+            f.write(''.join([msg.message for msg in msgs[i:i + _CACHE_CHUNK]]).encode('utf-8', 'surrogatepass'))
+    os.replace(tmp, cp)
+
+
+def _read_array(f, typecode, count) -> array:
+    """
+    Reads an array of count items of the given type code, written with array.tobytes, from the open file f.
+    Raises ValueError if the file ends before it.
+    """
+    values = array(typecode)
+    data = f.read(count * values.itemsize)
+    if len(data) != count * values.itemsize:
+        raise ValueError("Snapshot cache is truncated.")
+    values.frombytes(data)
+    return values
+
+
+def _file_hash(p) -> str:
+    """
+    Returns the SHA-1 hex digest of a file's content.
+    """
+    h = hashlib.sha1()
+    with open(p, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Pauses the cyclic garbage collector while many objects are built at once; the objects hold no
+    cycles, and each collection would otherwise walk every object built so far.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _timestamp_key(timestamp) -> float:
+    """
+    Returns a timestamp as a number for ordering; the server may send timestamps as strings.
+    """
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _outbox_dicts(outbox) -> list:
+    """
+    Returns the (message, recipient) pairs of an outbox as dictionaries, as they are saved in the DSU file.
+    """
+    return [{'recipient': recipient, 'message': message} for message, recipient in outbox]
+
+
+def _outbox_pairs(saved) -> list:
+    """
+    Returns the outbox saved in a DSU file as (message, recipient) pairs.
+    """
+    return [(msg['message'], msg['recipient']) for msg in saved]
+
+
+def _msg_key(contact, timestamp, message) -> tuple:
+    """
+    Returns the key that identifies a message when merging history from the server.
+    """
+    return (contact, _timestamp_key(timestamp), message)
+
+
+def _search_path(p) -> Path:
+    """
+    Returns the path of the search index file kept next to a DSU file.
+    """
+    return p.with_name(p.name + '.search')
+
+
+def _cache_path(p) -> Path:
+    """
+    Returns the path of the snapshot cache file kept next to a DSU file.
+    """
+    return p.with_name(p.name + '.cache')
+
+
+def _index_path(p) -> Path:
+    """
+    Returns the path of the index file kept next to a DSU file.
+    """
+    return p.with_name(p.name + '.idx')
+
+
+def _journal_path(p) -> Path:
+    """
+    Returns the path of the journal file kept next to a DSU file.
+    """
+    return p.with_name(p.name + '.journal')
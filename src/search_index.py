@@ -0,0 +1,189 @@
+"""
+search_index.py
+Defines the SearchIndex class, an inverted index over the text of a profile's messages
+"""
+
+import json, os, re, sys, threading
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+
+# Version of the search index file format; files of other versions are rebuilt
+SEARCH_INDEX_VERSION = 2
+
+_WORD = re.compile(r'\w+')
+
+def tokenize(text) -> set:
+    """
+    Returns the distinct lowercase words of a text. A message without text, such as a null one read from
+    an older DSU file, has no words.
+    """
+    if not isinstance(text, str):
+        return set()
+    return set(_WORD.findall(text.lower()))
+
+
+class SearchIndex:
+    """
+    Maps each word to the ids of the messages that contain it. Ids are given out in the order
+    messages are added, so every posting list is sorted and lists can be intersected by bisection.
+    For each message only its contact and timestamp are kept, which is enough to filter hits and
+    to find the message in its conversation.
+    """
+    def __init__(self):
+        self._postings = {}     # word -> array of message ids
+        self._contacts = []     # contact names, by contact id
+        self._contact_ids = {}  # contact name -> contact id
+        self._doc_contact = array('I')  # message id -> contact id
+        self._doc_time = array('d')     # message id -> timestamp
+        self._lock = threading.Lock()   # held while adding, and while save reads the index on another thread
+
+    def __len__(self):
+        return len(self._doc_time)
+
+    def add(self, contact, timestamp, text) -> None:
+        '''
+        Adds a message to the index.
+        '''
+        words = tokenize(text)
+        with self._lock:
+            doc = len(self._doc_time)
+            cid = self._contact_ids.get(contact)
+            if cid is None:
+                cid = self._contact_ids[contact] = len(self._contacts)
+                self._contacts.append(contact)
+            self._doc_contact.append(cid)
+            self._doc_time.append(timestamp)
+            for word in words:
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = array('I')
+                postings.append(doc)
+
+    def search(self, query, contact=None, since=None, until=None, limit=None) -> list:
+        '''
+        Returns the (contact, timestamp) of each message containing every word of the query, most recently
+        added first.
+        contact: only messages sent to or received from this contact
+        since, until: only messages with a timestamp in this range, inclusive
+        limit: at most this many hits
+        '''
+        words = tokenize(query)
+        if not words:
+            return []
+        lists = []
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is None:
+                return []
+            lists.append(postings)
+        lists.sort(key=len)
+        cid = self._contact_ids.get(contact, -1) if contact is not None else None
+        hits = []
+        for i in range(len(lists[0]) - 1, -1, -1):
+            doc = lists[0][i]
+            if cid is not None and self._doc_contact[doc] != cid:
+                continue
+            timestamp = self._doc_time[doc]
+            if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+                continue
+            if all(_contains(other, doc) for other in lists[1:]):
+                hits.append((self._contacts[self._doc_contact[doc]], timestamp))
+                if limit is not None and len(hits) >= limit:
+                    break
+        return hits
+
+    def save(self, path, seq, count=None) -> None:
+        '''
+        Writes the index to path, recording the journal sequence number of the DSU snapshot it matches
+        and the snapshot's size and mtime. The file is written to a temporary file and renamed into place.
+        If count is given, only the first count messages are written, so the index can be saved from
+        another thread as of the moment the snapshot was taken while messages are still being added.
+        The first line is a JSON key with the contacts and the words; the raw bytes of the contact and
+        timestamp arrays follow, then the length of each word's posting list and the posting lists, in the
+        order of the words.
+        '''
+        p = Path(path)
+        dsu = p.with_name(p.name[:-len('.search')])
+        st = os.stat(dsu)
+        tmp = p.with_name(p.name + '.tmp')
+        with self._lock:
+            doc_contact = self._doc_contact[:count]
+            doc_time = self._doc_time[:count]
+            words = []
+            sizes = array('I')
+            postings = []
+            for word, doc_ids in self._postings.items():
+                if count is not None and doc_ids[-1] >= count:
+                    doc_ids = doc_ids[:bisect_left(doc_ids, count)]
+                if doc_ids:
+                    words.append(word)
+                    sizes.append(len(doc_ids))
+                    postings.append(doc_ids)
+            key = {'version': SEARCH_INDEX_VERSION,
+                   'byteorder': sys.byteorder,
+                   'seq': seq,
+                   'size': st.st_size,
+                   'mtime_ns': st.st_mtime_ns,
+                   'count': len(doc_time),
+                   'contacts': self._contacts,
+                   'words': words
+                   }
+            with open(tmp, 'wb') as f:
+                f.write(json.dumps(key).encode('utf-8') + b'\n')
+                f.write(doc_contact.tobytes())
+                f.write(doc_time.tobytes())
+                f.write(sizes.tobytes())
+                for doc_ids in postings:
+                    f.write(doc_ids.tobytes())
+        os.replace(tmp, p)
+
+    @classmethod
+    def load(cls, path, seq):
+        '''
+        Reads an index written by save. Returns None if there is no index file, if it is damaged, or if it
+        does not match the DSU snapshot next to it at journal sequence number seq. The key is checked before
+        the rest of the file is read.
+        '''
+        p = Path(path)
+        dsu = p.with_name(p.name[:-len('.search')])
+        if not os.path.exists(p) or not os.path.exists(dsu):
+            return None
+        st = os.stat(dsu)
+        index = cls()
+        try:
+            with open(p, 'rb') as f:
+                key = json.loads(f.readline())
+                if (key.get('version') != SEARCH_INDEX_VERSION or key['byteorder'] != sys.byteorder
+                        or key['seq'] != seq or key['size'] != st.st_size or key['mtime_ns'] != st.st_mtime_ns):
+                    return None
+                data = memoryview(f.read())
+            count = key['count']
+            words = key['words']
+            sizes = array('I')
+            postings = array('I')
+            pos = 0
+            for values, size in ((index._doc_contact, count), (index._doc_time, count), (sizes, len(words))):
+                values.frombytes(data[pos:pos + size * values.itemsize])
+                pos += size * values.itemsize
+            postings.frombytes(data[pos:])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+        if (len(index._doc_contact) != count or len(index._doc_time) != count or len(sizes) != len(words)
+                or sum(sizes) != len(postings)):
+            return None
+        start = 0
+        for word, size in zip(words, sizes):
+            index._postings[word] = postings[start:start + size]
+            start += size
+        index._contacts = key['contacts']
+        index._contact_ids = {contact: cid for cid, contact in enumerate(index._contacts)}
+        return index
+
+
+def _contains(postings, doc) -> bool:
+    """
+    Returns true if the sorted posting list holds doc.
+    """
+    i = bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
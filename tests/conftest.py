@@ -0,0 +1,39 @@
+"""
+conftest.py
+Puts the client modules on the import path and provides a DsuServer stand-in for the tests
+"""
+
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import ds_messenger
+from ds_server import DsuServer
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """
+    Runs a DsuServer in a background thread, with every DirectMessenger pointed at it.
+    """
+    srv = DsuServer(seed=0)
+    monkeypatch.setattr(ds_messenger, 'DSU_SERVER_PORT', srv.start_in_thread())
+    yield srv
+    srv.stop()
+
+
+@pytest.fixture
+def messenger(server):
+    """
+    Returns a function that joins a user to the server, closing its session after the test.
+    """
+    messengers = []
+
+    def join(username, password='pwd'):
+        dmr = ds_messenger.DirectMessenger('127.0.0.1', username, password)
+        messengers.append(dmr)
+        return dmr
+    yield join
+    for dmr in messengers:
+        dmr.close()
@@ -0,0 +1,74 @@
+"""
+test_accounts.py
+Hosts several profiles in one AccountManager against the DsuServer stand-in
+"""
+
+import asyncio
+from ds_accounts import AccountManager
+from profile import Profile
+
+
+def _profile(tmp_path, username):
+    """
+    Returns the path of a new DSU file for username on the DsuServer stand-in.
+    """
+    path = tmp_path / f'{username}.dsu'
+    path.touch()
+    Profile('127.0.0.1', username, 'pwd').save_profile(path)
+    return path
+
+
+def test_accounts_send_to_each_other(tmp_path, messenger):
+    paths = {}
+    for username in ('alice', 'bob', 'carol'):
+        # Users are created on the server by their first join
+        messenger(username).retrieve_new()
+        paths[username] = _profile(tmp_path, username)
+
+    async def run():
+        manager = AccountManager(concurrency=4, min_interval=0.01, max_interval=0.05)
+        try:
+            for path in paths.values():
+                await manager.add(path)
+            sent = [manager.send('alice', f'to bob {i}', 'bob') for i in range(5)]
+            sent.append(manager.send('carol', 'to alice', 'alice'))
+            sent.append(manager.send('carol', 'lost', 'nobody'))
+            assert await asyncio.gather(*sent) == [True] * 6 + [False]
+            received = []
+            while len(received) < 6:
+                received.append(await asyncio.wait_for(manager.incoming.get(), 5))
+            return received
+        finally:
+            await manager.close()
+    received = asyncio.run(run())
+    assert sorted((username, dm.recipient, dm.message) for username, dm in received) == \
+        [('alice', 'carol', 'to alice')] + [('bob', 'alice', f'to bob {i}') for i in range(5)]
+
+    bob = Profile()
+    bob.load_profile(paths['bob'])
+    assert [msg.message for msg in bob.conversation('alice')] == [f'to bob {i}' for i in range(5)]
+    alice = Profile()
+    alice.load_profile(paths['alice'])
+    assert [(msg.message, msg.sent) for msg in alice.conversation('carol')] == [('to alice', False)]
+
+
+def test_send_wakes_a_backed_off_poll(tmp_path, messenger):
+    bob = messenger('bob')
+    bob.retrieve_new()
+    path = _profile(tmp_path, 'alice')
+
+    async def run():
+        manager = AccountManager(concurrency=2, min_interval=0.01, max_interval=30.0)
+        try:
+            account = await manager.add(path)
+            # Let the first poll join, then back the account off to a long sleep
+            await asyncio.sleep(0.1)
+            account.scheduler.interval = 30.0
+            await asyncio.sleep(0.1)
+            assert bob.send('are you there?', 'alice')
+            assert await manager.send('alice', 'yes', 'bob')
+            return await asyncio.wait_for(manager.incoming.get(), 2)
+        finally:
+            await manager.close()
+    username, dm = asyncio.run(run())
+    assert (username, dm.recipient, dm.message) == ('alice', 'bob', 'are you there?')
@@ -0,0 +1,70 @@
+"""
+test_client.py
+Sends and receives through HeadlessClient and the command line entry point against the DsuServer stand-in
+"""
+
+import json
+import ds_client
+from ds_client import HeadlessClient
+from profile import Profile
+
+
+def _profile(tmp_path, username='alice'):
+    """
+    Returns the path of a new DSU file for username on the DsuServer stand-in.
+    """
+    path = tmp_path / f'{username}.dsu'
+    path.touch()
+    Profile('127.0.0.1', username, 'pwd').save_profile(path)
+    return path
+
+
+def test_send_many_in_batches_and_receive(tmp_path, server, messenger):
+    bob = messenger('bob')
+    bob.retrieve_new()
+    path = _profile(tmp_path)
+    client = HeadlessClient(path)
+    outbox = [(f'message {i}', 'bob') for i in range(7)] + [('lost', 'nobody')]
+    report = list(client.send_many(iter(outbox), batch_size=3))
+    assert report == [(message, recipient, recipient == 'bob') for message, recipient in outbox]
+    assert [dm.message for dm in bob.retrieve_new()] == [message for message, _ in outbox[:7]]
+
+    assert bob.send('hello alice', 'alice')
+    assert [dm.message for dm in client.receive()] == ['hello alice']
+    assert client.receive() == []
+    client.close()
+
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert [msg.message for msg in reloaded.conversation('bob')] == [f'message {i}' for i in range(7)] + ['hello alice']
+    assert reloaded.pending_outbox() == []
+
+
+def test_send_many_keeps_messages_while_offline(tmp_path, server, messenger):
+    messenger('bob').retrieve_new()
+    path = _profile(tmp_path)
+    client = HeadlessClient(path)
+    server.stop()
+    outbox = [(f'message {i}', 'bob') for i in range(5)]
+    assert [sent for _, _, sent in client.send_many(outbox, batch_size=2)] == [False] * 5
+    client.close()
+
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert reloaded.pending_outbox() == outbox
+
+
+def test_command_line_send_and_listen_once(tmp_path, server, messenger, capsys):
+    bob = messenger('bob')
+    bob.retrieve_new()
+    path = _profile(tmp_path)
+    lines = tmp_path / 'outbox.txt'
+    lines.write_text('first\n\nsecond\n')
+    port = f'127.0.0.1:{server.port}'
+    assert ds_client.main([str(path), '--server', port, 'send', '--to', 'bob', '--file', str(lines)]) == 0
+    assert [dm.message for dm in bob.retrieve_new()] == ['first', 'second']
+
+    bob.send('hi', 'alice')
+    assert ds_client.main([str(path), '--server', port, 'listen', '--once']) == 0
+    out = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(obj['from'], obj['message']) for obj in out] == [('bob', 'hi')]
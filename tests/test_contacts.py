@@ -0,0 +1,57 @@
+"""
+test_contacts.py
+Membership, activity order and unread counts of the ContactRegistry, and of a profile's contacts
+"""
+
+from contact_registry import ContactRegistry
+from ds_messenger import DirectMessage
+from profile import Profile
+
+
+def test_contacts_keep_stable_ids_without_duplicates():
+    contacts = ContactRegistry()
+    assert contacts.add('bob')
+    assert contacts.add('carol')
+    assert not contacts.add('bob')
+    assert len(contacts) == 2
+    assert 'bob' in contacts and 'dave' not in contacts
+    assert list(contacts) == contacts.names() == ['bob', 'carol']
+    assert contacts.id_of('carol') == 1
+    assert contacts.id_of('dave') is None
+    assert contacts.name_of(0) == 'bob'
+
+
+def test_contacts_by_activity_and_unread():
+    contacts = ContactRegistry()
+    for name in ('bob', 'carol', 'dave', 'erin'):
+        contacts.add(name)
+    assert contacts.touch('carol', 10.0, unread=True)
+    assert contacts.touch('bob', 20.0)
+    # An older message does not move the contact back
+    assert contacts.touch('bob', 5.0, unread=True)
+    assert not contacts.touch('nobody', 30.0)
+    assert [contacts.name_of(id) for id in contacts.by_activity()] == ['bob', 'carol', 'dave', 'erin']
+    assert (contacts.unread('bob'), contacts.unread('carol'), contacts.unread('dave')) == (1, 1, 0)
+    assert contacts.mark_read('carol')
+    assert not contacts.mark_read('carol')
+    assert contacts.unread('carol') == 0
+    assert contacts.unread('nobody') == 0
+
+
+def test_profile_orders_contacts_by_their_messages():
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    for name in ('bob', 'carol', 'dave'):
+        assert profile.add_contact(name)
+    assert not profile.add_contact('bob')
+    dms = []
+    for i, sender in enumerate(('carol', 'bob', 'carol')):
+        dm = DirectMessage()
+        dm.recipient = sender
+        dm.message = f'from {sender}'
+        dm.timestamp = 100.0 + i
+        dms.append(dm)
+    profile.store_new_msgs(dms)
+    assert [profile.contacts.name_of(id) for id in profile.contacts.by_activity()] == ['carol', 'bob', 'dave']
+    assert profile.contacts.unread('carol') == 2
+    assert profile.mark_read('carol')
+    assert profile.contacts.unread('carol') == 0
@@ -0,0 +1,44 @@
+"""
+test_logging.py
+Structured log records written by the client at DEBUG level
+"""
+
+import io, json, logging, time
+import pytest
+from ds_messenger import DirectMessage
+from ds_metrics import JsonFormatter
+from profile import Profile
+
+
+@pytest.fixture
+def debug_log():
+    """
+    Sends every log record of the client to a buffer as JSON lines, at DEBUG level.
+    Returns the buffer.
+    """
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    level = root.level
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+    yield stream
+    root.removeHandler(handler)
+    root.setLevel(level)
+
+
+def test_stored_messages_are_logged_at_debug(debug_log):
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    sent = DirectMessage()
+    sent.recipient, sent.message, sent.timestamp = 'bob', 'hi bob', time.time()
+    profile.store_sent_msg(sent)
+    received = DirectMessage()
+    received.recipient, received.message, received.timestamp = 'bob', 'hi alice', time.time()
+    profile.store_new_msgs([received])
+
+    entries = [json.loads(line) for line in debug_log.getvalue().splitlines()]
+    ops = {entry['op']: entry for entry in entries if 'op' in entry}
+    assert ops['store_sent']['dm']['message'] == 'hi bob'
+    assert ops['store_new']['dm']['message'] == 'hi alice'
+    assert [msg.message for msg in profile.conversation('bob')] == ['hi bob', 'hi alice']
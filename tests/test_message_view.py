@@ -0,0 +1,13 @@
+"""
+test_message_view.py
+Lines of the message box built without tkinter
+"""
+
+from message_view import render_lines
+from profile import Message
+
+
+def test_render_lines_names_the_sender():
+    msgs = [Message('bob', 'hi alice', 1.0, False), Message('bob', 'hi bob', 2.0, True)]
+    assert render_lines(msgs) == ['BOB: hi alice\n', 'YOU: hi bob\n']
+    assert render_lines([]) == []
@@ -0,0 +1,146 @@
+"""
+test_messenger.py
+Round trips through DirectMessenger against the DsuServer stand-in, and its timeouts and circuit breaker
+"""
+
+import socket, time
+import ds_messenger
+from ds_server import DsuServer
+
+
+def test_send_and_retrieve_new(messenger):
+    alice = messenger('alice')
+    bob = messenger('bob')
+    assert bob.retrieve_new() == []
+    assert alice.send('hello bob', 'bob')
+    assert alice.send('are you there?', 'bob')
+    received = bob.retrieve_new()
+    assert [(dm.recipient, dm.message, dm.sent) for dm in received] == \
+        [('alice', 'hello bob', False), ('alice', 'are you there?', False)]
+    # Messages are only new once
+    assert bob.retrieve_new() == []
+
+
+def test_send_to_unknown_recipient_fails(messenger):
+    alice = messenger('alice')
+    assert not alice.send('anyone?', 'nobody')
+
+
+def test_send_batch_answers_every_message(messenger):
+    alice = messenger('alice')
+    messenger('bob').retrieve_new()
+    outbox = [(f'message {i}', 'bob') for i in range(20)] + [('lost', 'nobody')]
+    results = alice.send_batch(outbox)
+    assert alice.answered == len(outbox)
+    assert [dm.message for dm in results[:-1]] == [message for message, _ in outbox[:-1]]
+    assert results[-1] is None
+    # The batch is stored in order, with distinct timestamps
+    timestamps = [dm.timestamp for dm in results[:-1]]
+    assert timestamps == sorted(set(timestamps))
+
+
+def test_iter_all_batches_holds_sent_and_received(messenger):
+    alice = messenger('alice')
+    bob = messenger('bob')
+    bob.retrieve_new()
+    for i in range(7):
+        alice.send(f'to bob {i}', 'bob')
+    bob.send('to alice', 'alice')
+    batches = list(bob.iter_all_batches(batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 3, 2]
+    msgs = [dm for batch in batches for dm in batch]
+    assert sorted(dm.message for dm in msgs if not dm.sent) == [f'to bob {i}' for i in range(7)]
+    assert [(dm.recipient, dm.message) for dm in msgs if dm.sent] == [('alice', 'to alice')]
+
+
+def test_rejoins_when_server_forgets_token(server, messenger):
+    alice = messenger('alice')
+    messenger('bob').retrieve_new()
+    assert alice.send('first', 'bob')
+    server._tokens.clear()
+    assert alice.send('second', 'bob')
+
+
+def test_injected_errors_fail_the_send(monkeypatch):
+    srv = DsuServer(error_rate=1.0, seed=0)
+    monkeypatch.setattr(ds_messenger, 'DSU_SERVER_PORT', srv.start_in_thread())
+    try:
+        alice = ds_messenger.DirectMessenger('127.0.0.1', 'alice', 'pwd')
+        assert not alice.send('hello', 'bob')
+        alice.close()
+    finally:
+        srv.stop()
+
+
+def test_send_batch_leaves_messages_after_unreadable_reply(server, messenger):
+    alice = messenger('alice')
+    messenger('bob').retrieve_new()
+    respond = server._respond
+    replies = []
+
+    def respond_without_message(line):
+        resp = respond(line)
+        if b'"entry"' in line:
+            replies.append(resp)
+            # The third message is stored, but its reply lacks the message field
+            if len(replies) == 3:
+                del resp['response']['message']
+        return resp
+    server._respond = respond_without_message
+    outbox = [(f'message {i}', 'bob') for i in range(5)]
+    results = alice.send_batch(outbox)
+    assert alice.answered == 2
+    assert [dm.message for dm in results[:2]] == ['message 0', 'message 1']
+    assert results[2:] == [None, None, None]
+    # The session was closed, and the next batch starts a new one
+    assert alice._soc is None
+    assert all(alice.send_batch(outbox[2:]))
+
+
+def test_circuit_breaker_opens_and_backs_off():
+    breaker = ds_messenger.CircuitBreaker(threshold=2, base_delay=0.05, max_delay=0.1)
+    breaker.failure()
+    assert breaker.allow() and breaker.retry_in() == 0.0
+    breaker.failure()
+    assert not breaker.allow()
+    assert 0.0 < breaker.retry_in() <= 0.05
+    time.sleep(0.06)
+    # The trial after the delay is let through; failing it opens the breaker for twice as long
+    assert breaker.allow()
+    breaker.failure()
+    assert 0.05 < breaker.retry_in() <= 0.1
+    breaker.success()
+    assert breaker.allow() and breaker.failures == 0
+
+
+def test_read_timeout_fails_the_send_and_opens_the_breaker(server, messenger):
+    messenger('bob').retrieve_new()
+    breaker = ds_messenger.CircuitBreaker(threshold=1, base_delay=60.0)
+    alice = ds_messenger.DirectMessenger('127.0.0.1', 'alice', 'pwd', read_timeout=0.05, breaker=breaker)
+    server.latency = 0.5
+    t = time.monotonic()
+    assert not alice.send('slow', 'bob')
+    assert time.monotonic() - t < 0.4
+    assert not breaker.allow()
+    # While the breaker is open, commands fail without connecting
+    connections = server.connections
+    t = time.monotonic()
+    assert not alice.send('refused', 'bob')
+    assert alice.send_batch([('refused', 'bob')]) == [None]
+    assert time.monotonic() - t < 0.1
+    assert server.connections == connections
+    alice.close()
+
+
+def test_connection_refused_fails_fast(monkeypatch):
+    with socket.socket() as soc:
+        soc.bind(('127.0.0.1', 0))
+        port = soc.getsockname()[1]
+    monkeypatch.setattr(ds_messenger, 'DSU_SERVER_PORT', port)
+    breaker = ds_messenger.CircuitBreaker(threshold=2)
+    alice = ds_messenger.DirectMessenger('127.0.0.1', 'alice', 'pwd', token='saved', breaker=breaker)
+    t = time.monotonic()
+    assert not alice.send('hello', 'bob')
+    assert alice.retrieve_new() is None
+    assert time.monotonic() - t < 1.0
+    assert not breaker.allow()
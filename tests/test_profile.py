@@ -0,0 +1,278 @@
+"""
+test_profile.py
+Journal recovery, lazy and archived history, caches, tokens and the outbox of profiles filled from the
+DsuServer stand-in
+"""
+
+import json, os, socket, time
+import pytest
+import ds_messenger
+from ds_messenger import DirectMessage
+from profile import Profile, _cache_path, _journal_path, _search_path
+
+CONTACTS = ('bob', 'carol', 'dave')
+MESSAGES = 60
+
+
+@pytest.fixture
+def history(messenger):
+    """
+    Has each of CONTACTS send MESSAGES messages to alice, and alice answer every third one.
+    Returns the messages of each contact as (message, sent) pairs, in the order they were sent.
+    """
+    alice = messenger('alice')
+    senders = {contact: messenger(contact) for contact in CONTACTS}
+    expected = {contact: [] for contact in CONTACTS}
+    for i in range(MESSAGES):
+        for contact, dmr in senders.items():
+            text = f'{contact} says {i}'
+            assert dmr.send(text, 'alice')
+            expected[contact].append((text, False))
+            if i % 3 == 0:
+                assert alice.send(f'reply to {text}', contact)
+                expected[contact].append((f'reply to {text}', True))
+    return expected
+
+
+@pytest.fixture
+def synced(tmp_path, history):
+    """
+    Returns the path of a DSU file holding alice's history, merged from the server with sync_history.
+    """
+    path = tmp_path / 'alice.dsu'
+    path.touch()
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    for contact in CONTACTS:
+        profile.add_contact(contact)
+    stats = profile.sync_history(batch_size=25)
+    assert stats['ok']
+    assert stats['added'] == sum(len(msgs) for msgs in history.values())
+    profile.save_profile(path)
+    profile.close()
+    return path
+
+
+def _messages(profile, contact):
+    """
+    Returns the (message, sent) pairs of a contact's conversation.
+    """
+    return [(msg.message, msg.sent) for msg in profile.conversation(contact)]
+
+
+def test_sync_history_twice_adds_nothing(synced, history):
+    profile = Profile()
+    profile.load_profile(synced)
+    for contact in CONTACTS:
+        assert _messages(profile, contact) == history[contact]
+    assert profile.sync_history()['added'] == 0
+    profile.close()
+
+
+def test_journal_torn_tail_is_cut_off(synced, history):
+    profile = Profile()
+    profile.load_profile(synced)
+    profile.store_sent_msg(_sent('bob', 'saved'))
+    profile.save_profile(synced)
+    journal = _journal_path(synced)
+    size = os.path.getsize(journal)
+    # A crash part way through appending the next record
+    with open(journal, 'ab') as f:
+        f.write(b'{"n": 999, "new": {"from": "bob", "mess')
+
+    loaded = Profile()
+    loaded.load_profile(synced)
+    assert _messages(loaded, 'bob') == history['bob'] + [('saved', True)]
+    assert os.path.getsize(journal) == size
+
+    # Later appends start on a clean line
+    loaded.store_sent_msg(_sent('bob', 'after the crash'))
+    loaded.save_profile(synced)
+    reloaded = Profile()
+    reloaded.load_profile(synced)
+    assert _messages(reloaded, 'bob') == history['bob'] + [('saved', True), ('after the crash', True)]
+
+
+@pytest.mark.parametrize('retention', [None, 30])
+def test_lazy_load_pages_through_file_and_archive(synced, history, retention):
+    profile = Profile()
+    profile.load_profile(synced)
+    profile.set_retention(retention)
+    profile.save_profile(synced)
+    if retention is not None:
+        # Archived messages stay in their conversations until they are released
+        profile.release_archived()
+        assert all(len(profile.conversation(contact)) == retention for contact in CONTACTS)
+
+    lazy = Profile()
+    lazy.load_profile(synced, recent=10)
+    for contact in CONTACTS:
+        assert _messages(lazy, contact) == history[contact][-10:]
+        pages = 0
+        while lazy.has_older(contact):
+            assert lazy.load_older(contact, count=7) > 0
+            pages += 1
+        assert pages >= (len(history[contact]) - 10) // 7
+        assert _messages(lazy, contact) == history[contact]
+    # Messages in the file and in the archive are searched alike
+    assert lazy.search('bob says 0', contact='bob')
+    assert len(lazy.search('says')) == sum(len(msgs) for msgs in history.values())
+
+    if retention is not None:
+        released = lazy.release_archived('bob')
+        assert released == len(history['bob']) - retention
+        assert _messages(lazy, 'bob') == history['bob'][-retention:]
+
+
+def test_lazy_profile_keeps_new_messages_across_snapshot(synced, history):
+    lazy = Profile()
+    lazy.load_profile(synced, recent=5)
+    lazy.store_sent_msg(_sent('carol', 'while lazy'))
+    lazy.compact(synced)
+    reloaded = Profile()
+    reloaded.load_profile(synced)
+    assert _messages(reloaded, 'carol') == history['carol'] + [('while lazy', True)]
+    for contact in ('bob', 'dave'):
+        assert _messages(reloaded, contact) == history[contact]
+
+
+@pytest.mark.parametrize('search_file', [True, False])
+def test_snapshot_search_index_is_left_to_the_writer(synced, history, search_file):
+    profile = Profile()
+    profile.load_profile(synced)
+    profile.search('says')
+    profile.compact(synced)
+    if not search_file:
+        os.remove(_search_path(synced))
+    loaded = Profile()
+    loaded.load_profile(synced)
+    loaded.set_retention(30)
+    loaded.store_sent_msg(_sent('dave', 'indexed by the writer'))
+    loaded.compact(synced)
+    # The snapshot was taken without reading or building the search index
+    assert loaded._search is None
+
+    reloaded = Profile()
+    reloaded.load_profile(synced)
+    assert len(reloaded.search('says')) == sum(len(msgs) for msgs in history.values())
+    assert [contact for contact, _ in reloaded.search('writer')] == ['dave']
+
+
+def test_snapshot_cache_is_only_used_for_an_unchanged_file(synced, history):
+    profile = Profile()
+    profile.load_profile(synced)
+    assert Profile()._load_cache(synced)
+    cached = Profile()
+    cached.load_profile(synced)
+    assert all(_messages(cached, contact) == history[contact] for contact in CONTACTS)
+
+    # Same size and mtime, different content
+    st = os.stat(synced)
+    text = synced.read_text()
+    synced.write_text(text.replace('bob says 0"', 'bob said 0"', 1))
+    os.utime(synced, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.stat(synced).st_size == st.st_size
+    assert not Profile()._load_cache(synced)
+    changed = Profile()
+    changed.load_profile(synced)
+    assert _messages(changed, 'bob')[0] == ('bob said 0', False)
+    # Loading the JSON wrote the cache for the file as it is now
+    assert Profile()._load_cache(synced)
+
+    # A new mtime, or a new size, alone
+    os.utime(synced, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert not Profile()._load_cache(synced)
+    Profile().load_profile(synced)
+    with open(synced, 'a') as f:
+        f.write(' ')
+    assert not Profile()._load_cache(synced)
+    reloaded = Profile()
+    reloaded.load_profile(synced)
+    assert _messages(reloaded, 'bob')[0] == ('bob said 0', False)
+
+
+def test_null_message_leaves_snapshot_without_cache(tmp_path):
+    path = tmp_path / 'old.dsu'
+    msgs = [{'from': 'bob', 'message': None, 'timestamp': 1.0}, {'from': 'bob', 'message': 'hi', 'timestamp': 2.0}]
+    path.write_text(json.dumps({'dsuserver': '127.0.0.1', 'username': 'alice', 'password': 'pwd',
+                                '_recipients': ['bob'], '_retrievedmsgs': msgs}))
+    profile = Profile()
+    profile.load_profile(path)
+    assert _messages(profile, 'bob') == [(None, False), ('hi', False)]
+    assert not os.path.exists(_cache_path(path))
+    profile.compact(path)
+    assert not os.path.exists(_cache_path(path))
+
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert _messages(reloaded, 'bob') == [(None, False), ('hi', False)]
+    assert [contact for contact, _ in reloaded.search('hi')] == ['bob']
+
+
+def test_token_is_reused_after_reopen(tmp_path, server, messenger):
+    messenger('bob').retrieve_new()
+    path = tmp_path / 'alice.dsu'
+    path.touch()
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    profile.queue_msg('first', 'bob')
+    assert profile.flush_outbox() == [('first', 'bob', True)]
+    profile.close()
+    profile.save_profile(path)
+
+    join = server._join
+    joins = []
+    server._join = lambda cmd: joins.append(cmd) or join(cmd)
+    reopened = Profile()
+    reopened.load_profile(path)
+    reopened.queue_msg('second', 'bob')
+    assert reopened.flush_outbox() == [('second', 'bob', True)]
+    reopened.close()
+    assert joins == []
+
+    # A token the server no longer accepts is replaced by joining once
+    server._tokens.clear()
+    reopened.queue_msg('third', 'bob')
+    assert reopened.flush_outbox() == [('third', 'bob', True)]
+    reopened.close()
+    assert len(joins) == 1
+
+
+def test_outbox_is_kept_while_offline_and_sent_after_reopen(tmp_path, server, messenger, monkeypatch):
+    bob = messenger('bob')
+    bob.retrieve_new()
+    path = tmp_path / 'alice.dsu'
+    path.touch()
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    with socket.socket() as soc:
+        soc.bind(('127.0.0.1', 0))
+        # Nothing listens on this port, so the server is unreachable
+        monkeypatch.setattr(ds_messenger, 'DSU_SERVER_PORT', soc.getsockname()[1])
+    for i in range(3):
+        profile.queue_msg(f'offline {i}', 'bob')
+    assert profile.flush_outbox() == [(f'offline {i}', 'bob', False) for i in range(3)]
+    profile.save_profile(path)
+    monkeypatch.setattr(ds_messenger, 'DSU_SERVER_PORT', server.port)
+
+    reopened = Profile()
+    reopened.load_profile(path)
+    assert reopened.pending_outbox() == [(f'offline {i}', 'bob') for i in range(3)]
+    assert reopened.flush_outbox() == [(f'offline {i}', 'bob', True) for i in range(3)]
+    reopened.save_profile(path)
+    reopened.close()
+    assert [dm.message for dm in bob.retrieve_new()] == [f'offline {i}' for i in range(3)]
+
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert reloaded.pending_outbox() == []
+    assert _messages(reloaded, 'bob') == [(f'offline {i}', True) for i in range(3)]
+
+
+def _sent(recipient, message):
+    """
+    Returns a DirectMessage sent now to recipient.
+    """
+    dm = DirectMessage()
+    dm.recipient = recipient
+    dm.message = message
+    dm.timestamp = time.time()
+    dm.sent = True
+    return dm
@@ -0,0 +1,93 @@
+"""
+test_protocol.py
+Encoding and decoding of server commands through the per-session Codec
+"""
+
+import json, threading
+import pytest
+import ds_protocol
+from ds_protocol import Codec
+
+
+def _joined(token):
+    """
+    Returns the server's response line to a join that gave token.
+    """
+    return json.dumps({"response": {"type": "ok", "message": "Welcome back", "token": token}})
+
+
+def test_codec_keeps_the_token_of_its_own_session():
+    alice = Codec()
+    bob = Codec('bob-token')
+    assert alice.extract_json(_joined('alice-token')).token == 'alice-token'
+    assert alice.token == 'alice-token'
+    assert bob.token == 'bob-token'
+    assert json.loads(alice.new_message())['token'] == 'alice-token'
+    assert json.loads(bob.all_message())['token'] == 'bob-token'
+    cmd, timestamp = bob.direct_message('hi', 'alice', 12.5)
+    assert json.loads(cmd) == {"token": "bob-token",
+                               "directmessage": {"entry": "hi", "recipient": "alice", "timestamp": 12.5}}
+    assert timestamp == 12.5
+
+
+def test_codec_keeps_token_on_responses_without_one():
+    codec = Codec('kept')
+    rt = codec.extract_response(json.dumps({"response": {"type": "ok", "message": "Direct message sent"}}))
+    assert rt == ('ok', "Direct message sent", None)
+    assert codec.token == 'kept'
+    assert codec.extract_json('not json') is ds_protocol.UNDECODABLE
+    assert codec.token == 'kept'
+
+
+def test_codecs_on_threads_do_not_share_tokens():
+    codecs = [Codec() for _ in range(8)]
+    seen = [None] * len(codecs)
+
+    def run(i):
+        for n in range(200):
+            codecs[i].extract_json(_joined(f'token {i} {n}'))
+            seen[i] = json.loads(codecs[i].new_message())['token']
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(codecs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == [f'token {i} 199' for i in range(len(codecs))]
+
+
+def _reader(line, size):
+    """
+    Returns a read_chunk function handing out line size characters at a time, then ''.
+    """
+    chunks = iter([line[i:i + size] for i in range(0, len(line), size)])
+    return lambda: next(chunks, '')
+
+
+def test_iter_messages_at_every_chunk_boundary():
+    msgs = [{"message": "plain", "from": "bob", "timestamp": "1.0"},
+            {"message": 'brackets ] [ and "messages": [', "from": "bob", "timestamp": "2.0"},
+            {"message": "line\nbreak, comma, éè \U0001f600", "recipient": "bob", "timestamp": "3.0"},
+            {"message": "", "from": "carol", "timestamp": "4.0"}]
+    line = json.dumps({"response": {"type": "ok", "messages": msgs}}) + '\r\n'
+    for size in range(1, len(line) + 1):
+        assert list(ds_protocol.iter_messages(_reader(line, size))) == msgs
+
+
+def test_iter_messages_of_empty_list():
+    line = json.dumps({"response": {"type": "ok", "messages": []}}) + '\r\n'
+    for size in (1, 7, len(line)):
+        assert list(ds_protocol.iter_messages(_reader(line, size))) == []
+
+
+def test_iter_messages_raises_error_split_across_chunks():
+    line = json.dumps({"response": {"type": "error", "message": "Invalid token."}}) + '\r\n'
+    for size in range(1, len(line) + 1):
+        with pytest.raises(ValueError, match="Invalid token."):
+            list(ds_protocol.iter_messages(_reader(line, size)))
+
+
+def test_iter_messages_raises_on_truncated_response():
+    line = json.dumps({"response": {"type": "ok", "messages": [{"message": "cut", "from": "bob"}]}})
+    for size in (1, 5, len(line)):
+        with pytest.raises(ValueError):
+            list(ds_protocol.iter_messages(_reader(line[:-12], size)))
@@ -0,0 +1,59 @@
+"""
+test_search.py
+Queries, filters and the saved file of the inverted SearchIndex
+"""
+
+import os
+from search_index import SearchIndex, tokenize
+
+
+def _index():
+    """
+    Returns an index of ten messages, alternating between bob and carol, at timestamps 0 to 9.
+    """
+    index = SearchIndex()
+    for i in range(10):
+        contact = 'bob' if i % 2 == 0 else 'carol'
+        index.add(contact, float(i), f'Lunch at {i}? Meet at the Cafe' if i % 3 == 0 else f'message {i}')
+    return index
+
+
+def test_tokenize_lowercases_distinct_words():
+    assert tokenize("Hello, hello WORLD!") == {'hello', 'world'}
+    assert tokenize(None) == set()
+
+
+def test_search_matches_every_word_newest_first():
+    index = _index()
+    assert index.search('cafe lunch') == [('carol', 9.0), ('bob', 6.0), ('carol', 3.0), ('bob', 0.0)]
+    assert index.search('lunch nowhere') == []
+    assert index.search('') == []
+
+
+def test_search_filters():
+    index = _index()
+    assert index.search('meet', contact='bob') == [('bob', 6.0), ('bob', 0.0)]
+    assert index.search('meet', contact='dave') == []
+    assert index.search('meet', since=3.0, until=8.0) == [('bob', 6.0), ('carol', 3.0)]
+    assert index.search('message', limit=2) == [('bob', 8.0), ('carol', 7.0)]
+
+
+def test_saved_index_matches_its_snapshot_only(tmp_path):
+    dsu = tmp_path / 'alice.dsu'
+    dsu.write_text('{}')
+    path = tmp_path / 'alice.dsu.search'
+    index = _index()
+    # Only the messages added when the snapshot was taken are saved
+    index.add('dave', 10.0, 'after the snapshot')
+    index.save(path, 5, count=10)
+
+    loaded = SearchIndex.load(path, 5)
+    assert len(loaded) == 10
+    assert loaded.search('cafe') == index.search('cafe')
+    assert loaded.search('snapshot') == []
+    assert SearchIndex.load(path, 6) is None
+    with open(dsu, 'a') as f:
+        f.write(' ')
+    assert SearchIndex.load(path, 5) is None
+    os.remove(dsu)
+    assert SearchIndex.load(path, 5) is None
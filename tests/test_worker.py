@@ -0,0 +1,72 @@
+"""
+test_worker.py
+Sends and polls through NetWorker against the DsuServer stand-in, and the PollScheduler's poll rate
+"""
+
+import time
+from ds_messenger import DirectMessage
+from ds_worker import NetWorker, PollScheduler
+from profile import Profile
+
+
+def test_stop_keeps_outcome_of_batch_in_flight(tmp_path, server, messenger):
+    messenger('bob').retrieve_new()
+    path = tmp_path / 'alice.dsu'
+    path.touch()
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    for i in range(5):
+        profile.queue_msg(f'message {i}', 'bob')
+    profile.save_profile(path)
+    # Each command is answered late, so the batch is still being sent when the worker is stopped
+    server.latency = 0.05
+    worker = NetWorker(profile.dsuserver, profile.username, profile.password)
+    worker.flush(profile.pending_outbox())
+    time.sleep(0.05)
+    for result in worker.stop(5.0):
+        if result[0] == 'flush':
+            profile.outbox_sent(*result[1:])
+        elif result[0] == 'token':
+            profile.set_token(result[1])
+    profile.save_profile(path)
+
+    reopened = Profile()
+    reopened.load_profile(path)
+    assert reopened.pending_outbox() == []
+    assert [msg.message for msg in reopened.conversation('bob')] == [f'message {i}' for i in range(5)]
+    assert reopened._token is not None
+
+
+def test_poll_scheduler_backs_off_when_idle_or_failing():
+    poller = PollScheduler(min_interval=1.0, max_interval=8.0, factor=2.0, jitter=0.0, active_window=0.0)
+    assert poller.next_delay() == 1.0
+    # Polls that find nothing outside a conversation slow down, up to max_interval
+    for expected in (2.0, 4.0, 8.0, 8.0):
+        poller.result(True, 0)
+        assert poller.interval == expected
+    # New messages return to the fastest rate; a failed poll backs off again
+    poller.result(True, 3)
+    assert poller.interval == 1.0
+    poller.result(False)
+    assert poller.interval == 2.0
+
+
+def test_poll_scheduler_stays_fast_during_a_conversation():
+    poller = PollScheduler(min_interval=1.0, max_interval=60.0, jitter=0.0, active_window=30.0)
+    poller.result(False)
+    poller.result(False)
+    assert poller.interval == 4.0
+    poller.activity()
+    assert poller.interval == 1.0
+    for _ in range(5):
+        poller.result(True, 0)
+    assert poller.interval == 1.0
+    # Failures back off even while the conversation is active
+    poller.result(False)
+    assert poller.interval == 2.0
+
+
+def test_poll_scheduler_jitter_stays_in_bounds():
+    poller = PollScheduler(min_interval=10.0, jitter=0.2)
+    delays = [poller.next_delay() for _ in range(1000)]
+    assert all(8.0 <= delay <= 12.0 for delay in delays)
+    assert len(set(delays)) > 1
@@ -0,0 +1,126 @@
+"""
+test_writer.py
+Coalesced and retried background saves through ProfileWriter
+"""
+
+import threading, time
+import pytest
+import profile as dsu_profile
+from ds_messenger import DirectMessage
+from profile import Profile, ProfileWriter
+
+
+@pytest.fixture
+def saved(tmp_path):
+    """
+    Returns the path of a saved DSU file holding a profile with no messages.
+    """
+    path = tmp_path / 'alice.dsu'
+    path.touch()
+    Profile('127.0.0.1', 'alice', 'pwd').save_profile(path)
+    return path
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """
+    Records every job the ProfileWriter writes. Set block to hold up the writer thread before its next
+    write until release is set, and fail to make the next writes raise OSError.
+    """
+    class Writes(list):
+        block = False
+        fail = 0
+        blocked = threading.Event()
+        release = threading.Event()
+
+    calls = Writes()
+    write_save = dsu_profile._write_save
+
+    def write(job, fsync):
+        if calls.block:
+            calls.block = False
+            calls.blocked.set()
+            calls.release.wait(5)
+        if calls.fail:
+            calls.fail -= 1
+            raise OSError("Disk full.")
+        calls.append(job)
+        write_save(job, fsync)
+    monkeypatch.setattr(dsu_profile, '_write_save', write)
+    monkeypatch.setattr(dsu_profile, 'SAVE_RETRY_INTERVAL', 0.01)
+    return calls
+
+
+def _store(profile, *messages):
+    """
+    Stores messages as received from bob now.
+    """
+    dms = []
+    for message in messages:
+        dm = DirectMessage()
+        dm.recipient = 'bob'
+        dm.message = message
+        dm.timestamp = time.time()
+        dms.append(dm)
+    profile.store_new_msgs(dms)
+
+
+def _reloaded(path):
+    """
+    Returns the messages from bob in the DSU file at path.
+    """
+    profile = Profile()
+    profile.load_profile(path)
+    return [msg.message for msg in profile.conversation('bob')]
+
+
+def test_tick_waits_for_the_delay(saved, writes):
+    profile = Profile()
+    profile.load_profile(saved)
+    writer = ProfileWriter(profile, saved, delay=0.05)
+    _store(profile, 'one')
+    writer.mark_dirty()
+    assert not writer.tick()
+    time.sleep(0.06)
+    assert writer.tick()
+    writer.wait()
+    assert not writer.tick()
+    assert _reloaded(saved) == ['one']
+    writer.close()
+
+
+def test_jobs_waiting_together_are_written_once(saved, writes):
+    profile = Profile()
+    profile.load_profile(saved)
+    writer = ProfileWriter(profile, saved, delay=0)
+    writes.block = True
+    _store(profile, 'one')
+    writer.flush(wait=False)
+    assert writes.blocked.wait(5)
+    # Three saves queue up behind the blocked write, and are appended to the journal in one write
+    for message in ('two', 'three', 'four'):
+        _store(profile, message)
+        writer.flush(wait=False)
+    writes.release.set()
+    writer.wait()
+    assert [len(job['records']) for job in writes] == [1, 3]
+    writer.close()
+    assert _reloaded(saved) == ['one', 'two', 'three', 'four']
+
+
+def test_failed_write_is_retried(saved, writes):
+    profile = Profile()
+    profile.load_profile(saved)
+    writer = ProfileWriter(profile, saved, delay=0)
+    writes.fail = 2
+    _store(profile, 'one')
+    writer.flush()
+    assert writes == []
+    deadline = time.monotonic() + 5
+    while not writes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writes.fail == 0
+    assert _reloaded(saved) == ['one']
+    _store(profile, 'two')
+    writer.close()
+    assert _reloaded(saved) == ['one', 'two']